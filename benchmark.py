@@ -0,0 +1,523 @@
+"""End-to-end pipeline benchmark on a synthetic corpus with a mock VLM.
+
+    python benchmark.py run [--images 50] [--sizes 1024x768,4000x3000] [--latency-ms 200]
+                            [--jitter-ms 50] [--error-rate 0.05] [--format json] [--output FILE]
+                            [--token-ms 20] [--ramble-tokens 500] [--stream]
+    python benchmark.py mock-vlm [--port 8766] [--latency-ms 200] [--jitter-ms 50] [--error-rate 0.05]
+    python benchmark.py startup [--repeat 3] [--task-file FILE]
+    python benchmark.py compare OLD.json NEW.json [--threshold 1.10]
+
+`run` builds a corpus of JPEGs with EXIF dates, starts a local mock of the
+OpenAI-compatible /chat/completions endpoint, and times each stage of the
+pipeline in order: preprocess (ImagePreprocessor.process_folder), split
+(task_split.split_task_file), ingest (IngestionManager.run over the task
+folders) and import (import_to_sqlite.import_json). Results are written
+as JSON, by default to bench_results/<commit>-<time>.json, and `compare`
+reports per-stage changes between two result files.
+
+`run` also times the start-up of each GUI tool (see startup.py): the tool
+is started on Qt's offscreen platform and quits after its first paint,
+the tagger with the pre-annotation file open. `startup` does only that.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image, ImageDraw
+
+import config
+import gallery_db
+import record_io
+import task_split
+import import_to_sqlite
+from pre_process import ImagePreprocessor
+from ingestion_logic import IngestionManager
+
+RESULTS_DIR = "bench_results"
+RESULT_VERSION = 1
+STAGES = ("preprocess", "split", "ingest", "import")
+STARTUP_TOOLS = ("gui", "preprocess_gui", "import_gui")
+
+MOCK_SEASONS = ("Spring", "Summer", "Autumn", "Winter")
+MOCK_CATEGORIES = ("Landscape", "Portrait", "Activity", "Documentary")
+# Chatter a rambling model adds after its answer, one token each
+MOCK_RAMBLE = ("\n", "以上", "是", "对", "这张", "图片", "的", "分析", "。", "画面", "中", "还", "可以", "看到", "，")
+MOCK_OBJECTS = ("建筑", "树木", "天空", "行人", "雪", "草坪", "图书馆", "操场", "自行车", "湖面")
+
+
+# Synthetic corpus
+
+def make_corpus(root, count, sizes, per_folder=200, seed=0):
+    """Write `count` JPEGs with EXIF dates under `root`, cycling through `sizes`.
+
+    Images are split into sub-folders of `per_folder`, like camera card
+    dumps. Returns the list of paths.
+    """
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1, 8, 0, 0)
+    paths = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        folder = os.path.join(root, f"DCIM_{i // per_folder:03d}")
+        os.makedirs(folder, exist_ok=True)
+
+        img = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(8):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            x1, y1 = x0 + rng.randrange(1, width // 2 + 2), y0 + rng.randrange(1, height // 2 + 2)
+            draw.rectangle((x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+
+        taken = (start + timedelta(minutes=37 * i)).strftime('%Y:%m:%d %H:%M:%S')
+        exif = Image.Exif()
+        exif[306] = taken                     # DateTime
+        exif.get_ifd(0x8769)[36867] = taken   # DateTimeOriginal
+
+        path = os.path.join(folder, f"DSC_{i:05d}.jpg")
+        img.save(path, quality=90, exif=exif)
+        paths.append(path)
+    return paths
+
+
+def parse_sizes(text):
+    sizes = []
+    for part in text.split(","):
+        width, height = part.lower().split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+# Mock VLM server
+
+class MockVLMHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.request_bytes += len(body)
+            delay = max(0.0, server.latency + server.rng.uniform(-server.jitter, server.jitter))
+            fail = server.rng.random() < server.error_rate
+            answer = {
+                "season": server.rng.choice(MOCK_SEASONS),
+                "category": server.rng.choice(MOCK_CATEGORIES),
+                "objects": server.rng.sample(MOCK_OBJECTS, 4),
+            }
+        time.sleep(delay)
+
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"unknown endpoint {self.path}"}})
+        elif fail:
+            with server.lock:
+                server.errors += 1
+            self.send_json(500, {"error": {"message": "mock VLM failure"}})
+        else:
+            try:
+                request = json.loads(body)
+            except ValueError:
+                request = {}
+            tokens = self.answer_tokens(answer, request.get("max_tokens", -1))
+            if request.get("stream"):
+                self.send_stream(tokens)
+                return
+            time.sleep(len(tokens) * server.token_seconds)
+            with server.lock:
+                server.tokens_sent += len(tokens)
+            self.send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "model": config.MODEL_NAME,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": len(tokens)},
+            })
+
+    def answer_tokens(self, answer, max_tokens):
+        """The reply as tokens of a few characters: the JSON answer, then
+        `ramble_tokens` of chatter, cut at max_tokens."""
+        text = json.dumps(answer, ensure_ascii=False)
+        tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+        tokens += [MOCK_RAMBLE[i % len(MOCK_RAMBLE)] for i in range(self.server.ramble_tokens)]
+        if max_tokens and max_tokens > 0:
+            tokens = tokens[:max_tokens]
+        return tokens
+
+    def send_stream(self, tokens):
+        """Send the tokens as server-sent events, one chunk per token; stops
+        when the client hangs up."""
+        server = self.server
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for token in tokens:
+                time.sleep(server.token_seconds)
+                chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                with server.lock:
+                    server.tokens_sent += 1
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            with server.lock:
+                server.streams_cancelled += 1
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockVLMServer(ThreadingHTTPServer):
+    """OpenAI-compatible /chat/completions stub with configurable latency, jitter and error rate.
+
+    `latency` is the time to the first token; each token then takes
+    `token_seconds`, and `ramble_tokens` of chatter follow the answer (as
+    a model that runs on), unless max_tokens cuts them off. Streamed
+    requests ("stream": true) are answered as server-sent events.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, seed=0, token_seconds=0.0,
+                 ramble_tokens=0):
+        super().__init__(address, MockVLMHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_seconds = token_seconds
+        self.ramble_tokens = ramble_tokens
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.request_bytes = 0
+        self.tokens_sent = 0
+        self.streams_cancelled = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "mean_request_kb": round(self.request_bytes / self.requests / 1024, 1) if self.requests else 0,
+            "tokens_sent": self.tokens_sent,
+            "streams_cancelled": self.streams_cancelled,
+        }
+
+
+def start_mock_vlm(host="127.0.0.1", port=0, **kwargs):
+    server = MockVLMServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Pipeline run
+
+def _git_commit():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def _stage(results, name, func, quiet=True):
+    """Run one stage, recording its wall time and item count."""
+    out = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext():
+        items = func()
+    seconds = time.perf_counter() - start
+    results[name] = {
+        "seconds": round(seconds, 4),
+        "items": items,
+        "items_per_second": round(items / seconds, 2) if seconds and items else 0,
+    }
+    print(f"  {name:<10} {seconds:9.3f} s  {items:>7} items")
+
+
+def run_pipeline(workdir, images=50, sizes=((1024, 768),), latency=0.2, jitter=0.05, error_rate=0.0,
+                 fmt="json", per_task=100, corpus_dir=None, seed=0, verbose=False, startup_repeat=3,
+                 token_seconds=0.0, ramble_tokens=0, stream=False):
+    """Build the corpus, run every stage against the mock VLM and return the result dict."""
+    corpus_dir = corpus_dir or os.path.join(workdir, "corpus")
+    if not os.path.isdir(corpus_dir) or not os.listdir(corpus_dir):
+        print(f"Generating {images} images in {corpus_dir} ...")
+        start = time.perf_counter()
+        make_corpus(corpus_dir, images, list(sizes), seed=seed)
+        print(f"  corpus     {time.perf_counter() - start:9.3f} s")
+
+    output_file = os.path.join(workdir, "pre_annotated" + record_io.FORMAT_EXTENSIONS[fmt])
+    library_root = os.path.join(workdir, "library")
+    ingest_db = os.path.join(workdir, "ingest.db")
+    import_db = os.path.join(workdir, "import.db")
+
+    server = start_mock_vlm(latency=latency, jitter=jitter, error_rate=error_rate, seed=seed,
+                            token_seconds=token_seconds, ramble_tokens=ramble_tokens)
+    saved = (config.API_BASE_URL, config.VLM_RATE_LIMIT_SECONDS, config.VLM_RETRY_DELAY_SECONDS, config.VLM_STREAM)
+    config.VLM_STREAM = stream
+    # Only the mock's latency should count, not the politeness delays
+    config.API_BASE_URL = server.base_url
+    config.VLM_RATE_LIMIT_SECONDS = 0
+    config.VLM_RETRY_DELAY_SECONDS = 0
+
+    stages = {}
+    quiet = not verbose
+    try:
+        def preprocess():
+            processor = ImagePreprocessor(corpus_dir, output_file)
+            processor.process_folder()
+            return len(processor.data)
+
+        def split():
+            done = 0
+
+            def on_progress(count, total):
+                nonlocal done
+                done = count
+
+            task_split.split_task_file(output_file, per_task, progress_callback=on_progress)
+            return done
+
+        def ingest():
+            dist_root = os.path.join(workdir, os.path.splitext(os.path.basename(output_file))[0] + "_dist")
+            manager = IngestionManager(dist_root, library_root, is_folder_source=True,
+                                       log_callback=(print if verbose else lambda msg: None), db_path=ingest_db)
+            manager.run()
+            conn = gallery_db.connect(ingest_db)
+            try:
+                return conn.execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+            finally:
+                conn.close()
+
+        def import_():
+            return import_to_sqlite.import_json(output_file, db_path=import_db)
+
+        print(f"Running pipeline against mock VLM at {server.base_url}")
+        _stage(stages, "preprocess", preprocess, quiet)
+        vlm_stats = server.stats()
+        _stage(stages, "split", split, quiet)
+        _stage(stages, "ingest", ingest, quiet)
+        _stage(stages, "import", import_, quiet)
+    finally:
+        config.API_BASE_URL, config.VLM_RATE_LIMIT_SECONDS, config.VLM_RETRY_DELAY_SECONDS, config.VLM_STREAM = saved
+        server.shutdown()
+        server.server_close()
+
+    startup = {}
+    if startup_repeat:
+        print("Timing GUI start-up")
+        startup = measure_startup(repeat=startup_repeat, task_file=output_file)
+
+    commit, dirty = _git_commit()
+    return {
+        "version": RESULT_VERSION,
+        "commit": commit,
+        "dirty": dirty,
+        "started_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "images": images,
+            "sizes": [f"{w}x{h}" for w, h in sizes],
+            "latency_ms": latency * 1000,
+            "jitter_ms": jitter * 1000,
+            "error_rate": error_rate,
+            "token_ms": token_seconds * 1000,
+            "ramble_tokens": ramble_tokens,
+            "stream": stream,
+            "format": fmt,
+            "per_task": per_task,
+            "seed": seed,
+        },
+        "mock_vlm": vlm_stats,
+        "stages": stages,
+        "total_seconds": round(sum(s["seconds"] for s in stages.values()), 4),
+        "startup": startup,
+    }
+
+
+def measure_startup(tools=STARTUP_TOOLS, repeat=3, task_file=None):
+    """Start each GUI tool `repeat` times until its first paint.
+
+    Returns {tool: {"seconds": median process wall time, "phases": the
+    phases startup.py reported in that run}}.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for tool in tools:
+        runs = []
+        for _ in range(repeat):
+            fd, report = tempfile.mkstemp(suffix=".json", prefix="bqb_startup_")
+            os.close(fd)
+            env = dict(os.environ, BQB_STARTUP_REPORT=report, BQB_STARTUP_EXIT="1")
+            env.setdefault("QT_QPA_PLATFORM", "offscreen")
+            cmd = [sys.executable, os.path.join(here, tool + ".py")]
+            if tool == "gui" and task_file:
+                cmd.append(os.path.abspath(task_file))
+            try:
+                start = time.perf_counter()
+                subprocess.run(cmd, env=env, cwd=here, timeout=120, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                seconds = time.perf_counter() - start
+                with open(report, 'r', encoding='utf-8') as f:
+                    phases = json.load(f)["phases"]
+            finally:
+                os.remove(report)
+            runs.append((seconds, phases))
+        runs.sort(key=lambda run: run[0])
+        seconds, phases = runs[len(runs) // 2]
+        results[tool] = {"seconds": round(seconds, 4), "phases": phases}
+        print(f"  {tool:<15} {seconds:9.3f} s  (" +
+              ", ".join(f"{name} {t:.3f}" for name, t in phases.items()) + ")")
+    return results
+
+
+def compare(old, new, threshold=1.10):
+    """Print per-stage timings of two results; returns the stages slower than `threshold`x."""
+    if old.get("params") != new.get("params"):
+        print("Warning: the two runs used different parameters.")
+    rows = [(name, old["stages"][name]["seconds"], new["stages"][name]["seconds"])
+            for name in STAGES if name in old["stages"] and name in new["stages"]]
+    old_startup, new_startup = old.get("startup", {}), new.get("startup", {})
+    rows += [("startup:" + tool, old_startup[tool]["seconds"], new_startup[tool]["seconds"])
+             for tool in STARTUP_TOOLS if tool in old_startup and tool in new_startup]
+
+    print(f"{'stage':<24}{'old (s)':>10}{'new (s)':>10}{'ratio':>8}")
+    regressions = []
+    for name, before, after in rows:
+        ratio = after / before if before else float("inf")
+        flag = "  <-- slower" if ratio > threshold else ""
+        print(f"{name:<24}{before:>10.3f}{after:>10.3f}{ratio:>8.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BQB pipeline benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_vlm_args(p):
+        p.add_argument("--latency-ms", type=float, default=200, help="mean mock VLM response time")
+        p.add_argument("--jitter-ms", type=float, default=50, help="uniform +/- spread around the latency")
+        p.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+        p.add_argument("--token-ms", type=float, default=0, help="mock VLM time per generated token")
+        p.add_argument("--ramble-tokens", type=int, default=0,
+                       help="tokens of chatter the mock VLM adds after its answer")
+        p.add_argument("--seed", type=int, default=0)
+
+    p_run = sub.add_parser("run", help="run the full pipeline and write a JSON result")
+    p_run.add_argument("--images", type=int, default=50)
+    p_run.add_argument("--sizes", default="1024x768", help="comma-separated WxH, cycled through the corpus")
+    p_run.add_argument("--format", choices=record_io.FORMATS, default="json", help="pre-annotation file format")
+    p_run.add_argument("--per-task", type=int, default=100, help="images per task folder in the split stage")
+    p_run.add_argument("--corpus", help="reuse (or create) the corpus in this folder")
+    p_run.add_argument("--workdir", help="keep all intermediate files here instead of a temp folder")
+    p_run.add_argument("--output", help=f"result file (default: {RESULTS_DIR}/<commit>-<time>.json)")
+    p_run.add_argument("--verbose", action="store_true", help="show the stages' own output")
+    p_run.add_argument("--startup-repeat", type=int, default=3,
+                       help="start each GUI tool this many times and keep the median (0 to skip)")
+    p_run.add_argument("--stream", action="store_true", help="preprocess with streamed VLM replies (VLM_STREAM)")
+    add_vlm_args(p_run)
+
+    p_startup = sub.add_parser("startup", help="only time the start-up of the GUI tools")
+    p_startup.add_argument("--repeat", type=int, default=3)
+    p_startup.add_argument("--task-file", help="task file the tagger opens at start-up")
+
+    p_mock = sub.add_parser("mock-vlm", help="only run the mock VLM server")
+    p_mock.add_argument("--host", default="127.0.0.1")
+    p_mock.add_argument("--port", type=int, default=8766)
+    add_vlm_args(p_mock)
+
+    p_compare = sub.add_parser("compare", help="compare two result files")
+    p_compare.add_argument("old")
+    p_compare.add_argument("new")
+    p_compare.add_argument("--threshold", type=float, default=1.10, help="ratio above which a stage counts as slower")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "mock-vlm":
+        server = MockVLMServer((args.host, args.port), args.latency_ms / 1000,
+                               args.jitter_ms / 1000, args.error_rate, args.seed,
+                               args.token_ms / 1000, args.ramble_tokens)
+        print(f"Mock VLM on {server.base_url} (set API_BASE_URL to this)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    if args.command == "startup":
+        measure_startup(repeat=args.repeat, task_file=args.task_file)
+        return 0
+
+    if args.command == "compare":
+        with open(args.old, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.new, 'r', encoding='utf-8') as f:
+            new = json.load(f)
+        return 1 if compare(old, new, args.threshold) else 0
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bqb_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        result = run_pipeline(
+            workdir, args.images, parse_sizes(args.sizes), args.latency_ms / 1000, args.jitter_ms / 1000,
+            args.error_rate, args.format, args.per_task, args.corpus, args.seed, args.verbose,
+            args.startup_repeat, args.token_ms / 1000, args.ramble_tokens, args.stream
+        )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output
+    if not output:
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{result['commit'] or 'nogit'}-{stamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Total {result['total_seconds']:.3f} s, results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,471 @@
+"""Headless command line for the whole pipeline (no Qt, no display needed).
+
+    python cli.py preprocess <image_dir> [-o pre_annotated.json]
+    python cli.py split <pre_annotated.json> [--per-task 100] [--zip]
+    python cli.py ingest <source> <library_root> [--db buct_gallery.db] [--flat] [--layout content]
+    python cli.py import <file> [--db buct_gallery.db]
+    python cli.py stats [--db buct_gallery.db]
+    python cli.py ledger init|work|status|merge ...   (several machines, see work_ledger.py)
+    python cli.py features <pre_annotated.json> [--workers 4]   (backfill image_features.py)
+
+Progress goes to stdout, one line per step; with --json every line is a
+JSON event ({"event": "progress" | "result", ...}) for scripts and cron
+jobs. Log messages of the stages go to stderr. Exit codes:
+
+    0  success
+    1  finished, but some items failed (see the result counts)
+    2  bad arguments
+    3  input not found
+    4  the stage failed
+    130 interrupted (preprocess saves its progress first)
+
+Each command imports only the modules it needs, so e.g. `stats` starts
+without loading Pillow or requests.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import contextlib
+
+import config
+import scheduling
+
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_NOT_FOUND = 3
+EXIT_FAILED = 4
+EXIT_INTERRUPTED = 130
+
+
+class Reporter:
+    """Writes progress and results to stdout, as text or JSON lines.
+
+    Stage output printed while a command runs is redirected to stderr (see
+    `stage`), so stdout carries only these lines.
+    """
+
+    def __init__(self, as_json=False, quiet=False):
+        self.out = sys.stdout
+        self.as_json = as_json
+        self.quiet = quiet
+        self._last = {}
+
+    def emit(self, event, **fields):
+        if self.as_json:
+            self.out.write(json.dumps({"event": event, **fields}, ensure_ascii=False) + "\n")
+        else:
+            self.out.write(f"{event}: " + " ".join(f"{k}={v}" for k, v in fields.items()) + "\n")
+        self.out.flush()
+
+    def progress(self, stage, done, total, unit="items"):
+        """Report progress, at most once per percent."""
+        if self.quiet:
+            return
+        percent = int(done * 100 / total) if total else 100
+        if self._last.get(stage) == percent and done != total:
+            return
+        self._last[stage] = percent
+        self.emit("progress", stage=stage, done=done, total=total, unit=unit, percent=percent)
+
+    def log(self, msg):
+        if not self.quiet:
+            print(msg, file=sys.stderr, flush=True)
+
+    @contextlib.contextmanager
+    def stage(self):
+        if not self.quiet:
+            with contextlib.redirect_stdout(sys.stderr):
+                yield
+            return
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+
+
+def cmd_preprocess(args, reporter):
+    if not os.path.isdir(args.input_dir):
+        reporter.log(f"Error: Directory '{args.input_dir}' not found.")
+        return EXIT_NOT_FOUND
+    from pre_process import ImagePreprocessor
+
+    failed = []
+    processed = []
+    rejected = []
+
+    def on_result(item):
+        processed.append(item["uuid"])
+        if item["tags"]["meta"].get("error"):
+            failed.append(item["filename"])
+        if item["tags"]["meta"].get("quality_issues"):
+            rejected.append(item["filename"])
+
+    start = time.perf_counter()
+    with reporter.stage():
+        processor = ImagePreprocessor(args.input_dir, args.output)
+        if args.quality_gate is not None:
+            processor.check_quality = args.quality_gate
+        # The preprocessor's own Ctrl+C handler exits with status 0; report
+        # the interruption instead
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            processor.process_folder(
+                progress_callback=lambda done, total: reporter.progress("preprocess", done, total),
+                result_callback=on_result,
+                queue=scheduling.WorkQueue(args.order, args.folders)
+            )
+        except KeyboardInterrupt:
+            processor.save_data()
+            reporter.emit("result", stage="preprocess", status="interrupted", processed=len(processed),
+                          failed=len(failed), total=len(processor.data), output=args.output)
+            return EXIT_INTERRUPTED
+
+    reporter.emit("result", stage="preprocess", status="done", processed=len(processed), failed=len(failed),
+                  rejected=len(rejected), total=len(processor.data), output=args.output,
+                  seconds=round(time.perf_counter() - start, 2))
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+
+def cmd_split(args, reporter):
+    if not os.path.exists(args.file):
+        reporter.log(f"Error: {args.file} not found.")
+        return EXIT_NOT_FOUND
+    import task_split
+
+    start = time.perf_counter()
+    with reporter.stage():
+        chunks, output_root = task_split.split_task_file(
+            args.file, args.per_task, args.zip,
+            progress_callback=lambda done, total: reporter.progress("split", done, total),
+            log_callback=reporter.log
+        )
+    reporter.emit("result", stage="split", status="done", tasks=chunks, output=output_root,
+                  seconds=round(time.perf_counter() - start, 2))
+    return EXIT_OK
+
+
+def cmd_ingest(args, reporter):
+    if not os.path.exists(args.source):
+        reporter.log(f"Error: {args.source} not found.")
+        return EXIT_NOT_FOUND
+    from ingestion_logic import IngestionManager
+
+    manager = IngestionManager(
+        args.source, args.library_root,
+        organize_by_season=not args.flat,
+        is_folder_source=os.path.isdir(args.source),
+        log_callback=reporter.log,
+        progress_callback=lambda done, total: reporter.progress("ingest", done, total, unit="KB"),
+        db_path=args.db,
+        incremental=not args.full,
+        resume=not args.no_resume,
+        verify_copies=args.verify,
+        library_layout=args.layout
+    )
+    start = time.perf_counter()
+    with reporter.stage():
+        try:
+            manager.run()
+        except KeyboardInterrupt:
+            # The journal keeps the run resumable; rerun the same command to continue
+            reporter.emit("result", stage="ingest", status="interrupted")
+            return EXIT_INTERRUPTED
+
+    counts = manager.counts
+    failed = counts.get("missing", 0) + counts.get("error", 0)
+    reporter.emit("result", stage="ingest", status=manager.status, done=counts.get("done", 0),
+                  skipped=counts.get("skipped", 0), failed=failed, seconds=round(time.perf_counter() - start, 2))
+    if manager.status != "done":
+        return EXIT_FAILED
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+
+def cmd_import(args, reporter):
+    if not os.path.exists(args.file):
+        reporter.log(f"Error: {args.file} not found.")
+        return EXIT_NOT_FOUND
+    import import_to_sqlite
+
+    start = time.perf_counter()
+    with reporter.stage():
+        count = import_to_sqlite.import_json(args.file, args.batch_size, db_path=args.db)
+    # An empty file, or one whose rows are all there already, is not an error
+    reporter.emit("result", stage="import", status="failed" if count is None else "done", items=count or 0,
+                  db=args.db, seconds=round(time.perf_counter() - start, 2))
+    return EXIT_FAILED if count is None else EXIT_OK
+
+
+def cmd_ledger_init(args, reporter):
+    if not os.path.isdir(args.input_dir):
+        reporter.log(f"Error: Directory '{args.input_dir}' not found.")
+        return EXIT_NOT_FOUND
+    import work_ledger
+
+    added, total = work_ledger.init_ledger(args.ledger, args.input_dir, args.batch_size, args.retry_failed,
+                                           args.order, args.folders)
+    reporter.emit("result", stage="ledger-init", status="done", added=added, files=total, ledger=args.ledger)
+    return EXIT_OK
+
+
+def cmd_ledger_work(args, reporter):
+    if not os.path.exists(args.ledger):
+        reporter.log(f"Error: {args.ledger} not found.")
+        return EXIT_NOT_FOUND
+    if not os.path.isdir(args.input_dir):
+        reporter.log(f"Error: Directory '{args.input_dir}' not found.")
+        return EXIT_NOT_FOUND
+    import work_ledger
+
+    start = time.perf_counter()
+    with reporter.stage():
+        worker = work_ledger.LedgerWorker(
+            args.ledger, args.input_dir, args.worker, args.output, args.lease, args.wait,
+            log_callback=reporter.log,
+            progress_callback=lambda done, total: reporter.progress("ledger-work", done, total)
+        )
+        # The preprocessor's own Ctrl+C handler exits with status 0; the
+        # worker hands its batch back to the ledger instead
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            reporter.emit("result", stage="ledger-work", status="interrupted", worker=worker.worker,
+                          annotated=worker.annotated, batches=worker.batches, output=worker.output_file)
+            return EXIT_INTERRUPTED
+
+    reporter.emit("result", stage="ledger-work", status="failed" if worker.error else "done", worker=worker.worker,
+                  annotated=worker.annotated, batches=worker.batches, lost_batches=worker.lost_batches,
+                  output=worker.output_file, error=worker.error, seconds=round(time.perf_counter() - start, 2))
+    return EXIT_FAILED if worker.error else EXIT_OK
+
+
+def cmd_ledger_status(args, reporter):
+    if not os.path.exists(args.ledger):
+        reporter.log(f"Error: {args.ledger} not found.")
+        return EXIT_NOT_FOUND
+    import work_ledger
+
+    ledger = work_ledger.WorkLedger(args.ledger)
+    try:
+        status = ledger.status()
+    finally:
+        ledger.close()
+    if reporter.as_json:
+        reporter.emit("result", stage="ledger-status", ledger=args.ledger, **status)
+        return EXIT_OK
+
+    out = reporter.out
+    out.write(f"{args.ledger}: {status['done']}/{status['files']} images done, {status['failed']} failed\n")
+    out.write("  batches: " + ", ".join(f"{k} {v}" for k, v in sorted(status["batches"].items())) +
+              f", expired leases {status['expired_leases']}\n")
+    for w in status["workers"]:
+        out.write(f"  {w['name']}: {w['done']} done, {w['active_batches']} active batch(es), last seen {w['last_seen']}\n")
+    return EXIT_OK
+
+
+def cmd_ledger_merge(args, reporter):
+    if not os.path.exists(args.ledger):
+        reporter.log(f"Error: {args.ledger} not found.")
+        return EXIT_NOT_FOUND
+    import work_ledger
+
+    with reporter.stage():
+        written, missing = work_ledger.merge_outputs(args.ledger, args.output, args.input_dir, reporter.log)
+    reporter.emit("result", stage="ledger-merge", status="done", items=written, missing=missing, output=args.output)
+    return EXIT_PARTIAL if missing else EXIT_OK
+
+
+def cmd_stats(args, reporter):
+    if not os.path.exists(args.db):
+        reporter.log(f"Error: {args.db} not found.")
+        return EXIT_NOT_FOUND
+    import gallery_query
+
+    conn = gallery_query.connect_readonly(args.db)
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+        facets = gallery_query.facet_counts(conn)
+        keywords = gallery_query.keyword_counts(conn, args.top)
+        failures = conn.execute("SELECT COUNT(*) FROM photos WHERE vlm_error IS NOT NULL").fetchone()[0]
+        runs = conn.execute("""
+            SELECT id, status, started_at, finished_at, items_done, items_skipped, items_failed
+            FROM ingest_runs ORDER BY id DESC LIMIT 5
+        """).fetchall()
+    finally:
+        conn.close()
+
+    stats = {
+        "db": args.db,
+        "photos": total,
+        "vlm_failures": failures,
+        # JSON object keys cannot be None
+        "facets": {facet: {str(value) if value is not None else "": count for value, count in counts.items()}
+                   for facet, counts in facets.items()},
+        "top_keywords": [{"name": name, "count": count} for name, count in keywords],
+        "recent_ingest_runs": [
+            dict(zip(("id", "status", "started_at", "finished_at", "done", "skipped", "failed"), run)) for run in runs
+        ],
+    }
+    if reporter.as_json:
+        reporter.emit("result", stage="stats", **stats)
+        return EXIT_OK
+
+    out = reporter.out
+    out.write(f"{args.db}: {total} photos, {failures} without VLM tags\n")
+    for facet, counts in facets.items():
+        values = ", ".join(f"{value or '(none)'} {count}" for value, count in
+                           sorted(counts.items(), key=lambda kv: -kv[1]))
+        out.write(f"  {facet}: {values}\n")
+    out.write("  keywords: " + ", ".join(f"{name} {count}" for name, count in keywords) + "\n")
+    for run in stats["recent_ingest_runs"]:
+        out.write(f"  ingest run #{run['id']} {run['status']} {run['started_at']}: "
+                  f"{run['done']} done, {run['skipped']} skipped, {run['failed']} failed\n")
+    return EXIT_OK
+
+
+def cmd_features(args, reporter):
+    if not os.path.exists(args.file):
+        reporter.log(f"Error: {args.file} not found.")
+        return EXIT_NOT_FOUND
+    import record_io
+    import image_features
+
+    store_path = args.store or image_features.default_store_path(args.file)
+    store = image_features.FeatureStore(store_path)
+    task_dir = os.path.dirname(os.path.abspath(args.file))
+    todo = []
+    missing = 0
+    for item in record_io.iter_items(args.file):
+        if not item.get("uuid") or (item["uuid"] in store and not args.full):
+            continue
+        filename = item.get("filename") or os.path.basename(item.get("original_path", ""))
+        candidates = [item.get("original_path", ""), os.path.join(task_dir, filename),
+                      os.path.join(task_dir, "images", filename)]
+        path = next((c for c in candidates if c and os.path.exists(c)), None)
+        if path:
+            todo.append((item["uuid"], path))
+        else:
+            missing += 1
+
+    start = time.perf_counter()
+    unreadable = 0
+    try:
+        for records in image_features.extract_items(
+                todo, workers=args.workers, batch_size=args.batch_size,
+                progress_callback=lambda done, total: reporter.progress("features", done, total)):
+            unreadable += int((records["width"] == 0).sum())
+            store.add(records[records["width"] > 0])
+    finally:
+        store.close()
+    reporter.emit("result", stage="features", status="done", extracted=len(todo) - unreadable,
+                  unreadable=unreadable, missing=missing, total=len(store), output=store_path,
+                  seconds=round(time.perf_counter() - start, 2))
+    return EXIT_PARTIAL if unreadable or missing else EXIT_OK
+
+
+def add_order_args(p):
+    p.add_argument("--order", choices=tuple(scheduling.POLICIES),
+                   default=config.PREPROCESS_ORDER, help="processing order (see scheduling.py)")
+    p.add_argument("--folders", nargs="+", default=(), metavar="SUBFOLDER",
+                   help="subfolders to process first, for --order folders")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="BUCT Tagger headless pipeline")
+    parser.add_argument("--json", action="store_true", help="emit progress and results as JSON lines")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print results")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("preprocess", help="pre-annotate a folder of images with the VLM")
+    p.add_argument("input_dir")
+    p.add_argument("-o", "--output", default="pre_annotated.json",
+                   help="output file; the extension picks the format (.json, .jsonl, .bqr, .taskdb)")
+    add_order_args(p)
+    p.add_argument("--quality-gate", action=argparse.BooleanOptionalAction, default=None,
+                   help="skip the VLM for blurry, blank or badly exposed shots (default: QUALITY_GATE)")
+    p.set_defaults(func=cmd_preprocess)
+
+    p = sub.add_parser("split", help="split a pre-annotated file into task folders")
+    p.add_argument("file")
+    p.add_argument("--per-task", type=int, default=100, help="images per task folder")
+    p.add_argument("--zip", action="store_true", help="also zip every task folder")
+    p.set_defaults(func=cmd_split)
+
+    p = sub.add_parser("ingest", help="copy annotated images into the library and the database")
+    p.add_argument("source", help="a task file, or a folder of returned task folders")
+    p.add_argument("library_root")
+    p.add_argument("--db", default=config.DB_FILE)
+    p.add_argument("--flat", action="store_true", help="do not sort the library into season folders")
+    p.add_argument("--full", action="store_true", help="re-ingest unchanged files and items too")
+    p.add_argument("--no-resume", action="store_true", help="start a new run instead of resuming an unfinished one")
+    p.add_argument("--verify", choices=("size", "sha256"), default=config.INGEST_VERIFY_COPIES)
+    p.add_argument("--layout", choices=("season", "content"), default=config.LIBRARY_LAYOUT)
+    p.set_defaults(func=cmd_ingest)
+
+    p = sub.add_parser("import", help="import a task file or task DB into the database (no image copies)")
+    p.add_argument("file")
+    p.add_argument("--db", default=config.DB_FILE)
+    p.add_argument("--batch-size", type=int, default=config.DB_BATCH_SIZE)
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("stats", help="summarise the database")
+    p.add_argument("--db", default=config.DB_FILE)
+    p.add_argument("--top", type=int, default=20, help="number of keywords to list")
+    p.set_defaults(func=cmd_stats)
+
+    p = sub.add_parser("features", help="compute image features for the items of a task file")
+    p.add_argument("file")
+    p.add_argument("--store", help="feature file (default: next to the task file, .features.npy)")
+    p.add_argument("--workers", type=int, default=config.FEATURE_WORKERS, help="processes (0: one per CPU)")
+    p.add_argument("--batch-size", type=int, default=32, help="images per batch")
+    p.add_argument("--full", action="store_true", help="recompute features already stored")
+    p.set_defaults(func=cmd_features)
+
+    p = sub.add_parser("ledger", help="preprocess one folder on several machines through a shared ledger")
+    ledger_sub = p.add_subparsers(dest="ledger_command", required=True)
+
+    p = ledger_sub.add_parser("init", help="create the ledger, or add new images to it")
+    p.add_argument("ledger")
+    p.add_argument("input_dir")
+    p.add_argument("--batch-size", type=int, default=config.LEDGER_BATCH_SIZE, help="images per claimed batch")
+    p.add_argument("--retry-failed", action="store_true", help="queue images that failed again")
+    add_order_args(p)
+    p.set_defaults(func=cmd_ledger_init)
+
+    p = ledger_sub.add_parser("work", help="claim and annotate batches until none are left")
+    p.add_argument("ledger")
+    p.add_argument("input_dir", help="the image folder as mounted on this machine")
+    p.add_argument("--worker", help="worker name, unique per process (default: host name)")
+    p.add_argument("-o", "--output", help="this worker's output (default: <ledger>_workers/<worker>.jsonl)")
+    p.add_argument("--lease", type=int, default=config.LEDGER_LEASE_SECONDS, help="lease length in seconds")
+    p.add_argument("--wait", action="store_true", help="keep polling while other workers hold leases")
+    p.set_defaults(func=cmd_ledger_work)
+
+    p = ledger_sub.add_parser("status", help="progress per worker")
+    p.add_argument("ledger")
+    p.set_defaults(func=cmd_ledger_status)
+
+    p = ledger_sub.add_parser("merge", help="merge the workers' outputs into one pre-annotation file")
+    p.add_argument("ledger")
+    p.add_argument("output")
+    p.add_argument("--input-dir", help="rewrite original_path to the image folder as mounted here")
+    p.set_defaults(func=cmd_ledger_merge)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    reporter = Reporter(args.json, args.quiet)
+    try:
+        return args.func(args, reporter)
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        reporter.emit("error", command=args.command, message=str(e))
+        return EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
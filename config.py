@@ -1,8 +1,43 @@
 import os
-from dotenv import load_dotenv
+
+
+def load_env_file(filename=".env"):
+    """Load KEY=VALUE lines from the nearest .env (this folder or a parent)
+    into os.environ, without overriding variables that are already set.
+
+    Handles comments, `export` prefixes and quoted values, which covers
+    .env.example; kept here instead of python-dotenv so that importing
+    config stays cheap for the GUI tools.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(folder, filename)
+        if os.path.isfile(path):
+            break
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return
+        folder = parent
+
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            key = key.strip()
+            if key.startswith('export '):
+                key = key[len('export '):].strip()
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in ('"', "'"):
+                value = value[1:-1]
+            elif ' #' in value:
+                value = value.split(' #', 1)[0].rstrip()
+            os.environ.setdefault(key, value)
+
 
 # Load environment variables from .env file
-load_dotenv()
+load_env_file()
 
 # API Config
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:1234/v1")
@@ -12,8 +47,55 @@ DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY", "")
 # Preprocessing Config
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
 RESIZE_TARGET_SIZE = int(os.getenv("RESIZE_TARGET_SIZE", 1024))
+# Pause after each image, and before retrying a failed VLM call (seconds)
+VLM_RATE_LIMIT_SECONDS = float(os.getenv("VLM_RATE_LIMIT_SECONDS", 1))
+VLM_RETRY_DELAY_SECONDS = float(os.getenv("VLM_RETRY_DELAY_SECONDS", 2))
+# Structured output (vlm_client.py): auto, json_schema, guided_json or off;
+# reply length cap in tokens (0: no cap) and request timeout
+VLM_STRUCTURED_OUTPUT = os.getenv("VLM_STRUCTURED_OUTPUT", "auto")
+VLM_MAX_TOKENS = int(os.getenv("VLM_MAX_TOKENS", 256))
+VLM_TIMEOUT_SECONDS = float(os.getenv("VLM_TIMEOUT_SECONDS", 120))
+# Streamed replies, closed as soon as a complete answer has arrived, or
+# after this many tokens / seconds without one
+VLM_STREAM = os.getenv("VLM_STREAM", "0") not in ("", "0")
+VLM_STREAM_MAX_TOKENS = int(os.getenv("VLM_STREAM_MAX_TOKENS", 400))
+VLM_STREAM_MAX_SECONDS = float(os.getenv("VLM_STREAM_MAX_SECONDS", 60))
+# Order images are preprocessed in: walk, newest, folders, smallest, round_robin (see scheduling.py)
+PREPROCESS_ORDER = os.getenv("PREPROCESS_ORDER", "walk")
+# Shared work ledger (work_ledger.py): images per batch, and how long a
+# claimed batch stays reserved for a worker that stopped renewing it
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", 50))
+LEDGER_LEASE_SECONDS = int(os.getenv("LEDGER_LEASE_SECONDS", 600))
+# Image features (hashes, histogram, exposure, sharpness; image_features.py), stored
+# next to the output file. Workers for backfilling features (0: one per CPU)
+EXTRACT_FEATURES = os.getenv("EXTRACT_FEATURES", "1") not in ("", "0")
+FEATURE_WORKERS = int(os.getenv("FEATURE_WORKERS", 0))
+# Quality gate before the VLM call (quality_gate.py): blurry, blank or badly
+# exposed shots are flagged instead of sent. Sharpness is the Laplacian
+# variance of a 256 px thumbnail, the others are shares of 0..1
+QUALITY_GATE = os.getenv("QUALITY_GATE", "0") not in ("", "0")
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", 15))
+QUALITY_MIN_CONTRAST = float(os.getenv("QUALITY_MIN_CONTRAST", 0.04))
+QUALITY_MIN_BRIGHTNESS = float(os.getenv("QUALITY_MIN_BRIGHTNESS", 0.08))
+QUALITY_MAX_BRIGHTNESS = float(os.getenv("QUALITY_MAX_BRIGHTNESS", 0.92))
+QUALITY_MAX_CLIPPED = float(os.getenv("QUALITY_MAX_CLIPPED", 0.5))
+
+# Database Config
+DB_FILE = os.getenv("DB_FILE", "buct_gallery.db")
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", 5000))
+DB_CACHE_SIZE_MB = int(os.getenv("DB_CACHE_SIZE_MB", 64))
+
+# Ingestion Config
+# How copied library files are checked: "size" or "sha256" (slower, reads both files)
+INGEST_VERIFY_COPIES = os.getenv("INGEST_VERIFY_COPIES", "size")
+# Library layout: "season" (Season/{uuid}.jpg) or "content" (de-duplicated blobs/ab/cd/{sha256}.jpg)
+LIBRARY_LAYOUT = os.getenv("LIBRARY_LAYOUT", "season")
 
 # GUI Config
 WINDOW_TITLE = "BUCT Tagger - 北化图库智能打标系统"
 WINDOW_WIDTH = int(os.getenv("WINDOW_WIDTH", 1200))
 WINDOW_HEIGHT = int(os.getenv("WINDOW_HEIGHT", 800))
+# Tag suggestions from similar annotated images (similarity.py)
+SIMILARITY_INDEX_FILE = os.getenv("SIMILARITY_INDEX_FILE", "similarity_index.npz")
+SIMILAR_K = int(os.getenv("SIMILAR_K", 5))
+SIMILAR_MAX_DISTANCE = float(os.getenv("SIMILAR_MAX_DISTANCE", 0.3))
@@ -0,0 +1,401 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+import config
+import profiling
+
+DB_FILE = config.DB_FILE
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+# photos columns copied out of meta, mapped to their meta key
+META_COLUMNS = {
+    "date_taken": "date_taken",
+    "annotator": "annotator",
+    "vlm_error": "error",
+    "last_modified": "last_modified",
+}
+
+# photos columns added after the first release, filled in on older databases
+ADDED_COLUMNS = tuple(META_COLUMNS) + ("extra",)
+
+PHOTO_INSERT_COLUMNS = (
+    "uuid", "filename", "original_path", "processed_path", "thumb_path",
+    "width", "height", "campus", "season", "category", "keywords", "meta", "annotated_at",
+    "extra",
+) + tuple(META_COLUMNS)
+
+# Item keys that have a photos column; anything else is kept in `extra`
+ITEM_KEYS = {"uuid", "filename", "original_path", "processed_path", "thumb_path", "width", "height", "tags"}
+TAG_KEYS = {"attributes", "keywords", "meta"}
+ATTRIBUTE_KEYS = {"campus", "season", "category"}
+# Keys the pipelines add to items in flight, never stored
+TRANSIENT_KEYS = {"_source_json", "_source_index", "_ledger_path"}
+
+UPSERT_SQL = f"""
+    INSERT OR REPLACE INTO photos ({", ".join(PHOTO_INSERT_COLUMNS)})
+    VALUES ({", ".join("?" * len(PHOTO_INSERT_COLUMNS))})
+"""
+
+
+def connect(db_path=DB_FILE):
+    """Open a write connection tuned for bulk imports."""
+    conn = sqlite3.connect(db_path)
+    # WAL lets readers keep working while an import is running, and
+    # synchronous=NORMAL only fsyncs at checkpoints instead of every commit.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Negative cache_size is in KiB
+    conn.execute(f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_MB * 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def init_db(db_path=DB_FILE):
+    """Create any missing tables and indexes from schema.sql, then migrate."""
+    with open(SCHEMA_FILE, 'r', encoding='utf-8') as f:
+        sql_script = f.read()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        stale_triggers = _drop_stale_keyword_triggers(conn)
+        # Older databases need new columns before schema.sql indexes them
+        add_missing_columns(conn)
+        conn.executescript(sql_script)
+        conn.commit()
+        if stale_triggers:
+            _relink_keywords(conn)
+            conn.commit()
+        migrate(conn)
+    finally:
+        conn.close()
+
+
+def add_missing_columns(conn):
+    """Add ADDED_COLUMNS to a photos table created before they existed."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(photos)")}
+    if not columns:
+        return  # New database, schema.sql creates the full table
+    for column in ADDED_COLUMNS:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE photos ADD COLUMN {column} TEXT")
+    conn.commit()
+
+
+def _drop_stale_keyword_triggers(conn):
+    """Drop keyword triggers that use INSERT OR IGNORE, so schema.sql re-creates them.
+
+    Inside a trigger the OR IGNORE took on the outer INSERT OR REPLACE
+    policy: re-upserting a photo re-created its existing keywords under new
+    ids, leaving other photos linked to ids that no longer exist.
+    """
+    stale = [name for name, sql in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN ('photos_keywords_ai', 'photos_keywords_au')"
+    ) if "INSERT OR IGNORE" in sql]
+    for name in stale:
+        conn.execute(f"DROP TRIGGER {name}")
+    return bool(stale)
+
+
+def _relink_keywords(conn):
+    """Rebuild keywords/photo_keywords from photos.keywords."""
+    conn.execute("DELETE FROM photo_keywords")
+    conn.execute("DELETE FROM keywords")
+    _backfill_keywords(conn)
+
+
+def _backfill_keywords(conn):
+    """Populate keywords/photo_keywords from photos rows written before they existed."""
+    conn.execute("""
+        INSERT OR IGNORE INTO keywords (name)
+        SELECT trim(j.value)
+        FROM photos p, json_each(CASE WHEN json_valid(p.keywords) THEN p.keywords ELSE '[]' END) j
+        WHERE j.type = 'text' AND trim(j.value) != ''
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO photo_keywords (keyword_id, photo_uuid)
+        SELECT k.id, p.uuid
+        FROM photos p, json_each(CASE WHEN json_valid(p.keywords) THEN p.keywords ELSE '[]' END) j
+        JOIN keywords k ON k.name = trim(j.value)
+        WHERE j.type = 'text'
+    """)
+
+
+def rebuild_fts(conn):
+    """Rebuild the full-text index from the photos table."""
+    conn.execute("DELETE FROM photos_fts")
+    conn.execute("DELETE FROM photos_fts_docs")
+    conn.execute("INSERT INTO photos_fts_docs (uuid) SELECT uuid FROM photos")
+    conn.execute("""
+        INSERT INTO photos_fts (rowid, keywords, description, filename, annotator)
+        SELECT d.id, s.keywords, s.description, s.filename, s.annotator
+        FROM photos_fts_docs d JOIN photos_fts_source s ON s.uuid = d.uuid
+    """)
+
+
+def _backfill_meta_columns(conn):
+    assignments = ", ".join(f"{column} = json_extract(meta, '$.{key}')" for column, key in META_COLUMNS.items())
+    conn.execute(f"UPDATE photos SET {assignments} WHERE json_valid(meta)")
+
+
+def _drop_single_column_indexes(conn):
+    # Superseded by the (facet, date_taken, uuid) indexes
+    for name in ("idx_photos_campus", "idx_photos_season", "idx_photos_category"):
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def rebuild_summaries(conn):
+    """Recompute photo_facets and keyword_counts from scratch."""
+    conn.execute("DELETE FROM photo_facets")
+    conn.execute("""
+        INSERT INTO photo_facets (campus, season, category, photo_count)
+        SELECT ifnull(campus, ''), ifnull(season, ''), ifnull(category, ''), COUNT(*)
+        FROM photos GROUP BY 1, 2, 3
+    """)
+    conn.execute("DELETE FROM keyword_counts")
+    conn.execute("""
+        INSERT INTO keyword_counts (keyword_id, photo_count)
+        SELECT keyword_id, COUNT(*) FROM photo_keywords GROUP BY keyword_id
+    """)
+
+
+def _build_summaries(conn):
+    # idx_photos_facets only served the GROUP BY that photo_facets replaces
+    conn.execute("DROP INDEX IF EXISTS idx_photos_facets")
+
+    rebuild_summaries(conn)
+
+
+def _rekey_ingest_files(conn):
+    # ingest_files was keyed by path alone, so a file ingested into one
+    # library was skipped for every other. Forgetting the old rows only
+    # means those files are read once more; unchanged items are still
+    # skipped by their digests.
+    conn.execute("DROP TABLE IF EXISTS ingest_files")
+    with open(SCHEMA_FILE, 'r', encoding='utf-8') as f:
+        conn.executescript(f.read())
+
+
+def _keep_fts_doc_ids(conn):
+    # The first FTS triggers replaced the photo's photos_fts_docs row, and
+    # so its id, on every upsert; re-create them from schema.sql
+    conn.execute("DROP TRIGGER IF EXISTS photos_fts_ai")
+    conn.execute("DROP TRIGGER IF EXISTS photos_fts_au")
+    with open(SCHEMA_FILE, 'r', encoding='utf-8') as f:
+        conn.executescript(f.read())
+
+
+def _posix_blob_paths(conn):
+    # Blob paths written on Windows used '\\'; they are stored '/'-separated now
+    conn.execute("UPDATE blobs SET path = replace(path, '\\', '/') WHERE instr(path, '\\')")
+
+
+# One-time data migrations, keyed by the PRAGMA user_version they bring the DB to
+MIGRATIONS = [
+    (1, _backfill_keywords),
+    (2, rebuild_fts),
+    (3, _backfill_meta_columns),
+    (4, _drop_single_column_indexes),
+    (5, _build_summaries),
+    (6, _rekey_ingest_files),
+    (7, _keep_fts_doc_ids),
+    (8, _posix_blob_paths),
+]
+
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, step in MIGRATIONS:
+        if target <= version:
+            continue
+        step(conn)
+        conn.execute(f"PRAGMA user_version = {target}")
+        conn.commit()
+
+
+def item_to_row(item, processed_path=None, thumb_path=None, annotated_at=None):
+    """Flatten a JSON item into the parameter tuple used by UPSERT_SQL."""
+    tags = item.get("tags", {})
+    attrs = tags.get("attributes", {})
+    meta = tags.get("meta") or {}
+    if annotated_at is None:
+        annotated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    return (
+        item.get("uuid"),
+        item.get("filename"),
+        item.get("original_path"),
+        processed_path if processed_path is not None else item.get("processed_path"),
+        thumb_path if thumb_path is not None else item.get("thumb_path"),
+        item.get("width"),
+        item.get("height"),
+        attrs.get("campus"),
+        attrs.get("season"),
+        attrs.get("category"),
+        json.dumps(tags.get("keywords", []), ensure_ascii=False),
+        json.dumps(meta, ensure_ascii=False),
+        annotated_at,
+        item_extra(item),
+    ) + tuple(_meta_text(meta.get(key)) for key in META_COLUMNS.values())
+
+
+def item_extra(item):
+    """The keys of `item` no photos column holds, as JSON shaped like the item (or None)."""
+    extra = {key: value for key, value in item.items() if key not in ITEM_KEYS and key not in TRANSIENT_KEYS}
+    tags = item.get("tags", {})
+    tag_extra = {key: value for key, value in tags.items() if key not in TAG_KEYS}
+    attr_extra = {key: value for key, value in tags.get("attributes", {}).items() if key not in ATTRIBUTE_KEYS}
+    if attr_extra:
+        tag_extra["attributes"] = attr_extra
+    if tag_extra:
+        extra["tags"] = tag_extra
+    return json.dumps(extra, ensure_ascii=False) if extra else None
+
+
+# photos columns that make up a JSON item, in row_to_item order
+ITEM_COLUMNS = (
+    "uuid", "filename", "original_path", "processed_path", "thumb_path",
+    "width", "height", "campus", "season", "category", "keywords", "meta", "extra",
+)
+ITEM_SELECT = f"SELECT {', '.join(ITEM_COLUMNS)} FROM photos"
+
+
+def item_select(conn):
+    """ITEM_SELECT for a photos table that may predate some columns, e.g. an old task DB."""
+    present = {row[1] for row in conn.execute("PRAGMA table_info(photos)")}
+    return f"SELECT {', '.join(c if c in present else 'NULL' for c in ITEM_COLUMNS)} FROM photos"
+
+
+def row_to_item(row):
+    """Rebuild a JSON item from a row selected with ITEM_SELECT."""
+    (uuid, filename, original_path, processed_path, thumb_path,
+     width, height, campus, season, category, keywords, meta, extra) = row
+    attrs = {}
+    for key, value in (("campus", campus), ("season", season), ("category", category)):
+        if value is not None:
+            attrs[key] = value
+    item = {
+        "uuid": uuid,
+        "filename": filename,
+        "original_path": original_path,
+        "processed_path": processed_path,
+        "thumb_path": thumb_path,
+        "width": width,
+        "height": height,
+        "tags": {
+            "attributes": attrs,
+            "keywords": json.loads(keywords) if keywords else [],
+            "meta": json.loads(meta) if meta else {},
+        },
+    }
+    if extra:
+        _merge_extra(item, json.loads(extra))
+    return item
+
+
+def _merge_extra(target, extra):
+    for key, value in extra.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_extra(target[key], value)
+        else:
+            target[key] = value
+
+
+def merge_db(conn, other_path):
+    """Upsert every photo of another database with the photos schema (e.g. a task DB).
+
+    One INSERT ... SELECT over an ATTACHed database, so the rows never pass
+    through Python; the keyword, facet and full-text triggers still fire.
+    Returns the number of rows merged.
+    """
+    columns = ", ".join(PHOTO_INSERT_COLUMNS)
+    conn.execute("ATTACH DATABASE ? AS other", (other_path,))
+    try:
+        # Task DBs created before a column was added select NULL for it
+        present = {row[1] for row in conn.execute("PRAGMA other.table_info(photos)")}
+        values = ", ".join(c if c in present else "NULL" for c in PHOTO_INSERT_COLUMNS)
+        cur = conn.execute(f"INSERT OR REPLACE INTO main.photos ({columns}) SELECT {values} FROM other.photos")
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.execute("DETACH DATABASE other")
+
+
+def _meta_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+class BulkWriter:
+    """Buffers rows and writes them with executemany, one transaction per batch.
+
+    Defaults to upserting photo rows; pass `sql` to batch any other statement.
+    `depends_on` is another writer whose rows must be committed first, e.g.
+    bookkeeping rows that claim photo rows were written. Rows whose
+    `dependency_key` column names a row that writer failed to write (its
+    first column, kept in `failed_keys`) are passed through
+    `on_failed_dependency`, which returns the row to write instead or None.
+    """
+
+    def __init__(self, conn, batch_size=config.DB_BATCH_SIZE, log_callback=None, sql=UPSERT_SQL, depends_on=None,
+                 dependency_key=0, on_failed_dependency=None):
+        self.conn = conn
+        self.sql = sql
+        self.depends_on = depends_on
+        self.dependency_key = dependency_key
+        self.on_failed_dependency = on_failed_dependency
+        self.batch_size = max(1, batch_size)
+        self.log_callback = log_callback
+        self.pending = []
+        self.written = 0
+        self.failed = 0
+        self.failed_keys = set()
+
+    def log(self, msg):
+        if self.log_callback:
+            self.log_callback(msg)
+        else:
+            print(msg)
+
+    def add(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.depends_on:
+            self.depends_on.flush()
+
+        rows, self.pending = self.pending, []
+        if self.on_failed_dependency and self.depends_on.failed_keys:
+            failed_keys = self.depends_on.failed_keys
+            rows = [self.on_failed_dependency(row) if row[self.dependency_key] in failed_keys else row
+                    for row in rows]
+            rows = [row for row in rows if row is not None]
+            if not rows:
+                return
+        try:
+            with profiling.span("commit", rows=len(rows)):
+                self.conn.executemany(self.sql, rows)
+                self.conn.commit()
+            self.written += len(rows)
+        except sqlite3.Error:
+            # A single bad row fails the whole batch; redo it row by row
+            # so only the offending items are dropped.
+            self.conn.rollback()
+            for row in rows:
+                try:
+                    self.conn.execute(self.sql, row)
+                    self.written += 1
+                except sqlite3.Error as e:
+                    self.failed += 1
+                    self.failed_keys.add(row[0])
+                    self.log(f"写入失败 {row[0]}: {e}")
+            self.conn.commit()
+
+    def close(self):
+        self.flush()
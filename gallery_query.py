@@ -0,0 +1,340 @@
+import json
+import queue
+import base64
+import sqlite3
+import contextlib
+
+import gallery_db
+
+PHOTO_COLUMNS = (
+    "uuid", "filename", "original_path", "processed_path", "thumb_path",
+    "width", "height", "campus", "season", "category", "keywords", "meta",
+    "created_at", "annotated_at", "date_taken", "annotator", "vlm_error", "last_modified"
+)
+
+
+def connect(db_path=gallery_db.DB_FILE):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def connect_readonly(db_path=gallery_db.DB_FILE):
+    """Read-only connection for serving queries, safe to hand between threads.
+
+    sqlite3 keeps a per-connection cache of prepared statements keyed by SQL
+    text, so the fixed query strings in this module are compiled once per
+    connection and reused.
+    """
+    conn = sqlite3.connect(
+        f"file:{db_path}?mode=ro", uri=True,
+        check_same_thread=False, cached_statements=256
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute("PRAGMA mmap_size = 268435456")
+    return conn
+
+
+class ConnectionPool:
+    """Fixed-size pool of read-only connections.
+
+    With the database in WAL mode (set by every writer in gallery_db) readers
+    never block on the importer, so one pool can serve all request threads.
+    """
+
+    def __init__(self, db_path=gallery_db.DB_FILE, size=8):
+        self._pool = queue.LifoQueue()
+        for _ in range(size):
+            self._pool.put(connect_readonly(db_path))
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def row_to_dict(row):
+    """Convert a photos row into a plain dict with keywords/meta decoded."""
+    photo = dict(row)
+    for key, default in (("keywords", []), ("meta", {})):
+        if key in photo:
+            try:
+                photo[key] = json.loads(photo[key]) if photo[key] else default
+            except (TypeError, ValueError):
+                photo[key] = default
+    return photo
+
+
+def list_by_date(conn, season=None, category=None, newest_first=False, limit=100):
+    """Gallery listing (uuid, thumb_path, date_taken) ordered by date taken.
+
+    With both season and category given this is served entirely from
+    idx_photos_season_category_date.
+    """
+    sql = "SELECT uuid, thumb_path, date_taken FROM photos"
+    where = []
+    params = []
+    for column, value in (("season", season), ("category", category)):
+        if value:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY date_taken {'DESC' if newest_first else 'ASC'} LIMIT ?"
+    params.append(limit)
+    return [dict(row) for row in conn.execute(sql, params)]
+
+
+def encode_cursor(photo):
+    """Opaque keyset cursor for the page after `photo`."""
+    key = json.dumps([photo["date_taken"], photo["uuid"]])
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        date_taken, uuid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+    return date_taken, uuid
+
+
+def list_page(conn, campus=None, season=None, category=None, cursor=None, limit=50):
+    """One page of photos ordered by (date_taken, uuid), using keyset pagination.
+
+    Returns (photos, next_cursor); next_cursor is None on the last page. Unlike
+    OFFSET, each page costs the same no matter how deep the client pages.
+    Photos without a date sort first (SQLite orders NULL lowest).
+    """
+    sql = "SELECT uuid, filename, thumb_path, campus, season, category, date_taken FROM photos"
+    where = []
+    params = []
+    for column, value in (("campus", campus), ("season", season), ("category", category)):
+        if value:
+            where.append(f"{column} = ?")
+            params.append(value)
+
+    if cursor:
+        date_taken, uuid = decode_cursor(cursor)
+        if date_taken is None:
+            where.append("(date_taken IS NOT NULL OR uuid > ?)")
+            params.append(uuid)
+        else:
+            # Row-value comparison lets SQLite seek straight to the cursor
+            where.append("(date_taken, uuid) > (?, ?)")
+            params.extend([date_taken, uuid])
+
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY date_taken, uuid LIMIT ?"
+    params.append(limit + 1)
+
+    photos = [dict(row) for row in conn.execute(sql, params)]
+    next_cursor = None
+    if len(photos) > limit:
+        photos = photos[:limit]
+        next_cursor = encode_cursor(photos[-1])
+    return photos, next_cursor
+
+
+FACETS = ("campus", "season", "category")
+
+
+def facet_counts(conn, campus=None, season=None, category=None):
+    """Counts per campus/season/category value for a filter sidebar.
+
+    Each facet is counted with the filters on the *other* facets applied, so
+    the sidebar shows what selecting a value would yield. Read from the
+    trigger-maintained photo_facets table, which has one row per
+    (campus, season, category) combination, so the cost does not grow with
+    the number of photos. Photos missing an attribute are counted under None.
+    """
+    filters = {"campus": campus, "season": season, "category": category}
+    result = {facet: {} for facet in FACETS}
+    rows = conn.execute(
+        "SELECT campus, season, category, photo_count FROM photo_facets WHERE photo_count > 0"
+    )
+    for row in rows:
+        combo = {facet: row[i] or None for i, facet in enumerate(FACETS)}
+        for facet in FACETS:
+            if all(not value or combo[column] == value
+                   for column, value in filters.items() if column != facet):
+                counts = result[facet]
+                counts[combo[facet]] = counts.get(combo[facet], 0) + row[3]
+    return result
+
+
+def keyword_counts(conn, limit=None):
+    """(keyword, photo count) pairs, most used first, from keyword_counts."""
+    sql = """
+        SELECT k.name, c.photo_count FROM keyword_counts c
+        JOIN keywords k ON k.id = c.keyword_id
+        WHERE c.photo_count > 0
+        ORDER BY c.photo_count DESC, k.name
+    """
+    params = []
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [(row[0], row[1]) for row in conn.execute(sql, params)]
+
+
+def annotator_counts(conn, since):
+    """Number of photos saved per annotator since a 'YYYY-MM-DD[ HH:MM:SS]' timestamp."""
+    rows = conn.execute("""
+        SELECT annotator, COUNT(*) AS count FROM photos
+        WHERE last_modified >= ?
+        GROUP BY annotator ORDER BY count DESC
+    """, (since,)).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+def vlm_failures(conn, limit=100):
+    """Photos whose VLM pre-annotation failed and need manual tagging."""
+    rows = conn.execute(
+        "SELECT uuid, vlm_error FROM photos WHERE vlm_error IS NOT NULL LIMIT ?", (limit,)
+    ).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+def _keyword_ids(conn, names):
+    names = [n.strip() for n in names if n and n.strip()]
+    if not names:
+        return {}
+    placeholders = ",".join("?" * len(names))
+    rows = conn.execute(f"SELECT name, id FROM keywords WHERE name IN ({placeholders})", names).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def _posting_size(conn, keyword_ids):
+    placeholders = ",".join("?" * len(keyword_ids))
+    return conn.execute(
+        f"SELECT ifnull(SUM(photo_count), 0) FROM keyword_counts WHERE keyword_id IN ({placeholders})", keyword_ids
+    ).fetchone()[0]
+
+
+def find_by_tags(conn, all_tags=(), any_tags=(), campus=None, season=None, category=None, limit=100):
+    """Find photos by keyword combination plus attribute filters.
+
+    A photo matches if it has every tag in `all_tags` and at least one tag in
+    `any_tags` (each list is ignored when empty). Uses the photo_keywords
+    inverted index, so no JSON is parsed at query time.
+    """
+    all_tags = [t.strip() for t in all_tags if t and t.strip()]
+    any_tags = [t.strip() for t in any_tags if t and t.strip()]
+    ids = _keyword_ids(conn, all_tags + any_tags)
+
+    if any(t not in ids for t in all_tags):
+        return []
+    all_ids = [ids[t] for t in all_tags]
+    any_ids = [ids[t] for t in any_tags if t in ids]
+    if any_tags and not any_ids:
+        return []
+
+    columns = ", ".join("p." + c for c in PHOTO_COLUMNS)
+    where = []
+    params = []
+
+    # Drive the query from the smallest posting list and probe the others
+    # with EXISTS, so rows stream out in index order and LIMIT stops early.
+    # CROSS JOIN pins that join order for the planner.
+    groups = [[keyword_id] for keyword_id in all_ids]
+    if any_ids:
+        groups.append(any_ids)
+    groups.sort(key=lambda group: _posting_size(conn, group))
+
+    if groups:
+        driver = groups[0]
+        placeholders = ",".join("?" * len(driver))
+        sql = (f"SELECT {columns} FROM (SELECT DISTINCT photo_uuid FROM photo_keywords WHERE keyword_id IN ({placeholders})) t"
+               " CROSS JOIN photos p ON p.uuid = t.photo_uuid")
+        params.extend(driver)
+        for group in groups[1:]:
+            placeholders = ",".join("?" * len(group))
+            where.append(f"EXISTS (SELECT 1 FROM photo_keywords k WHERE k.keyword_id IN ({placeholders}) AND k.photo_uuid = p.uuid)")
+            params.extend(group)
+    else:
+        sql = f"SELECT {columns} FROM photos p"
+
+    for column, value in (("campus", campus), ("season", season), ("category", category)):
+        if value:
+            where.append(f"p.{column} = ?")
+            params.append(value)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+
+    sql += " LIMIT ?"
+    params.append(limit)
+
+    return [row_to_dict(row) for row in conn.execute(sql, params)]
+
+
+# bm25 column weights: keywords, description, filename, annotator
+FTS_WEIGHTS = (10.0, 4.0, 2.0, 1.0)
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query over the bigram-indexed columns.
+
+    Every whitespace-separated term must match. Terms of two or more
+    characters become a phrase of their bigrams; single characters become a
+    prefix query, since they are only indexed as the head of a bigram.
+    """
+    terms = []
+    for term in text.split():
+        term = term.replace('"', '')
+        if not term:
+            continue
+        if len(term) == 1:
+            terms.append(f'"{term}"*')
+        else:
+            terms.append('"' + " ".join(term[i:i + 2] for i in range(len(term) - 1)) + '"')
+    return " AND ".join(terms)
+
+
+def search_text(conn, text, campus=None, season=None, category=None, limit=50):
+    """Ranked free-text search over keywords, VLM description, filename and annotator.
+
+    Returns photo dicts ordered by bm25 relevance, each with a `score`
+    (lower is better).
+    """
+    query = fts_query(text)
+    if not query:
+        return []
+
+    columns = ", ".join("p." + c for c in PHOTO_COLUMNS)
+    score = f"bm25(photos_fts, {', '.join(map(str, FTS_WEIGHTS))})"
+    filters = [(c, v) for c, v in (("campus", campus), ("season", season), ("category", category)) if v]
+
+    if not filters:
+        # Rank inside the FTS index first and only join the top hits
+        sql = (f"SELECT {columns}, f.score AS score"
+               f" FROM (SELECT rowid, {score} AS score FROM photos_fts"
+               "       WHERE photos_fts MATCH ? ORDER BY score LIMIT ?) f"
+               " CROSS JOIN photos_fts_docs d ON d.id = f.rowid"
+               " CROSS JOIN photos p ON p.uuid = d.uuid"
+               " ORDER BY f.score")
+        return [row_to_dict(row) for row in conn.execute(sql, (query, limit))]
+
+    sql = (f"SELECT {columns}, {score} AS score"
+           " FROM photos_fts f"
+           " CROSS JOIN photos_fts_docs d ON d.id = f.rowid"
+           " CROSS JOIN photos p ON p.uuid = d.uuid"
+           " WHERE photos_fts MATCH ?")
+    params = [query]
+    for column, value in filters:
+        sql += f" AND p.{column} = ?"
+        params.append(value)
+
+    sql += " ORDER BY score LIMIT ?"
+    params.append(limit)
+
+    return [row_to_dict(row) for row in conn.execute(sql, params)]
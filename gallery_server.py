@@ -0,0 +1,258 @@
+"""Local read-only HTTP API over buct_gallery.db for the web front end.
+
+    python gallery_server.py serve [--db buct_gallery.db] [--port 8765]
+    python gallery_server.py bench [--url http://127.0.0.1:8765] [--seconds 10]
+
+Endpoints (all GET, JSON responses):
+    /photos?campus=&season=&category=&cursor=&limit=   keyset-paginated listing
+    /facets?campus=&season=&category=                  counts per facet value
+    /tags?all=a,b&any=c,d&campus=&season=&category=    keyword search
+    /search?q=&campus=&season=&category=               full-text search
+    /keywords?limit=                                   keyword usage counts
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import gallery_db
+import gallery_query
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_LIMIT = 500
+
+
+def _param(params, name, default=None):
+    values = params.get(name)
+    return values[0] if values else default
+
+
+def _split(value):
+    return [v for v in (value or "").split(",") if v.strip()]
+
+
+def _limit(params, default):
+    return max(1, min(int(_param(params, "limit", default)), MAX_LIMIT))
+
+
+def _filters(params):
+    return {facet: _param(params, facet) for facet in gallery_query.FACETS}
+
+
+def handle_photos(conn, params):
+    photos, next_cursor = gallery_query.list_page(
+        conn, cursor=_param(params, "cursor"), limit=_limit(params, 50), **_filters(params)
+    )
+    return {"photos": photos, "next_cursor": next_cursor}
+
+
+def handle_facets(conn, params):
+    return gallery_query.facet_counts(conn, **_filters(params))
+
+
+def handle_tags(conn, params):
+    photos = gallery_query.find_by_tags(
+        conn, _split(_param(params, "all")), _split(_param(params, "any")),
+        limit=_limit(params, 100), **_filters(params)
+    )
+    return {"photos": photos}
+
+
+def handle_search(conn, params):
+    photos = gallery_query.search_text(
+        conn, _param(params, "q", ""), limit=_limit(params, 50), **_filters(params)
+    )
+    return {"photos": photos}
+
+
+def handle_keywords(conn, params):
+    counts = gallery_query.keyword_counts(conn, _limit(params, 100))
+    return {"keywords": [{"name": name, "count": count} for name, count in counts]}
+
+
+ROUTES = {
+    "/photos": handle_photos,
+    "/facets": handle_facets,
+    "/tags": handle_tags,
+    "/search": handle_search,
+    "/keywords": handle_keywords,
+}
+
+
+class GalleryRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so clients reuse one TCP connection for many requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this Nagle's
+    # algorithm holds the body back until the client ACKs the headers.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        handler = ROUTES.get(url.path)
+        if handler is None:
+            self.send_json(404, {"error": f"unknown endpoint {url.path}"})
+            return
+
+        try:
+            with self.server.pool.connection() as conn:
+                result = handler(conn, parse_qs(url.query))
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, result)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class GalleryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, db_path=gallery_db.DB_FILE, pool_size=8, verbose=False):
+        super().__init__(address, GalleryRequestHandler)
+        self.pool = gallery_query.ConnectionPool(db_path, pool_size)
+        self.verbose = verbose
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+
+
+def serve(db_path, host=DEFAULT_HOST, port=DEFAULT_PORT, pool_size=8, verbose=False):
+    server = GalleryServer((host, port), db_path, pool_size, verbose)
+    print(f"Serving {db_path} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _bench_paths(conn):
+    """A request mix of listing, paging, facet and tag queries built from real values."""
+    facets = gallery_query.facet_counts(conn)
+    tags = [row[0] for row in conn.execute("SELECT name FROM keywords LIMIT 50")]
+    paths = ["/photos", "/facets", "/keywords"]
+    for facet, counts in facets.items():
+        for value in counts:
+            if value:
+                paths.append("/photos?" + urlencode({facet: value}))
+                paths.append("/facets?" + urlencode({facet: value}))
+    _, cursor = gallery_query.list_page(conn, limit=1000)
+    if cursor:
+        paths.append("/photos?" + urlencode({"cursor": cursor}))
+    for tag in tags[:10]:
+        paths.append("/tags?" + urlencode({"all": tag, "limit": 20}))
+    return paths
+
+
+def bench(url, db_path, seconds=10, threads=8):
+    """Hammer a running server from `threads` keep-alive clients and report QPS/latency."""
+    conn = gallery_query.connect_readonly(db_path)
+    try:
+        paths = _bench_paths(conn)
+    finally:
+        conn.close()
+
+    target = urlsplit(url)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        http_conn = http.client.HTTPConnection(target.hostname, target.port or 80)
+        local = []
+        local_errors = 0
+        rng = random.Random()
+        while time.perf_counter() < deadline:
+            path = rng.choice(paths)
+            start = time.perf_counter()
+            try:
+                http_conn.request("GET", path)
+                response = http_conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                http_conn.close()
+                http_conn = http.client.HTTPConnection(target.hostname, target.port or 80)
+                continue
+            local.append(time.perf_counter() - start)
+        http_conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def pct(p):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": round(elapsed, 2),
+        "threads": threads,
+        "qps": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BUCT gallery query service")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_serve = sub.add_parser("serve", help="run the HTTP API")
+    p_serve.add_argument("--db", default=gallery_db.DB_FILE)
+    p_serve.add_argument("--host", default=DEFAULT_HOST)
+    p_serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    p_serve.add_argument("--pool-size", type=int, default=8)
+    p_serve.add_argument("--verbose", action="store_true", help="log every request")
+
+    p_bench = sub.add_parser("bench", help="load-test a running server")
+    p_bench.add_argument("--url", default=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}")
+    p_bench.add_argument("--db", default=gallery_db.DB_FILE, help="used to pick realistic query values")
+    p_bench.add_argument("--seconds", type=float, default=10)
+    p_bench.add_argument("--threads", type=int, default=8)
+
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        serve(args.db, args.host, args.port, args.pool_size, args.verbose)
+    else:
+        print(json.dumps(bench(args.url, args.db, args.seconds, args.threads), indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,17 @@
+import startup
 import sys
 import os
-import json
+import queue
+import threading
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                              QLabel, QPushButton, QRadioButton, QButtonGroup, 
                              QLineEdit, QGridLayout, QMessageBox, QFrame, QSizePolicy, QFileDialog, QMenuBar, QMenu)
-from PyQt6.QtCore import Qt, QSize, QEvent
+from PyQt6.QtCore import Qt, QSize, QEvent, QThread, pyqtSignal
 from PyQt6.QtGui import QPixmap, QImage, QShortcut, QKeySequence, QIcon, QAction
-from PIL import Image, ImageOps
 
 import config
+import profiling
+import record_io
 
 class FlowLayout(QGridLayout):
     """Simple helper to emulate flow layout using grid."""
@@ -76,12 +79,196 @@ class ScalableImageLabel(QLabel):
             )
             super().setPixmap(scaled)
 
+def find_image_path(item, json_path, image_root_override=None):
+    """Locate an item's image without asking the user, or return None."""
+    original_path = item.get("original_path", "")
+    if not original_path:
+        return None
+
+    # 1. Try exact absolute path
+    if os.path.exists(original_path):
+        return original_path
+
+    filename = item.get("filename") or os.path.basename(original_path)
+    json_dir = os.path.dirname(os.path.abspath(json_path))
+
+    # 2. Try override folder if set
+    if image_root_override:
+        candidate = os.path.join(image_root_override, filename)
+        if os.path.exists(candidate):
+            return candidate
+
+    # 3. Common relative paths
+    candidates = [
+        os.path.join(json_dir, filename), # Same dir
+        os.path.join(json_dir, "images", filename), # images/ subdir
+        os.path.join(json_dir, "..", "images", filename), # ../images sibling
+        os.path.join(json_dir, "..", filename), # Parent dir
+    ]
+
+    for c in candidates:
+        if os.path.exists(c):
+            return c
+    return None
+
+
+class SimilarityWorker(QThread):
+    """Owns the similarity index (similarity.py) off the GUI thread.
+
+    Loads the saved index, indexes annotated items of an opened task file
+    in the background, adds items as they are saved, and answers lookups
+    for the image on screen. Only the latest lookup is answered when the
+    annotator pages faster than images are read.
+    """
+    suggestions_ready = pyqtSignal(str, str, list) # uuid, campus ("" for none), keywords
+
+    SAVE_EVERY = 20
+
+    def __init__(self, index_path=config.SIMILARITY_INDEX_FILE):
+        super().__init__()
+        self.index_path = index_path
+        self.requests = queue.Queue()
+        self._lookup = None
+        self._lookup_lock = threading.Lock()
+        self._backlog = None
+
+    def lookup(self, uuid, image_path):
+        with self._lookup_lock:
+            self._lookup = (uuid, image_path)
+        self.requests.put(("lookup",))
+
+    def add(self, uuid, image_path, campus, keywords):
+        self.requests.put(("add", uuid, image_path, campus, list(keywords)))
+
+    def index_task_file(self, json_path, image_root_override=None):
+        """Index the already annotated items of a task file, in the background."""
+        self.requests.put(("backlog", json_path, image_root_override))
+
+    def stop(self):
+        self.requests.put(None)
+
+    def run(self):
+        import similarity
+        profiling.name_thread("SimilarityWorker")
+        try:
+            self.index = similarity.SimilarityIndex.load(self.index_path)
+        except Exception as e:
+            print(f"Similarity index not loaded ({e}), starting a new one.")
+            self.index = similarity.SimilarityIndex()
+        self.features = {}
+        self.unsaved = 0
+
+        while True:
+            self._answer_lookup(similarity)
+            try:
+                # Index the backlog while there is nothing else to do
+                request = self.requests.get(block=self._backlog is None)
+            except queue.Empty:
+                self._index_next(similarity)
+                continue
+            if request is None:
+                break
+            if request[0] == "add":
+                self._add(similarity, *request[1:])
+            elif request[0] == "backlog":
+                self._backlog = self._iter_backlog(*request[1:])
+
+        if self.index.dirty:
+            self.index.save(self.index_path)
+
+    def _answer_lookup(self, similarity):
+        with self._lookup_lock:
+            pending, self._lookup = self._lookup, None
+        if not pending:
+            return
+        uuid, image_path = pending
+        try:
+            with profiling.span("features", file=os.path.basename(image_path)):
+                features = self.features.get(uuid) or similarity.image_features(image_path)
+        except Exception as e:
+            print(f"Similarity lookup failed: {e}")
+            return
+        # Kept for the add() that follows when the item is saved
+        self.features = {uuid: features}
+        with profiling.span("similarity", rows=len(self.index)):
+            campus, keywords = self.index.suggest(features, exclude=uuid)
+        self.suggestions_ready.emit(uuid, campus or "", keywords)
+
+    def _add(self, similarity, uuid, image_path, campus, keywords):
+        if uuid in self.index and uuid not in self.features:
+            # Same image, new tags
+            self.index.update_tags(uuid, campus, keywords)
+        else:
+            try:
+                features = self.features.pop(uuid, None) or similarity.image_features(image_path)
+            except Exception as e:
+                print(f"Similarity indexing failed: {e}")
+                return
+            self.index.add(uuid, features, campus, keywords)
+        self.unsaved += 1
+        if self.unsaved >= self.SAVE_EVERY:
+            self.index.save(self.index_path)
+            self.unsaved = 0
+
+    def _iter_backlog(self, json_path, image_root_override):
+        import image_features
+        # Features stored by the preprocessing run spare decoding the images
+        store = None
+        store_path = image_features.default_store_path(json_path)
+        if os.path.exists(store_path):
+            try:
+                store = image_features.FeatureStore(store_path)
+            except Exception as e:
+                print(f"Stored features not used ({e}).")
+        try:
+            for item in record_io.iter_items(json_path):
+                meta = item.get("tags", {}).get("meta", {})
+                # Only items a person has checked are trusted for suggestions
+                if not meta.get("annotator") or item.get("uuid") in self.index:
+                    continue
+                try:
+                    record = store.get(item["uuid"]) if store is not None else None
+                except ValueError:
+                    # Not a canonical UUID (e.g. a hand-made task file): decode the image instead
+                    print(f"No stored features for uuid {item['uuid']!r}.")
+                    record = None
+                if record is not None and record["width"]:
+                    yield item, None, record
+                    continue
+                image_path = find_image_path(item, json_path, image_root_override)
+                if image_path:
+                    yield item, image_path, None
+        finally:
+            if store is not None:
+                store.close()
+
+    def _index_next(self, similarity):
+        try:
+            item, image_path, record = next(self._backlog)
+        except StopIteration:
+            self._backlog = None
+            return
+        except Exception as e:
+            print(f"Similarity backlog stopped: {e}")
+            self._backlog = None
+            return
+        if record is not None:
+            self.features[item["uuid"]] = similarity.features_of(record)
+        attrs = item["tags"].get("attributes", {})
+        self._add(similarity, item["uuid"], image_path, attrs.get("campus"), item["tags"].get("keywords", []))
+
+
 class TaggerWindow(QMainWindow):
     def __init__(self, json_path=None):
         super().__init__()
         self.json_path = json_path
         self.data = []
+        self.data_format = "json"
         self.current_index = 0
+        self.current_uuid = None
+        self.current_image_path = None
+        # Started with the first task file, so it does not slow down startup
+        self.similarity = None
         self.dirty = False
         
         self.setWindowTitle(config.WINDOW_TITLE)
@@ -90,10 +277,15 @@ class TaggerWindow(QMainWindow):
         self.init_ui()
         
         if self.json_path:
-            self.load_data()
-            self.load_current_image()
+            # Show the window first, then read the task file
+            startup.after_first_paint(self, self.load_initial_data)
         else:
             self.image_label.setText("请通过菜单 '文件 -> 打开' 选择 JSON 文件")
+            startup.after_first_paint(self)
+
+    def load_initial_data(self):
+        self.load_data()
+        self.load_current_image()
 
     def init_ui(self):
         # Menu Bar
@@ -191,6 +383,13 @@ class TaggerWindow(QMainWindow):
         add_tag_layout.addWidget(add_btn)
         right_layout.addLayout(add_tag_layout)
 
+        # Suggestions from similar annotated images, filled in by SimilarityWorker
+        right_layout.addWidget(QLabel("<b>相似图片建议 (Suggestions):</b>"))
+        self.suggest_container = QWidget()
+        self.suggest_layout = QGridLayout(self.suggest_container)
+        self.suggest_layout.setSpacing(5)
+        right_layout.addWidget(self.suggest_container)
+
         # Navigation & Save
         right_layout.addStretch()
         
@@ -222,7 +421,7 @@ class TaggerWindow(QMainWindow):
         self.image_root_override = None
 
     def open_file_dialog(self):
-        f, _ = QFileDialog.getOpenFileName(self, "选择预标注 JSON 文件", "", "JSON Files (*.json)")
+        f, _ = QFileDialog.getOpenFileName(self, "选择预标注 JSON 文件", "", record_io.DIALOG_FILTER)
         if f:
             self.json_path = f
             self.current_index = 0
@@ -234,14 +433,34 @@ class TaggerWindow(QMainWindow):
         if not os.path.exists(self.json_path):
             QMessageBox.critical(self, "错误", f"找不到文件: {self.json_path}")
             return
-        
+
+        # Loaded on first use, so the window appears without waiting for them
+        import records
+        import task_store
+
+        if isinstance(self.data, task_store.STORES):
+            self.data.close()
+            self.data = records.RecordTable()
+
         try:
-            with open(self.json_path, 'r', encoding='utf-8') as f:
-                self.data = json.load(f)
+            self.data_format = record_io.detect_format(self.json_path)
+            # JSONL and task DBs are opened as stores: records are read when
+            # shown and saved one by one, so large task files open instantly.
+            # Otherwise records are kept in a compact RecordTable; self.data[i]
+            # returns a copy as a dict, which save_current writes back.
+            self.data = task_store.open_store(self.json_path, self.data_format)
+            if self.data is None:
+                self.data = records.load(self.json_path)
         except Exception as e:
             QMessageBox.critical(self, "错误", f"无法加载 JSON: {e}")
             return
 
+        if self.similarity is None:
+            self.similarity = SimilarityWorker()
+            self.similarity.suggestions_ready.connect(self.show_suggestions)
+            self.similarity.start()
+        self.similarity.index_task_file(self.json_path, self.image_root_override)
+
         if not self.data:
             QMessageBox.warning(self, "警告", "JSON 文件为空。")
             return
@@ -250,32 +469,12 @@ class TaggerWindow(QMainWindow):
         original_path = item.get("original_path", "")
         if not original_path:
             return None
-        
-        # 1. Try exact absolute path
-        if os.path.exists(original_path):
-            return original_path
-            
+
+        found = find_image_path(item, self.json_path, self.image_root_override)
+        if found:
+            return found
         filename = item.get("filename") or os.path.basename(original_path)
-        json_dir = os.path.dirname(os.path.abspath(self.json_path))
-        
-        # 2. Try override folder if set
-        if self.image_root_override:
-            candidate = os.path.join(self.image_root_override, filename)
-            if os.path.exists(candidate):
-                return candidate
-                
-        # 3. Common relative paths
-        candidates = [
-            os.path.join(json_dir, filename), # Same dir
-            os.path.join(json_dir, "images", filename), # images/ subdir
-            os.path.join(json_dir, "..", "images", filename), # ../images sibling
-            os.path.join(json_dir, "..", filename), # Parent dir
-        ]
-        
-        for c in candidates:
-            if os.path.exists(c):
-                return c
-                
+
         # 4. Ask user (only once per session)
         if not self.image_root_override:
             reply = QMessageBox.question(
@@ -301,11 +500,18 @@ class TaggerWindow(QMainWindow):
         if 0 <= self.current_index < len(self.data):
             item = self.data[self.current_index]
             
+            self.current_uuid = item["uuid"]
+            self.clear_suggestions()
+
             # Load Image
             img_path = self.resolve_image_path(item)
+            self.current_image_path = img_path
             if img_path:
-                pixmap = QPixmap(img_path)
-                self.image_label.setPixmap(pixmap)
+                with profiling.span("pixmap", file=os.path.basename(img_path)):
+                    pixmap = QPixmap(img_path)
+                    self.image_label.setPixmap(pixmap)
+                if self.similarity:
+                    self.similarity.lookup(item["uuid"], img_path)
             else:
                 self.image_label.setText(f"图片未找到 (Image Not Found):\n{item.get('original_path')}")
 
@@ -351,6 +557,46 @@ class TaggerWindow(QMainWindow):
 
             self.setWindowTitle(f"{config.WINDOW_TITLE} - [{self.current_index + 1}/{len(self.data)}]")
 
+    def clear_suggestions(self):
+        while self.suggest_layout.count():
+            child = self.suggest_layout.takeAt(0)
+            if child.widget():
+                child.widget().deleteLater()
+
+    def show_suggestions(self, uuid, campus, keywords):
+        # The annotator may have moved on while the lookup ran
+        if uuid != self.current_uuid:
+            return
+        self.clear_suggestions()
+
+        # Pre-fill the campus only if none is chosen yet
+        checked = self.campus_group.checkedButton()
+        if campus and (checked is None or checked.text() == "未知"):
+            for btn in self.campus_group.buttons():
+                if btn.text() == campus:
+                    btn.setChecked(True)
+                    self.statusBar().showMessage(f"校区已按相似图片预填: {campus}", 3000)
+                    break
+
+        col_count = 3
+        suggested = [kw for kw in keywords if kw not in self.current_keywords]
+        for i, tag in enumerate(suggested):
+            btn = QPushButton(f"+ {tag}")
+            btn.setStyleSheet("color: #1565C0;")
+            btn.clicked.connect(lambda checked=False, t=tag: self.accept_suggestion(t))
+            self.suggest_layout.addWidget(btn, i // col_count, i % col_count)
+
+    def accept_suggestion(self, tag):
+        if tag not in self.current_keywords:
+            self.current_keywords.append(tag)
+            self.render_tags()
+            self.update_preset_buttons_state()
+        # Remove the accepted button
+        for i in range(self.suggest_layout.count()):
+            widget = self.suggest_layout.itemAt(i).widget()
+            if widget and widget.text() == f"+ {tag}":
+                widget.hide()
+
     def render_tags(self):
         # Clear existing tags
         while self.tags_layout.count():
@@ -417,11 +663,18 @@ class TaggerWindow(QMainWindow):
         item["tags"]["meta"]["annotator"] = os.getenv("USERNAME", "User")
         item["tags"]["meta"]["last_modified"] = str(import_datetime_now())
 
-        self.generate_thumbnail(item)
-        self.save_json()
+        with profiling.span("thumbnail", file=item.get("filename")):
+            self.generate_thumbnail(item)
+        with profiling.span("checkpoint"):
+            self.data[self.current_index] = item
+            self.save_json()
+        if self.similarity and self.current_image_path:
+            self.similarity.add(item["uuid"], self.current_image_path,
+                                item["tags"]["attributes"].get("campus"), item["tags"]["keywords"])
         self.next_image()
 
     def generate_thumbnail(self, item):
+        from PIL import Image, ImageOps
         try:
             original_path = item["original_path"]
             if not os.path.exists(original_path):
@@ -445,13 +698,26 @@ class TaggerWindow(QMainWindow):
             print(f"Thumbnail generation failed: {e}")
 
     def save_json(self):
+        import task_store
         try:
-            with open(self.json_path, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            # A store already saved the record on assignment; other
+            # formats are saved back whole, in the format they were opened in
+            if not isinstance(self.data, task_store.STORES):
+                record_io.write_items(self.json_path, self.data, self.data_format)
             self.statusBar().showMessage("已保存!", 1000)
         except Exception as e:
             QMessageBox.critical(self, "错误", f"保存失败: {e}")
 
+    def closeEvent(self, event):
+        import task_store
+        if isinstance(self.data, task_store.STORES):
+            self.data.close()
+        if self.similarity:
+            # Saves the index
+            self.similarity.stop()
+            self.similarity.wait()
+        super().closeEvent(event)
+
     def next_image(self):
         if self.current_index < len(self.data) - 1:
             self.current_index += 1
@@ -469,7 +735,9 @@ def import_datetime_now():
     return datetime.now()
 
 if __name__ == "__main__":
+    startup.mark("imports")
     app = QApplication(sys.argv)
+    startup.mark("qapplication")
     
     # Optional CLI arg, but default behavior is open empty
     json_file = None
@@ -479,5 +747,8 @@ if __name__ == "__main__":
             json_file = None
 
     window = TaggerWindow(json_file)
+    startup.mark("window")
     window.show()
-    sys.exit(app.exec())
+    with profiling.profiled("tagger"):
+        exit_code = app.exec()
+    sys.exit(exit_code)
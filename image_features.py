@@ -0,0 +1,285 @@
+"""Per-image features for dedupe, similarity suggestions and quality checks.
+
+Images are decoded once, downscaled to a fixed WORK_SIZE square, and the
+features of a whole batch are computed together with NumPy:
+
+    dhash       64-bit difference hash of the 9x8 grayscale image
+    phash       64-bit perceptual hash (8x8 low frequencies of a 32x32 DCT vs their median)
+    hist        64-bin RGB histogram (4 levels per channel), square root of
+                the frequencies scaled to 0..255, so hist/255 . hist/255 is the
+                Bhattacharyya coefficient of two images
+    brightness  mean luma, 0..1
+    contrast    standard deviation of luma, 0..1
+    sharpness   variance of the Laplacian of the luma (0..255 scale); low means blurry
+    shadows     share of pixels with clipped blacks (luma <= CLIP_LOW)
+    highlights  share of pixels with blown highlights (luma >= CLIP_HIGH)
+
+Results are kept in a FeatureStore: a .npy file of fixed-size records
+(FEATURE_DTYPE, 124 bytes per image) keyed by UUID, which np.load reads
+directly and which can be appended to in place.
+
+The preprocessing run computes the features from the image it already
+decoded for the VLM (see ImagePreprocessor.prepare_image); existing task
+files are backfilled across a process pool:
+
+    python cli.py features pre_annotated.json [--store pre_annotated.features.npy] [--workers 4]
+"""
+import os
+import ast
+import uuid as uuid_lib
+
+import numpy as np
+
+import config
+
+WORK_SIZE = 256
+HIST_LEVELS = 4
+HIST_BINS = HIST_LEVELS ** 3
+# Luma at or beyond which a pixel counts as clipped
+CLIP_LOW = 8
+CLIP_HIGH = 247
+
+FEATURE_DTYPE = np.dtype([
+    ("uuid", "V16"),             # uuid.UUID(...).bytes; "S16" would drop trailing NULs
+    ("dhash", "<u8"),
+    ("phash", "<u8"),
+    ("hist", "u1", (HIST_BINS,)),
+    ("brightness", "<f4"),
+    ("contrast", "<f4"),
+    ("sharpness", "<f4"),
+    ("shadows", "<f4"),
+    ("highlights", "<f4"),
+    ("width", "<u4"),
+    ("height", "<u4"),
+])
+
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m.astype(np.float32)
+
+
+_DCT32 = _dct_matrix(32)
+# Column boundaries for averaging WORK_SIZE columns down to 9
+_DHASH_COLUMNS = np.linspace(0, WORK_SIZE, 10).astype(int)[:-1]
+
+
+def downscale(img):
+    """WORK_SIZE x WORK_SIZE x 3 uint8 array of an opened PIL image.
+
+    Calls draft() first, so a JPEG that is not decoded yet is decoded at a
+    reduced scale; an already decoded image is only resized.
+    """
+    from PIL import Image
+    img.draft('RGB', (WORK_SIZE * 2, WORK_SIZE * 2))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    small = img.resize((WORK_SIZE, WORK_SIZE), Image.Resampling.BILINEAR)
+    return np.asarray(small, dtype=np.uint8)
+
+
+def load_small(path):
+    """Decode `path` (at reduced scale where possible) and downscale it. Returns (array, (width, height))."""
+    from PIL import Image
+    # Not rotated by the EXIF orientation, like the image sent to the VLM
+    with Image.open(path) as img:
+        return downscale(img), img.size
+
+
+def _block_mean(a, factor):
+    """Average non-overlapping factor x factor blocks of a [N, H, W] array."""
+    n, h, w = a.shape
+    return a.reshape(n, h // factor, factor, w // factor, factor).mean(axis=(2, 4))
+
+
+def _pack_bits(bits):
+    """[N, 64] bool -> [N] uint64, first bit most significant."""
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def compute(images):
+    """Features of a batch of WORK_SIZE images ([N, S, S, 3] uint8).
+
+    Returns a FEATURE_DTYPE array with uuid, width and height left empty.
+    """
+    images = np.asarray(images, dtype=np.uint8)
+    n = len(images)
+    out = np.zeros(n, dtype=FEATURE_DTYPE)
+    if not n:
+        return out
+
+    gray = images.astype(np.float32) @ _LUMA                    # [N, S, S], 0..255
+
+    # dHash: 8 rows x 9 columns of block means, each compared with its right neighbour
+    rows = gray.reshape(n, 8, WORK_SIZE // 8, WORK_SIZE).mean(axis=2)
+    widths = np.diff(np.append(_DHASH_COLUMNS, WORK_SIZE)).astype(np.float32)
+    cols = np.add.reduceat(rows, _DHASH_COLUMNS, axis=2) / widths
+    out["dhash"] = _pack_bits((cols[:, :, 1:] > cols[:, :, :-1]).reshape(n, 64))
+
+    # pHash: 2D DCT of the 32x32 image, low 8x8 frequencies without DC vs their median
+    g32 = _block_mean(gray, WORK_SIZE // 32)
+    dct = _DCT32 @ g32 @ _DCT32.T
+    low = dct[:, :8, :8].reshape(n, 64)
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    out["phash"] = _pack_bits(low > median)
+
+    # Colour histogram
+    levels = (images // (256 // HIST_LEVELS)).astype(np.int32)
+    bins = (levels[..., 0] * HIST_LEVELS + levels[..., 1]) * HIST_LEVELS + levels[..., 2]
+    bins = bins.reshape(n, -1) + (np.arange(n, dtype=np.int32) * HIST_BINS)[:, None]
+    counts = np.bincount(bins.ravel(), minlength=n * HIST_BINS).reshape(n, HIST_BINS)
+    freq = counts / float(WORK_SIZE * WORK_SIZE)
+    out["hist"] = np.round(np.sqrt(freq) * 255).astype(np.uint8)
+
+    # Exposure and blur
+    out["brightness"] = gray.mean(axis=(1, 2)) / 255
+    out["contrast"] = gray.std(axis=(1, 2)) / 255
+    lap = (gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] + gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:]
+           - 4 * gray[:, 1:-1, 1:-1])
+    out["sharpness"] = lap.var(axis=(1, 2))
+    out["shadows"] = (gray <= CLIP_LOW).mean(axis=(1, 2))
+    out["highlights"] = (gray >= CLIP_HIGH).mean(axis=(1, 2))
+    return out
+
+
+def uuid_bytes(value):
+    return uuid_lib.UUID(value).bytes
+
+
+def extract_files(paths):
+    """Features of image files, one batch. Unreadable files get a zero record
+    (width 0). Runs in pool workers, so it takes and returns plain data."""
+    images = np.zeros((len(paths), WORK_SIZE, WORK_SIZE, 3), dtype=np.uint8)
+    sizes = []
+    for i, path in enumerate(paths):
+        try:
+            images[i], size = load_small(path)
+        except Exception:
+            size = (0, 0)
+        sizes.append(size)
+    out = compute(images)
+    out["width"] = [s[0] for s in sizes]
+    out["height"] = [s[1] for s in sizes]
+    return out
+
+
+def extract_items(items, workers=None, batch_size=32, progress_callback=None):
+    """Compute features for (uuid, image path) pairs across a process pool.
+
+    Yields FEATURE_DTYPE arrays, one per batch, in input order.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    items = list(items)
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    workers = workers or config.FEATURE_WORKERS or os.cpu_count() or 1
+    done = 0
+
+    def finish(batch, out):
+        out["uuid"] = [uuid_bytes(u) for u, _ in batch]
+        return out
+
+    if workers == 1:
+        results = (extract_files([p for _, p in batch]) for batch in batches)
+        for batch, out in zip(batches, results):
+            done += len(batch)
+            if progress_callback:
+                progress_callback(done, len(items))
+            yield finish(batch, out)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for batch, out in zip(batches, pool.map(extract_files, [[p for _, p in b] for b in batches])):
+            done += len(batch)
+            if progress_callback:
+                progress_callback(done, len(items))
+            yield finish(batch, out)
+
+
+class FeatureStore:
+    """Feature records in a .npy file, keyed by UUID, appended in place.
+
+    The .npy header is written with a fixed length, so adding records
+    only appends them and rewrites the count in the header. A record for
+    a UUID already in the store is overwritten in place.
+    """
+
+    HEADER_SIZE = 512
+    MAGIC = b"\x93NUMPY\x01\x00"
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}
+        self.count = 0
+        if os.path.exists(path):
+            self.f = open(path, 'r+b')
+            self.count = self._read_header()
+            uuids = np.fromfile(self.f, dtype=FEATURE_DTYPE, count=self.count)["uuid"] if self.count else []
+            self.rows = {bytes(u): i for i, u in enumerate(uuids)}
+        else:
+            self.f = open(path, 'w+b')
+            self._write_header()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, uuid):
+        return uuid_bytes(uuid) in self.rows
+
+    def close(self):
+        self.f.close()
+
+    def _read_header(self):
+        self.f.seek(0)
+        if self.f.read(len(self.MAGIC)) != self.MAGIC:
+            raise ValueError(f"{self.path} is not a feature store")
+        header_len = int.from_bytes(self.f.read(2), 'little')
+        header = ast.literal_eval(self.f.read(header_len).decode('latin1'))
+        if np.dtype(header["descr"]) != FEATURE_DTYPE or len(self.MAGIC) + 2 + header_len != self.HEADER_SIZE:
+            raise ValueError(f"{self.path} was written by another version; delete it to rebuild")
+        return header["shape"][0]
+
+    def _write_header(self):
+        header = repr({"descr": FEATURE_DTYPE.descr, "fortran_order": False, "shape": (self.count,)})
+        header_len = self.HEADER_SIZE - len(self.MAGIC) - 2
+        text = header.encode('latin1').ljust(header_len - 1) + b"\n"
+        self.f.seek(0)
+        self.f.write(self.MAGIC + header_len.to_bytes(2, 'little') + text)
+
+    def add(self, records):
+        """Store FEATURE_DTYPE records, replacing those with the same UUID."""
+        records = np.asarray(records, dtype=FEATURE_DTYPE)
+        for record in records:
+            key = bytes(record["uuid"])
+            row = self.rows.get(key)
+            if row is None:
+                row = self.count
+                self.rows[key] = row
+                self.count += 1
+            self.f.seek(self.HEADER_SIZE + row * FEATURE_DTYPE.itemsize)
+            self.f.write(record.tobytes())
+        self._write_header()
+        self.f.flush()
+
+    def get(self, uuid):
+        """The record of `uuid`, or None."""
+        row = self.rows.get(uuid_bytes(uuid))
+        if row is None:
+            return None
+        self.f.seek(self.HEADER_SIZE + row * FEATURE_DTYPE.itemsize)
+        return np.frombuffer(self.f.read(FEATURE_DTYPE.itemsize), dtype=FEATURE_DTYPE)[0]
+
+    def all(self):
+        """Every record, as one array."""
+        self.f.seek(self.HEADER_SIZE)
+        return np.fromfile(self.f, dtype=FEATURE_DTYPE, count=self.count)
+
+
+def default_store_path(task_path):
+    """pre_annotated.json -> pre_annotated.features.npy"""
+    return os.path.splitext(task_path)[0] + ".features.npy"
@@ -1,3 +1,4 @@
+import startup
 import sys
 import os
 import json
@@ -10,25 +11,32 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QH
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 
 import config
-from ingestion_logic import IngestionManager
+import record_io
+import profiling
 
 class IngestionWorker(QThread):
     log_signal = pyqtSignal(str)
     progress_signal = pyqtSignal(int, int)
     finished_signal = pyqtSignal()
 
-    def __init__(self, source_path, library_root, organize_by_season=True, is_folder_source=False):
+    def __init__(self, source_path, library_root, organize_by_season=True, is_folder_source=False, incremental=True, resume=True,
+                 library_layout=config.LIBRARY_LAYOUT):
         super().__init__()
+        from ingestion_logic import IngestionManager
         self.manager = IngestionManager(
             source_path, 
             library_root, 
             organize_by_season, 
             is_folder_source,
             log_callback=self.emit_log,
-            progress_callback=self.emit_progress
+            progress_callback=self.emit_progress,
+            incremental=incremental,
+            resume=resume,
+            library_layout=library_layout
         )
 
     def run(self):
+        profiling.name_thread("IngestionWorker")
         self.manager.run()
         self.finished_signal.emit()
 
@@ -120,7 +128,7 @@ class ImportWindow(QMainWindow):
         # Folder Mode
         hbox_src = QHBoxLayout()
         self.src_edit = QLineEdit()
-        self.src_edit.setPlaceholderText("选择包含 JSON/图片的文件夹 或 单个 JSON 文件...")
+        self.src_edit.setPlaceholderText("选择包含 JSON/图片的文件夹 或 单个 JSON/JSONL/BQR 文件...")
         self.src_btn = QPushButton("选择文件夹")
         self.src_btn.clicked.connect(self.select_src_folder)
         self.src_file_btn = QPushButton("选择文件")
@@ -151,6 +159,18 @@ class ImportWindow(QMainWindow):
         self.chk_season = QCheckBox("按季节自动归档 (Auto-organize by Season)")
         self.chk_season.setChecked(True)
         dst_layout.addWidget(self.chk_season)
+
+        self.chk_incremental = QCheckBox("增量入库，跳过未变化的文件和记录 (Incremental)")
+        self.chk_incremental.setChecked(True)
+        dst_layout.addWidget(self.chk_incremental)
+
+        self.chk_resume = QCheckBox("断点续传，继续上次中断的入库任务 (Resume)")
+        self.chk_resume.setChecked(True)
+        dst_layout.addWidget(self.chk_resume)
+
+        self.chk_content = QCheckBox("按内容去重存储，相同图片只保存一份 (Content-addressed)")
+        self.chk_content.setChecked(config.LIBRARY_LAYOUT == "content")
+        dst_layout.addWidget(self.chk_content)
         
         grp_dst.setLayout(dst_layout)
         layout.addWidget(grp_dst)
@@ -174,7 +194,7 @@ class ImportWindow(QMainWindow):
         if d: self.src_edit.setText(d)
 
     def select_src_file(self):
-        f, _ = QFileDialog.getOpenFileName(self, "选择源 JSON", "", "JSON (*.json)")
+        f, _ = QFileDialog.getOpenFileName(self, "选择源 JSON", "", record_io.DIALOG_FILTER)
         if f: self.src_edit.setText(f)
 
     def select_dst_folder(self):
@@ -198,7 +218,11 @@ class ImportWindow(QMainWindow):
         self.log_text.clear()
         self.pbar.setValue(0)
         
-        self.worker = IngestionWorker(src, dst, self.chk_season.isChecked(), is_folder)
+        self.worker = IngestionWorker(
+            src, dst, self.chk_season.isChecked(), is_folder,
+            self.chk_incremental.isChecked(), self.chk_resume.isChecked(),
+            "content" if self.chk_content.isChecked() else "season"
+        )
         self.worker.log_signal.connect(self.append_log)
         self.worker.progress_signal.connect(self.update_progress)
         self.worker.finished_signal.connect(self.on_finished)
@@ -215,10 +239,14 @@ class ImportWindow(QMainWindow):
 
     def on_finished(self):
         self.start_btn.setEnabled(True)
-        QMessageBox.information(self, "完成", "入库操作已完成！\n数据已写入 buct_gallery.db")
+        QMessageBox.information(self, "完成", f"入库操作已完成！\n数据已写入 {config.DB_FILE}")
 
 if __name__ == "__main__":
+    startup.mark("imports")
     app = QApplication(sys.argv)
+    startup.mark("qapplication")
     win = ImportWindow()
+    startup.mark("window")
+    startup.after_first_paint(win)
     win.show()
     sys.exit(app.exec())
@@ -1,92 +1,81 @@
-import sqlite3
-import json
 import sys
 import os
-from datetime import datetime
 
-DB_FILE = "buct_gallery.db"
-SCHEMA_FILE = "schema.sql"
+import config
+import gallery_db
+import record_io
 
-def init_db():
-    """Initialize the database with schema."""
+DB_FILE = gallery_db.DB_FILE
+SCHEMA_FILE = gallery_db.SCHEMA_FILE
+
+def init_db(db_path=None):
+    """Initialize the database with schema (also migrates existing databases)."""
     if not os.path.exists(SCHEMA_FILE):
         print(f"Error: {SCHEMA_FILE} not found.")
         return
+    db_path = db_path or DB_FILE
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    with open(SCHEMA_FILE, 'r', encoding='utf-8') as f:
-        sql_script = f.read()
-    
     try:
-        cursor.executescript(sql_script)
-        conn.commit()
-        print(f"Database initialized: {DB_FILE}")
+        gallery_db.init_db(db_path)
+        print(f"Database initialized: {db_path}")
     except Exception as e:
         print(f"Error initializing database: {e}")
-    finally:
-        conn.close()
 
-def import_json(json_path):
-    """Import validated JSON data into SQLite."""
+def import_json(json_path, batch_size=config.DB_BATCH_SIZE, db_path=None):
+    """Import validated JSON (array, JSONL, columnar .bqr or a .taskdb) data into SQLite.
+
+    Returns the number of items written (0 for an empty file), or None if
+    the import failed.
+    """
     if not os.path.exists(json_path):
         print(f"Error: {json_path} not found.")
-        return
+        return None
+    db_path = db_path or DB_FILE
 
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        # The upsert writes columns and keyword tables that older databases lack
+        gallery_db.init_db(db_path)
     except Exception as e:
-        print(f"Error loading JSON: {e}")
-        return
-
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+        print(f"Error initializing database: {e}")
+        return None
 
-    count = 0
-    for item in data:
+    conn = gallery_db.connect(db_path)
+    if record_io.detect_format(json_path) == "sqlite":
+        # Task databases share the photos schema: merge in one INSERT ... SELECT
         try:
-            # Extract fields
-            uuid_str = item.get("uuid")
-            filename = item.get("filename")
-            original_path = item.get("original_path")
-            processed_path = item.get("processed_path")
-            thumb_path = item.get("thumb_path")
-            width = item.get("width")
-            height = item.get("height")
-
-            tags = item.get("tags", {})
-            attrs = tags.get("attributes", {})
-            campus = attrs.get("campus")
-            season = attrs.get("season")
-            category = attrs.get("category")
+            count = gallery_db.merge_db(conn, json_path)
+            conn.execute("PRAGMA optimize")
+            print(f"Successfully merged {count} items from {json_path} into {db_path}")
+            return count
+        except Exception as e:
+            print(f"Error merging task DB: {e}")
+            return None
+        finally:
+            conn.close()
 
-            # JSON serialization for lists/dicts
-            keywords = json.dumps(tags.get("keywords", []), ensure_ascii=False)
-            meta = json.dumps(tags.get("meta", {}), ensure_ascii=False)
-            
-            # Timestamp
-            annotated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    writer = gallery_db.BulkWriter(conn, batch_size)
+    failed = False
 
-            # Upsert (Insert or Replace)
-            cursor.execute("""
-                INSERT OR REPLACE INTO photos (
-                    uuid, filename, original_path, processed_path, thumb_path, 
-                    width, height, campus, season, category, keywords, meta, annotated_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                uuid_str, filename, original_path, processed_path, thumb_path,
-                width, height, campus, season, category, keywords, meta, annotated_at
-            ))
-            
-            count += 1
-        except Exception as e:
-            print(f"Error inserting item {item.get('uuid')}: {e}")
+    # Items are streamed, so rows are written while the file is still being read
+    try:
+        for item in record_io.iter_items(json_path):
+            try:
+                # Upsert (Insert or Replace), flushed in batches
+                writer.add(gallery_db.item_to_row(item))
+            except Exception as e:
+                print(f"Error inserting item {item.get('uuid')}: {e}")
+    except Exception as e:
+        print(f"Error loading JSON: {e}")
+        failed = True
 
-    conn.commit()
+    writer.close()
+    conn.execute("PRAGMA optimize")
     conn.close()
-    print(f"Successfully imported {count} items into {DB_FILE}")
+    if failed:
+        print(f"Imported {writer.written} items into {db_path} before the error")
+        return None
+    print(f"Successfully imported {writer.written} items into {db_path}")
+    return writer.written
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -0,0 +1,132 @@
+import os
+from datetime import datetime
+
+import config
+import gallery_db
+
+ITEM_SQL = """
+    INSERT OR REPLACE INTO ingest_run_items (run_id, source_json, item_index, uuid, status, error)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Item statuses that need no work when a run is resumed
+FINISHED_STATUSES = ("done", "skipped")
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _write_failed(row):
+    run_id, source_json, item_index, uuid, status, error = row
+    if status != "done":
+        return row
+    return run_id, source_json, item_index, uuid, "error", "数据库写入失败 (database write failed)"
+
+
+class IngestJournal:
+    """Per-run progress journal that lets an interrupted ingestion resume.
+
+    Every item is recorded by (source JSON, index in file) once its photo row
+    is committed, and every fully processed source JSON once all its items
+    are. A run that was stopped or crashed is picked up again by the next run
+    with the same source and library, which then skips finished files without
+    reading them and finished items without copying or writing them.
+    """
+
+    def __init__(self, conn, photo_writer, batch_size=config.DB_BATCH_SIZE, log_callback=None):
+        self.conn = conn
+        # Statuses are only committed after the photo rows they vouch for,
+        # and "done" becomes "error" for a photo row that could not be written
+        self.item_writer = gallery_db.BulkWriter(
+            conn, batch_size, log_callback=log_callback, sql=ITEM_SQL, depends_on=photo_writer,
+            dependency_key=3, on_failed_dependency=_write_failed
+        )
+        self.run_id = None
+        self.resumed = False
+        self.done_files = set()
+
+    def start(self, source_path, library_root, organize_by_season, resume=True):
+        """Open a new run, or reopen the last unfinished one for the same target."""
+        source_path = os.path.abspath(source_path)
+        library_root = os.path.abspath(library_root)
+
+        row = None
+        if resume:
+            row = self.conn.execute("""
+                SELECT id FROM ingest_runs
+                WHERE source_path = ? AND library_root = ? AND organize_by_season = ?
+                  AND status != 'done'
+                ORDER BY id DESC LIMIT 1
+            """, (source_path, library_root, int(organize_by_season))).fetchone()
+
+        if row:
+            self.run_id = row[0]
+            self.resumed = True
+            self.conn.execute("UPDATE ingest_runs SET status = 'running' WHERE id = ?", (self.run_id,))
+            self.done_files = {
+                r[0] for r in self.conn.execute("SELECT path FROM ingest_run_files WHERE run_id = ?", (self.run_id,))
+            }
+        else:
+            cur = self.conn.execute("""
+                INSERT INTO ingest_runs (source_path, library_root, organize_by_season, status, started_at)
+                VALUES (?, ?, ?, 'running', ?)
+            """, (source_path, library_root, int(organize_by_season), _now()))
+            self.run_id = cur.lastrowid
+        self.conn.commit()
+        return self.run_id
+
+    def file_done(self, path):
+        return os.path.abspath(path) in self.done_files
+
+    def finished_items(self, path):
+        """{item_index: uuid} of items of `path` already finished in this run."""
+        rows = self.conn.execute(f"""
+            SELECT item_index, uuid FROM ingest_run_items
+            WHERE run_id = ? AND source_json = ? AND status IN ({",".join("?" * len(FINISHED_STATUSES))})
+        """, (self.run_id, os.path.abspath(path)) + FINISHED_STATUSES)
+        return {r[0]: r[1] for r in rows}
+
+    def record_item(self, item, status, error=None):
+        self.item_writer.add((
+            self.run_id,
+            os.path.abspath(item['_source_json']),
+            item['_source_index'],
+            item.get('uuid'),
+            status,
+            error
+        ))
+
+    def record_file(self, path, item_count):
+        self.item_writer.flush()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ingest_run_files (run_id, path, item_count) VALUES (?, ?, ?)",
+            (self.run_id, os.path.abspath(path), item_count)
+        )
+        self.conn.commit()
+        self.done_files.add(os.path.abspath(path))
+
+    def finish(self, status):
+        """Close the run as 'done', 'stopped' or 'failed'.
+
+        Item rows of a completed run are no longer needed and are dropped;
+        the per-status totals are kept on the run row.
+        """
+        self.item_writer.close()
+        counts = dict(self.conn.execute(
+            "SELECT status, COUNT(*) FROM ingest_run_items WHERE run_id = ? GROUP BY status", (self.run_id,)
+        ).fetchall())
+        self.conn.execute("""
+            UPDATE ingest_runs SET status = ?, finished_at = ?, items_done = ?, items_skipped = ?, items_failed = ?
+            WHERE id = ?
+        """, (
+            status, _now(),
+            counts.get("done", 0), counts.get("skipped", 0),
+            counts.get("missing", 0) + counts.get("error", 0),
+            self.run_id
+        ))
+        if status == "done":
+            self.conn.execute("DELETE FROM ingest_run_items WHERE run_id = ?", (self.run_id,))
+            self.conn.execute("DELETE FROM ingest_run_files WHERE run_id = ?", (self.run_id,))
+        self.conn.commit()
+        return counts
@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+
+import config
+import gallery_db
+
+ITEM_SQL = "INSERT OR REPLACE INTO ingest_items (uuid, digest, source_json) VALUES (?, ?, ?)"
+
+FILE_SQL = """
+    INSERT OR REPLACE INTO ingest_files (path, library_root, layout, size, mtime, sha256, item_count, ingested_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def item_digest(item):
+    """Stable digest of an item's content, ignoring internal '_' keys."""
+    content = {k: v for k, v in item.items() if not k.startswith('_')}
+    text = json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class IngestManifest:
+    """Records which source files and items were already ingested into the DB.
+
+    Files are compared by size and mtime first, then by SHA-256 when those
+    differ; items by a digest of their JSON content. A file only counts as
+    ingested into the library (root and layout) it was ingested into, and
+    only once all of its items made it there.
+    """
+
+    def __init__(self, conn, library_root, layout, batch_size=config.DB_BATCH_SIZE, log_callback=None,
+                 photo_writer=None):
+        self.conn = conn
+        self.library_root = os.path.abspath(library_root)
+        self.layout = layout
+        # A digest must never be committed ahead of its photo row, or a crash
+        # would leave the item skipped as unchanged but missing from photos;
+        # nor recorded at all for a photo row that failed to be written.
+        self.item_writer = gallery_db.BulkWriter(
+            conn, batch_size, log_callback=log_callback, sql=ITEM_SQL, depends_on=photo_writer,
+            on_failed_dependency=lambda row: None
+        )
+
+    def check_file(self, path):
+        """Return (changed, fingerprint) for a source JSON.
+
+        The fingerprint is a dict of size/mtime/sha256; sha256 is None for
+        files never seen before, so the caller can hash them while reading.
+        """
+        key = os.path.abspath(path)
+        st = os.stat(path)
+        fingerprint = {"size": st.st_size, "mtime": st.st_mtime, "sha256": None}
+
+        row = self.conn.execute(
+            "SELECT size, mtime, sha256 FROM ingest_files WHERE path = ? AND library_root = ? AND layout = ?",
+            (key, self.library_root, self.layout)
+        ).fetchone()
+        if not row:
+            return True, fingerprint
+
+        if row[0] == st.st_size and row[1] == st.st_mtime:
+            fingerprint["sha256"] = row[2]
+            return False, fingerprint
+
+        # Touched or copied but possibly identical: compare content
+        fingerprint["sha256"] = file_sha256(path)
+        if fingerprint["sha256"] == row[2]:
+            self.conn.execute(
+                "UPDATE ingest_files SET size = ?, mtime = ? WHERE path = ? AND library_root = ? AND layout = ?",
+                (st.st_size, st.st_mtime, key, self.library_root, self.layout)
+            )
+            self.conn.commit()
+            return False, fingerprint
+        return True, fingerprint
+
+    def record_file(self, path, fingerprint, item_count):
+        """Mark a source JSON as ingested; only call this once every item of it was."""
+        # Item digests must be durable before the file is marked as done
+        self.item_writer.flush()
+        self.conn.execute(FILE_SQL, (
+            os.path.abspath(path),
+            self.library_root,
+            self.layout,
+            fingerprint["size"],
+            fingerprint["mtime"],
+            fingerprint["sha256"],
+            item_count,
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ))
+        self.conn.commit()
+
+    def item_unchanged(self, item):
+        """Return (unchanged, digest) for an item."""
+        digest = item_digest(item)
+        row = self.conn.execute(
+            "SELECT digest FROM ingest_items WHERE uuid = ?", (item.get('uuid'),)
+        ).fetchone()
+        return bool(row) and row[0] == digest, digest
+
+    def record_item(self, item, digest):
+        self.item_writer.add((item['uuid'], digest, item.get('_source_json')))
+
+    def close(self):
+        self.item_writer.close()
@@ -1,18 +1,35 @@
 import os
-import json
 import shutil
-import sqlite3
-from datetime import datetime
+import hashlib
+
+import config
+import gallery_db
+import ingest_journal
+import ingest_manifest
+import library_store
+import record_io
+import profiling
 
 class IngestionManager:
-    def __init__(self, source_path, library_root, organize_by_season=True, is_folder_source=False, log_callback=None, progress_callback=None):
+    def __init__(self, source_path, library_root, organize_by_season=True, is_folder_source=False, log_callback=None, progress_callback=None,
+                 db_path=gallery_db.DB_FILE, batch_size=config.DB_BATCH_SIZE, incremental=True, resume=True,
+                 verify_copies=config.INGEST_VERIFY_COPIES, library_layout=config.LIBRARY_LAYOUT):
         self.source_path = source_path
         self.library_root = library_root
         self.organize_by_season = organize_by_season
         self.is_folder_source = is_folder_source
         self.log_callback = log_callback
         self.progress_callback = progress_callback
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.resume = resume
+        self.verify_copies = verify_copies
+        self.library_layout = library_layout
         self._is_running = True
+        # Outcome of run(): "done", "stopped" or "failed", and item counts per journal status
+        self.status = None
+        self.counts = {}
 
     def log(self, msg):
         if self.log_callback:
@@ -21,67 +38,61 @@ class IngestionManager:
             print(msg)
 
     def run(self):
+        with profiling.profiled("ingest"):
+            self._run()
+
+    def _run(self):
+        self._journal = None
         try:
             self.log(">>> 开始入库流程 (Starting Ingestion)...")
             
-            # 1. Gather all JSON data
-            all_items = []
-            
-            if self.is_folder_source:
-                self.log(f"扫描目录: {self.source_path}")
-                for root, dirs, files in os.walk(self.source_path):
-                    for file in files:
-                        if file.lower().endswith('.json'):
-                            full_path = os.path.join(root, file)
-                            try:
-                                with open(full_path, 'r', encoding='utf-8') as f:
-                                    data = json.load(f)
-                                    if isinstance(data, list):
-                                        for item in data:
-                                            item['_source_json'] = full_path
-                                        all_items.extend(data)
-                                        self.log(f"已读取: {file} ({len(data)} items)")
-                            except Exception as e:
-                                self.log(f"读取失败 {file}: {e}")
-            else:
-                self.log(f"读取文件: {self.source_path}")
-                try:
-                    with open(self.source_path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        if isinstance(data, list):
-                            for item in data:
-                                item['_source_json'] = self.source_path
-                            all_items = data
-                except Exception as e:
-                    self.log(f"读取失败: {e}")
-                    return
-
-            total_items = len(all_items)
-            self.log(f"总计发现 {total_items} 个待处理项。")
-            
-            if total_items == 0:
+            # 1. Find JSON sources. Items are streamed from them one at a time,
+            # so ingestion starts before large files are fully read.
+            with profiling.span("scan"):
+                json_files = self.find_json_files()
+            if not json_files:
                 self.log("没有数据需要处理。")
+                self.status = "done"
                 return
 
+            total_kb = max(1, sum(os.path.getsize(p) for p in json_files) // 1024)
+            self.log(f"总计发现 {len(json_files)} 个 JSON 文件 ({total_kb} KB)。")
+
             # 2. Init DB
             self.init_db()
             
-            conn = sqlite3.connect("buct_gallery.db")
-            cursor = conn.cursor()
+            conn = gallery_db.connect(self.db_path)
+            # Content-addressed layout: files are stored once per content
+            self._store = library_store.LibraryStore(
+                self.library_root, conn, self.batch_size, log_callback=self.log
+            ) if self.library_layout == "content" else None
+            self._writer = gallery_db.BulkWriter(
+                conn, self.batch_size, log_callback=self.log,
+                depends_on=self._store.link_writer if self._store else None
+            )
+            self._manifest = ingest_manifest.IngestManifest(
+                conn, self.library_root, self.layout_name(), self.batch_size,
+                log_callback=self.log, photo_writer=self._writer
+            ) if self.incremental else None
+            self._journal = ingest_journal.IngestJournal(conn, self._writer, self.batch_size, log_callback=self.log)
+            writer = self._writer
+            journal = self._journal
+
+            run_id = journal.start(self.source_path, self.library_root, self.organize_by_season, self.resume)
+            if journal.resumed:
+                self.log(f"继续未完成的入库任务 #{run_id} (Resuming run)，已完成 {len(journal.done_files)} 个文件。")
             
             # 3. Process each item
             processed_count = 0
+            self.skipped_files = 0
+            self.skipped_items = 0
+            self.resumed_files = 0
+            self.resumed_items = 0
             
-            for item in all_items:
+            for item in self.iter_source_items(json_files):
                 if not self._is_running: break
                 
                 try:
-                    # Find Source Image
-                    source_image_path = self.resolve_source_image(item)
-                    if not source_image_path:
-                        self.log(f"跳过 (找不到图片): {item.get('filename')}")
-                        continue
-                        
                     # Determine Destination
                     season = item.get("tags", {}).get("attributes", {}).get("season", "Unknown")
                     if not self.organize_by_season:
@@ -89,47 +100,173 @@ class IngestionManager:
                     
                     # Target folder: Library/Season/
                     target_dir = os.path.join(self.library_root, season)
-                    os.makedirs(target_dir, exist_ok=True)
                     
                     # Target filename
                     ext = os.path.splitext(item['filename'])[1]
                     new_filename = f"{item['uuid']}{ext}"
                     target_path = os.path.join(target_dir, new_filename)
-                    
-                    # Copy File
-                    if not os.path.exists(target_path):
-                        shutil.copy2(source_image_path, target_path)
-                    
-                    # Handle Thumbnail
-                    thumb_target_path = ""
-                    source_thumb = self.resolve_source_thumb(item)
-                    if source_thumb:
-                        thumb_dir = os.path.join(self.library_root, "thumbs", season)
-                        os.makedirs(thumb_dir, exist_ok=True)
-                        thumb_target_name = f"{item['uuid']}_thumb{ext}"
-                        thumb_target_path = os.path.join(thumb_dir, thumb_target_name)
-                        if not os.path.exists(thumb_target_path):
-                            shutil.copy2(source_thumb, thumb_target_path)
+
+                    # Skip items whose content is unchanged since the last run
+                    if self._manifest:
+                        unchanged, digest = self._manifest.item_unchanged(item)
+                        if unchanged and self._store:
+                            target_path = self._store.existing_path(item['uuid'])
+                        if unchanged and target_path and os.path.exists(target_path):
+                            self.skipped_items += 1
+                            journal.record_item(item, "skipped")
+                            continue
+
+                    # Find Source Image
+                    source_image_path = self.resolve_source_image(item)
+                    if not source_image_path:
+                        self.log(f"跳过 (找不到图片): {item.get('filename')}")
+                        journal.record_item(item, "missing")
+                        self._file_failures += 1
+                        continue
+
+                    # Copy File (redone if a previous copy is incomplete)
+                    with profiling.span("copy", file=item.get('filename')):
+                        if self._store:
+                            target_path = self._store.put(source_image_path, item['uuid'])
+                        else:
+                            os.makedirs(target_dir, exist_ok=True)
+                            self.copy_verified(source_image_path, target_path)
+
+                        # Handle Thumbnail
+                        thumb_target_path = ""
+                        source_thumb = self.resolve_source_thumb(item)
+                        if source_thumb and self._store:
+                            thumb_target_path = self._store.put(source_thumb, item['uuid'], "thumb")
+                        elif source_thumb:
+                            thumb_dir = os.path.join(self.library_root, "thumbs", season)
+                            os.makedirs(thumb_dir, exist_ok=True)
+                            thumb_target_name = f"{item['uuid']}_thumb{ext}"
+                            thumb_target_path = os.path.join(thumb_dir, thumb_target_name)
+                            self.copy_verified(source_thumb, thumb_target_path)
 
                     # Update DB
-                    self.upsert_db(cursor, item, target_path, thumb_target_path)
+                    with profiling.span("upsert"):
+                        self.upsert_db(writer, item, target_path, thumb_target_path)
+                    if self._manifest:
+                        self._manifest.record_item(item, digest)
+                    journal.record_item(item, "done")
                     
                     processed_count += 1
                     if self.progress_callback:
-                        self.progress_callback(processed_count, total_items)
+                        # Progress is measured in KB of JSON read, since the
+                        # item count is unknown until the stream ends.
+                        self.progress_callback(min(self._bytes_read // 1024, total_kb), total_kb)
                     
-                    if processed_count % 10 == 0:
-                        conn.commit()
-                        
                 except Exception as e:
                     self.log(f"处理错误 {item.get('filename')}: {e}")
+                    journal.record_item(item, "error", str(e))
+                    self._file_failures += 1
             
-            conn.commit()
+            writer.close()
+            if self._store:
+                self._store.close()
+            if self._manifest:
+                self._manifest.close()
+            self.status = "done" if self._is_running else "stopped"
+            self.counts = journal.finish(self.status)
+            if not self._is_running:
+                self.log(f"已停止，下次以相同源和目标入库时将从断点继续 (run #{run_id})。")
+            conn.execute("PRAGMA optimize")
             conn.close()
+            self.log(f"已处理 {processed_count} 项。")
+            if journal.resumed:
+                self.log(f"断点续传跳过: 已完成文件 {self.resumed_files} 个, 已完成记录 {self.resumed_items} 条。")
+            if self._store:
+                self.log(f"内容寻址存储: 新文件 {self._store.new_blobs} 个, 重复内容 {self._store.duplicate_blobs} 个 (未重复存储)。")
+            if self.incremental:
+                self.log(f"增量跳过: 未变化文件 {self.skipped_files} 个, 未变化记录 {self.skipped_items} 条。")
+            if writer.failed:
+                self.log(f"数据库写入失败 {writer.failed} 项。")
             self.log(">>> 入库完成 (Ingestion Complete) <<<")
             
         except Exception as e:
             self.log(f"致命错误: {e}")
+            self.status = "failed"
+            if self._journal and self._journal.run_id:
+                try:
+                    # Keeps everything committed so far resumable
+                    self._journal.finish("failed")
+                except Exception:
+                    pass
+
+    def find_json_files(self):
+        if not self.is_folder_source:
+            return [self.source_path]
+
+        self.log(f"扫描目录: {self.source_path}")
+        json_files = []
+        for root, dirs, files in os.walk(self.source_path):
+            for file in files:
+                if file.lower().endswith(record_io.ITEM_FILE_EXTENSIONS):
+                    json_files.append(os.path.join(root, file))
+        return json_files
+
+    def iter_source_items(self, json_files):
+        """Stream items from each JSON source, tagging them with their origin."""
+        self._bytes_read = 0
+        for path in json_files:
+            name = os.path.basename(path)
+            done_before = self._bytes_read
+
+            if self._journal.file_done(path):
+                self.resumed_files += 1
+                self._bytes_read = done_before + os.path.getsize(path)
+                continue
+            finished = self._journal.finished_items(path) if self._journal.resumed else {}
+
+            hasher = None
+            if self._manifest:
+                changed, fingerprint = self._manifest.check_file(path)
+                if not changed:
+                    self.skipped_files += 1
+                    self._bytes_read = done_before + fingerprint["size"]
+                    continue
+                if fingerprint["sha256"] is None:
+                    hasher = hashlib.sha256()
+
+            reader = record_io.ItemReader(path, hasher=hasher)
+            count = 0
+            # Items of this file that were missing or failed, counted by the consumer
+            self._file_failures = 0
+            failed_writes = self._writer.failed
+            try:
+                for index, item in enumerate(reader):
+                    self._bytes_read = done_before + reader.bytes_read
+                    if not isinstance(item, dict):
+                        continue
+                    count += 1
+                    if index in finished and finished[index] == item.get('uuid'):
+                        self.resumed_items += 1
+                        continue
+                    item['_source_json'] = path
+                    item['_source_index'] = index
+                    yield item
+                self.log(f"已读取: {name} ({count} items)")
+
+                # The consumer has handled every item of this file once we get
+                # here. It is only marked as ingested if all of them made it;
+                # otherwise the next run (or resumed run) reads it again and
+                # the item digests and journal skip what is already done.
+                if self._is_running:
+                    # Photo rows must be committed before their digests
+                    self._writer.flush()
+                    complete = not self._file_failures and self._writer.failed == failed_writes
+                    if self._manifest and complete:
+                        if hasher:
+                            fingerprint["sha256"] = hasher.hexdigest()
+                        self._manifest.record_file(path, fingerprint, count)
+                    if complete:
+                        self._journal.record_file(path, count)
+            except record_io.NotItemListError:
+                self.log(f"跳过 (非任务列表): {name}")
+            except Exception as e:
+                self.log(f"读取失败 {name}: {e}")
+            self._bytes_read = done_before + reader.size
 
     def resolve_source_image(self, item):
         path = item.get("original_path")
@@ -170,54 +307,44 @@ class IngestionManager:
                 return c
         return None
 
+    def copy_verified(self, src, dst):
+        """Copy src to dst unless dst already holds a complete copy.
+
+        The copy is written to a temporary name and only renamed into place
+        after it is verified, so a crash never leaves a truncated file under
+        the final name; files truncated by older versions fail verification
+        and are copied again.
+        """
+        if os.path.exists(dst) and self.copy_matches(src, dst):
+            return False
+
+        tmp_path = dst + ".part"
+        shutil.copy2(src, tmp_path)
+        if not self.copy_matches(src, tmp_path):
+            os.remove(tmp_path)
+            raise IOError(f"复制校验失败 (copy verification failed): {dst}")
+        os.replace(tmp_path, dst)
+        return True
+
+    def copy_matches(self, src, dst):
+        if os.path.getsize(src) != os.path.getsize(dst):
+            return False
+        if self.verify_copies == "sha256":
+            return ingest_manifest.file_sha256(src) == ingest_manifest.file_sha256(dst)
+        return True
+
+    def layout_name(self):
+        """How items are placed in the library: "content", "season" or "unsorted"."""
+        if self.library_layout == "content":
+            return "content"
+        return "season" if self.organize_by_season else "unsorted"
+
     def init_db(self):
-        conn = sqlite3.connect("buct_gallery.db")
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS photos (
-                uuid TEXT PRIMARY KEY,
-                filename TEXT NOT NULL,
-                original_path TEXT,
-                processed_path TEXT,
-                thumb_path TEXT,
-                width INTEGER,
-                height INTEGER,
-                campus TEXT,
-                season TEXT,
-                category TEXT,
-                keywords TEXT,
-                meta TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                annotated_at DATETIME
-            );
-        """)
-        conn.commit()
-        conn.close()
-
-    def upsert_db(self, cursor, item, processed_path, thumb_path):
-        tags = item.get("tags", {})
-        attrs = tags.get("attributes", {})
-        
-        cursor.execute("""
-            INSERT OR REPLACE INTO photos (
-                uuid, filename, original_path, processed_path, thumb_path, 
-                width, height, campus, season, category, keywords, meta, annotated_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            item['uuid'],
-            item['filename'],
-            item.get('original_path'),
-            processed_path,
-            thumb_path,
-            item.get('width'),
-            item.get('height'),
-            attrs.get('campus'),
-            attrs.get('season'),
-            attrs.get('category'),
-            json.dumps(tags.get('keywords', []), ensure_ascii=False),
-            json.dumps(tags.get('meta', {}), ensure_ascii=False),
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ))
+        gallery_db.init_db(self.db_path)
+
+    def upsert_db(self, writer, item, processed_path, thumb_path):
+        # Rows are buffered and written in batches by the BulkWriter
+        writer.add(gallery_db.item_to_row(item, processed_path, thumb_path))
 
     def stop(self):
         self._is_running = False
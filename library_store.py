@@ -0,0 +1,172 @@
+"""Content-addressed storage for library images.
+
+Files are stored once per content under blobs/<ab>/<cd>/<sha256><ext>, so
+the same photo annotated under several UUIDs takes the space of one copy.
+The extension is that of the first file stored with the content; the same
+bytes under another extension reuse that blob. The SHA-256 is computed
+while the file is copied, in the same read pass.
+
+    python library_store.py verify <library_root> [--db buct_gallery.db] [--full]
+"""
+import os
+import sys
+import uuid
+import shutil
+import posixpath
+import hashlib
+import argparse
+from datetime import datetime
+
+import config
+import gallery_db
+import ingest_manifest
+
+BLOB_DIR = "blobs"
+COPY_CHUNK_SIZE = 1024 * 1024
+
+BLOB_SQL = "INSERT OR IGNORE INTO blobs (sha256, path, size, created_at) VALUES (?, ?, ?, ?)"
+LINK_SQL = "INSERT OR REPLACE INTO photo_blobs (photo_uuid, role, sha256) VALUES (?, ?, ?)"
+
+
+def copy_with_hash(src, dst, chunk_size=COPY_CHUNK_SIZE):
+    """Copy src to dst, returning (sha256 hex digest, size) of what was written."""
+    h = hashlib.sha256()
+    size = 0
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            h.update(chunk)
+            fout.write(chunk)
+            size += len(chunk)
+    shutil.copystat(src, dst)
+    return h.hexdigest(), size
+
+
+def blob_relpath(digest, ext):
+    """Library-relative path of a blob, fanned out over two directory levels.
+
+    Always '/'-separated, so the DB reads the same from Windows and Linux.
+    """
+    return posixpath.join(BLOB_DIR, digest[:2], digest[2:4], digest + ext.lower())
+
+
+def blob_path(library_root, relpath):
+    """Native absolute path of a blob from its stored relative path."""
+    # Rows written by older versions on Windows use '\\'
+    return os.path.join(library_root, *relpath.replace('\\', '/').split('/'))
+
+
+class LibraryStore:
+    """Stores files by content under a library root and records them in the DB.
+
+    `blobs` holds one row per distinct file, `photo_blobs` maps each photo
+    (and its thumbnail) to a blob. Blob paths are stored relative to the
+    library root so the library can be moved.
+    """
+
+    def __init__(self, library_root, conn, batch_size=config.DB_BATCH_SIZE, log_callback=None):
+        self.library_root = library_root
+        self.conn = conn
+        self.blob_writer = gallery_db.BulkWriter(conn, batch_size, log_callback=log_callback, sql=BLOB_SQL)
+        # A photo must never point at a blob row that was not committed
+        self.link_writer = gallery_db.BulkWriter(
+            conn, batch_size, log_callback=log_callback, sql=LINK_SQL, depends_on=self.blob_writer
+        )
+        self.tmp_dir = os.path.join(library_root, BLOB_DIR, "tmp")
+        self.new_blobs = 0
+        self.duplicate_blobs = 0
+        # Blobs added in this run, whose rows may not be committed yet
+        self.added = {}
+
+    def put(self, src, photo_uuid, role="image"):
+        """Store src and link it to a photo. Returns the blob's absolute path."""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex + ".part")
+        try:
+            digest, size = copy_with_hash(src, tmp_path)
+            if size != os.path.getsize(src):
+                raise IOError(f"复制校验失败 (copy verification failed): {src}")
+
+            relpath = self.known_relpath(digest) or blob_relpath(digest, os.path.splitext(src)[1])
+            path = blob_path(self.library_root, relpath)
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                self.duplicate_blobs += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                self.new_blobs += 1
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if digest not in self.added:
+            self.added[digest] = relpath
+            self.blob_writer.add((digest, relpath, size, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.link_writer.add((photo_uuid, role, digest))
+        return path
+
+    def known_relpath(self, digest):
+        """Path of the blob already recorded for a content, or None."""
+        if digest in self.added:
+            return self.added[digest]
+        row = self.conn.execute("SELECT path FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def existing_path(self, photo_uuid, role="image"):
+        """Absolute path of the blob linked to a photo, or None."""
+        row = self.conn.execute("""
+            SELECT b.path FROM photo_blobs pb JOIN blobs b ON b.sha256 = pb.sha256
+            WHERE pb.photo_uuid = ? AND pb.role = ?
+        """, (photo_uuid, role)).fetchone()
+        return blob_path(self.library_root, row[0]) if row else None
+
+    def close(self):
+        self.link_writer.close()
+        self.blob_writer.close()
+
+
+def verify_blobs(conn, library_root, full=False):
+    """Yield (sha256, path, problem) for every blob that is missing or damaged.
+
+    The quick check compares sizes only; `full` re-hashes every blob and
+    compares it with the digest in its name, with no other state needed.
+    """
+    for digest, relpath, size in conn.execute("SELECT sha256, path, size FROM blobs"):
+        path = blob_path(library_root, relpath)
+        if not os.path.exists(path):
+            yield digest, path, "missing"
+        elif os.path.getsize(path) != size:
+            yield digest, path, "size mismatch"
+        elif full and ingest_manifest.file_sha256(path) != digest:
+            yield digest, path, "checksum mismatch"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Content-addressed library tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_verify = sub.add_parser("verify", help="check stored blobs against the database")
+    p_verify.add_argument("library_root")
+    p_verify.add_argument("--db", default=gallery_db.DB_FILE)
+    p_verify.add_argument("--full", action="store_true", help="re-hash every blob instead of comparing sizes")
+    args = parser.parse_args(argv)
+
+    conn = gallery_db.connect(args.db)
+    try:
+        blobs, total = conn.execute("SELECT COUNT(*), ifnull(SUM(size), 0) FROM blobs").fetchone()
+        links, linked = conn.execute("""
+            SELECT COUNT(*), ifnull(SUM(b.size), 0) FROM photo_blobs pb JOIN blobs b ON b.sha256 = pb.sha256
+        """).fetchone()
+        print(f"Blobs: {blobs} ({total / 1024 / 1024:.1f} MB) for {links} photo files "
+              f"({(linked - total) / 1024 / 1024:.1f} MB saved by de-duplication)")
+
+        problems = 0
+        for digest, path, problem in verify_blobs(conn, args.library_root, args.full):
+            problems += 1
+            print(f"{problem}: {path}")
+        print(f"Verified {blobs} blobs, {problems} problems.")
+    finally:
+        conn.close()
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,4 @@
 import os
-import json
 import uuid
 import glob
 import time
@@ -8,9 +7,16 @@ import sys
 import threading
 from datetime import datetime
 from PIL import Image, ExifTags
-import requests
 import base64
+import io
 import config
+import records
+import record_io
+import scheduling
+import image_features
+import quality_gate
+import vlm_client
+import profiling
 
 # Set API Key
 # dashscope.api_key = config.DASHSCOPE_API_KEY
@@ -19,9 +25,21 @@ class ImagePreprocessor:
     def __init__(self, input_dir, output_file="pre_annotated.json"):
         self.input_dir = input_dir
         self.output_file = output_file
-        self.data = []
-        self.processed_files = set()
+        # Compact storage: a million records stay within ~200 MB
+        self.data = records.RecordTable()
+        self.processed_files = records.DigestSet()
+        self.queue = None
+        self.features = None
+        self.check_quality = config.QUALITY_GATE
+        self.vlm = vlm_client.VLMClient()
         self.load_existing_data()
+        if config.EXTRACT_FEATURES:
+            # Features of every image, next to the output file (image_features.py)
+            features_file = image_features.default_store_path(output_file)
+            try:
+                self.features = image_features.FeatureStore(features_file)
+            except Exception as e:
+                print(f"Warning: Image features not stored ({e}).")
         
         # Handle Ctrl+C gracefully (only if in main thread)
         if threading.current_thread() is threading.main_thread():
@@ -40,35 +58,41 @@ class ImagePreprocessor:
         """Load existing JSON to support resuming."""
         if os.path.exists(self.output_file):
             try:
-                with open(self.output_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
-                    # Build a set of already processed filenames for quick lookup
-                    # Using absolute path is safer if filenames are duplicates in different folders (though structure here assumes flat or we use path)
-                    # Let's use the relative filename or original_path check
-                    for item in self.data:
-                        if "original_path" in item:
-                            self.processed_files.add(os.path.abspath(item["original_path"]))
+                # JSON is streamed straight into the compact table, a columnar
+                # file is read as is. Build a set of already processed paths
+                # for quick lookup (absolute, since names may repeat across folders)
+                self.data = records.load(self.output_file)
+                for path in self.data.original_paths():
+                    if path:
+                        self.processed_files.add(os.path.abspath(path))
                 print(f"Loaded {len(self.data)} existing records. Resuming...")
             except Exception as e:
                 print(f"Warning: Failed to load existing data ({e}). Starting fresh.")
+                self.data = records.RecordTable()
+                self.processed_files = records.DigestSet()
                 # Backup corrupt file just in case
                 if os.path.exists(self.output_file):
                     os.rename(self.output_file, self.output_file + f".bak.{int(time.time())}")
 
     def save_data(self):
-        """Save current data to JSON."""
+        """Save current data, in the format the output file name asks for.
+        Errors are printed; use write_data to have them raised."""
         try:
+            self.write_data()
+        except Exception as e:
+            print(f"CRITICAL ERROR: Failed to save data: {e}")
+
+    def write_data(self):
+        """Save current data like save_data, raising if it cannot be written."""
+        with profiling.span("checkpoint", items=len(self.data)):
             # Write to temp file first then rename to avoid corruption on crash during write
             temp_file = self.output_file + ".tmp"
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            record_io.write_items(temp_file, self.data, record_io.format_of(self.output_file))
             
             if os.path.exists(self.output_file):
                 os.remove(self.output_file)
             os.rename(temp_file, self.output_file)
             print(f"Progress saved to {self.output_file}")
-        except Exception as e:
-            print(f"CRITICAL ERROR: Failed to save data: {e}")
 
     def get_exif_date(self, img):
         """Extract date from EXIF data."""
@@ -89,131 +113,172 @@ class ImagePreprocessor:
             pass
         return None
 
-    def compress_image_for_api(self, image_path):
-        """Resize image for VLM API to save tokens."""
-        try:
-            img = Image.open(image_path)
-            # Calculate new size preserving aspect ratio
-            max_size = config.RESIZE_TARGET_SIZE
-            ratio = min(max_size / img.width, max_size / img.height)
-            
+    def encode_image_for_api(self, img):
+        """Resize an opened image for the VLM API to save tokens; base64 JPEG."""
+        # Calculate new size preserving aspect ratio
+        max_size = config.RESIZE_TARGET_SIZE
+        ratio = min(max_size / img.width, max_size / img.height)
+
+        with profiling.span("resize"):
             if ratio < 1:
                 new_size = (int(img.width * ratio), int(img.height * ratio))
                 img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
-            temp_path = f"temp_{uuid.uuid4().hex}.jpg"
-            img.save(temp_path, quality=85)
-            return temp_path
-        except Exception as e:
-            print(f"Error compressing image: {e}")
-            return image_path
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
 
-    def call_vlm(self, image_path):
-        """Call Local VLM to analyze the image."""
-        # Compress first
-        temp_path = self.compress_image_for_api(image_path)
-        
+        with profiling.span("encode"):
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=85)
+            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+    def prepare_image(self, file_path):
+        """Decode an image once for everything done locally.
+
+        Returns a dict: width, height, date_taken (or None), features (an
+        image_features record, or None if neither stored nor gated on),
+        quality_issues (see quality_gate.py; empty when the image passed or
+        was not checked), quality (the values checked) and base64_image (the
+        JPEG for the API; None for a rejected image, which is not sent).
+        """
+        info = {"features": None, "quality_issues": [], "quality": None, "base64_image": None}
+        with Image.open(file_path) as img:
+            with profiling.span("decode"):
+                info["width"], info["height"] = img.size
+                info["date_taken"] = self.get_exif_date(img)
+                img.load()
+            if self.features is not None or self.check_quality:
+                with profiling.span("features"):
+                    features = image_features.compute(image_features.downscale(img)[None])
+                    features["width"], features["height"] = img.size
+                    info["features"] = features
+                    if self.check_quality:
+                        info["quality_issues"], info["quality"] = quality_gate.check(features[0])
+            if not info["quality_issues"]:
+                info["base64_image"] = self.encode_image_for_api(img)
+        return info
+
+    def call_vlm(self, image_path, base64_image=None):
+        """Call Local VLM to analyze the image.
+
+        `base64_image` is the image already encoded by prepare_image; the
+        file is read and encoded here if it is not given.
+        """
         try:
-            with open(temp_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-            prompt = """请分析这张图片。
-1. 判断季节 (Spring/Summer/Autumn/Winter)。
-2. 判断场景类型 (Landscape/Portrait/Activity/Documentary)。
-3. 提取画面中的关键物体 (不超过5个) 使用中文标签。
-请以纯JSON格式返回，不要包含Markdown格式标记，格式如下:
-{
-    "season": "...",
-    "category": "...",
-    "objects": ["...", "..."]
-}"""
-
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "model": config.MODEL_NAME,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "temperature": 0.7,
-                "max_tokens": -1,
-                "stream": False
-            }
+            if base64_image is None:
+                with Image.open(image_path) as img:
+                    base64_image = self.encode_image_for_api(img)
 
-            response = requests.post(
-                f"{config.API_BASE_URL}/chat/completions",
-                headers=headers,
-                json=payload
-            )
-
-            # Clean up temp file
-            if temp_path != image_path and os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
-
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                return content
-            else:
-                print(f"API Error: {response.status_code} - {response.text}")
-                return None
+            with profiling.span("http", kb=len(base64_image) // 1024):
+                return self.vlm.complete(base64_image)
 
         except Exception as e:
             print(f"VLM Call Exception: {e}")
-            if temp_path != image_path and os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
             return None
 
     def parse_vlm_response(self, response_text):
-        """Parse the JSON response from VLM."""
-        if not response_text:
-            return {}
-        
-        try:
-            # Strip markdown code blocks if present
-            text = response_text.strip()
-            if text.startswith("```json"):
-                text = text[7:]
-            if text.startswith("```"):
-                text = text[3:]
-            if text.endswith("```"):
-                text = text[:-3]
-            
-            return json.loads(text)
-        except json.JSONDecodeError:
+        """Parse the JSON response from VLM (validated by vlm_client.parse_response)."""
+        with profiling.span("parse"):
+            data = vlm_client.parse_response(response_text)
+        if "raw_description" in data:
             print(f"Failed to parse JSON. Raw: {response_text[:50]}...")
-            return {"raw_description": response_text}
+        return data
+
+    def process_file(self, file_path, log_callback=None, check_pause=None):
+        """Annotate one image: size and EXIF date locally, tags from the VLM.
+
+        Returns the new item; VLM failures are recorded in meta["error"].
+        """
+        item = {
+            "uuid": str(uuid.uuid4()),
+            "filename": os.path.basename(file_path),
+            "original_path": os.path.abspath(file_path),
+            "processed_path": "", 
+            "thumb_path": "",
+            "width": 0,
+            "height": 0,
+            "tags": {
+                "attributes": {},
+                "keywords": [],
+                "meta": {}
+            }
+        }
+
+        # 1. Basic Image Info (Local), decoded once for the API image and features too
+        info = self.prepare_image(file_path)
+        item["width"], item["height"] = info["width"], info["height"]
+        if info["date_taken"]:
+            item["tags"]["meta"]["date_taken"] = info["date_taken"]
+        if info["features"] is not None and self.features is not None:
+            info["features"]["uuid"] = image_features.uuid_bytes(item["uuid"])
+            self.features.add(info["features"])
+
+        # Unusable shot: no VLM call, flagged for the end of the task packs
+        if info["quality_issues"]:
+            item["tags"]["meta"]["quality_issues"] = info["quality_issues"]
+            item["tags"]["meta"]["quality"] = info["quality"]
+            msg = f"  Skipped VLM for {os.path.basename(file_path)}: {', '.join(info['quality_issues'])}"
+            print(msg)
+            if log_callback: log_callback(msg)
+            return item
+
+        # 2. VLM Call (Remote)
+        # Add retry logic for network stability
+        retry_count = 0
+        max_retries = 3
+        vlm_raw = None
+
+        while retry_count < max_retries:
+            if check_pause: check_pause() # Check pause during retries too
+            vlm_raw = self.call_vlm(file_path, info["base64_image"])
+            if vlm_raw:
+                break
+            print(f"  Retrying VLM call ({retry_count + 1}/{max_retries})...")
+            profiling.instant("retry", file=os.path.basename(file_path))
+            retry_count += 1
+            time.sleep(config.VLM_RETRY_DELAY_SECONDS) # Wait before retry
+
+        if not vlm_raw:
+            msg = f"  Failed to get VLM response for {os.path.basename(file_path)}. Marking as manual needed."
+            print(msg)
+            if log_callback: log_callback(msg)
+            item["tags"]["meta"]["error"] = "VLM API Failed"
+        else:
+            vlm_data = self.parse_vlm_response(vlm_raw)
+            # Map VLM data
+            if "season" in vlm_data:
+                item["tags"]["attributes"]["season"] = vlm_data["season"]
+            if "category" in vlm_data:
+                item["tags"]["attributes"]["category"] = vlm_data["category"]
+            if "objects" in vlm_data:
+                item["tags"]["keywords"] = vlm_data["objects"]
+
+            if "raw_description" in vlm_data:
+                item["tags"]["meta"]["vlm_description"] = vlm_data["raw_description"]
+
+        return item
+
+    def process_folder(self, progress_callback=None, log_callback=None, preview_callback=None, result_callback=None, check_pause=None,
+                       queue=None):
+        """Annotate every image under input_dir not processed yet.
 
-    def process_folder(self, progress_callback=None, log_callback=None, preview_callback=None, result_callback=None, check_pause=None):
+        Files are taken from `queue` (a scheduling.WorkQueue, created with
+        config.PREPROCESS_ORDER if not given), whose order can be changed
+        while this runs.
+        """
+        with profiling.profiled("preprocess"):
+            self._process_folder(progress_callback, log_callback, preview_callback, result_callback, check_pause,
+                                 queue)
+
+    def _process_folder(self, progress_callback, log_callback, preview_callback, result_callback, check_pause,
+                        queue):
         files = []
         # Recursive search is better usually, but let's stick to flat or one level
         # Using os.walk to be more robust
-        for root, dirs, filenames in os.walk(self.input_dir):
-            for filename in filenames:
-                if os.path.splitext(filename)[1].lower() in config.IMAGE_EXTENSIONS:
-                    files.append(os.path.join(root, filename))
+        with profiling.span("scan"):
+            for root, dirs, filenames in os.walk(self.input_dir):
+                for filename in filenames:
+                    if os.path.splitext(filename)[1].lower() in config.IMAGE_EXTENSIONS:
+                        files.append(os.path.join(root, filename))
         
         total_files = len(files)
         msg = f"Found {total_files} images in '{self.input_dir}'."
@@ -228,12 +293,22 @@ class ImagePreprocessor:
             print(msg)
             if log_callback: log_callback(msg)
 
-        for i, file_path in enumerate(files_to_process):
+        if queue is None:
+            queue = scheduling.WorkQueue(config.PREPROCESS_ORDER)
+        queue.extend(files_to_process, root=self.input_dir)
+        self.queue = queue
+
+        i = 0
+        while True:
             # Check pause before starting new item
             if check_pause:
                 check_pause()
 
-            current_idx = skipped_count + i + 1
+            file_path = queue.pop()
+            if file_path is None:
+                break
+            i += 1
+            current_idx = skipped_count + i
             msg = f"Processing [{current_idx}/{total_files}]: {os.path.basename(file_path)}"
             print(msg)
             if log_callback: log_callback(msg)
@@ -241,61 +316,9 @@ class ImagePreprocessor:
             if preview_callback: preview_callback(file_path)
             
             try:
-                item = {
-                    "uuid": str(uuid.uuid4()),
-                    "filename": os.path.basename(file_path),
-                    "original_path": os.path.abspath(file_path),
-                    "processed_path": "", 
-                    "thumb_path": "",
-                    "width": 0,
-                    "height": 0,
-                    "tags": {
-                        "attributes": {},
-                        "keywords": [],
-                        "meta": {}
-                    }
-                }
-
-                # 1. Basic Image Info (Local)
-                with Image.open(file_path) as img:
-                    item["width"], item["height"] = img.size
-                    date_taken = self.get_exif_date(img)
-                    if date_taken:
-                        item["tags"]["meta"]["date_taken"] = date_taken
-
-                # 2. VLM Call (Remote)
-                # Add retry logic for network stability
-                retry_count = 0
-                max_retries = 3
-                vlm_raw = None
-                
-                while retry_count < max_retries:
-                    if check_pause: check_pause() # Check pause during retries too
-                    vlm_raw = self.call_vlm(file_path)
-                    if vlm_raw:
-                        break
-                    print(f"  Retrying VLM call ({retry_count + 1}/{max_retries})...")
-                    retry_count += 1
-                    time.sleep(2) # Wait before retry
-                
-                if not vlm_raw:
-                    msg = f"  Failed to get VLM response for {os.path.basename(file_path)}. Marking as manual needed."
-                    print(msg)
-                    if log_callback: log_callback(msg)
-                    item["tags"]["meta"]["error"] = "VLM API Failed"
-                else:
-                    vlm_data = self.parse_vlm_response(vlm_raw)
-                    # Map VLM data
-                    if "season" in vlm_data:
-                        item["tags"]["attributes"]["season"] = vlm_data["season"]
-                    if "category" in vlm_data:
-                        item["tags"]["attributes"]["category"] = vlm_data["category"]
-                    if "objects" in vlm_data:
-                        item["tags"]["keywords"] = vlm_data["objects"]
-                    
-                    if "raw_description" in vlm_data:
-                        item["tags"]["meta"]["vlm_description"] = vlm_data["raw_description"]
-                
+                with profiling.span("image", file=os.path.relpath(file_path, self.input_dir)):
+                    item = self.process_file(file_path, log_callback, check_pause)
+
                 if result_callback: result_callback(item)
 
                 self.data.append(item)
@@ -306,7 +329,7 @@ class ImagePreprocessor:
                 self.save_data()
                 
                 # Rate limit
-                time.sleep(1)
+                time.sleep(config.VLM_RATE_LIMIT_SECONDS)
 
             except Exception as e:
                 msg = f"ERROR processing {file_path}: {e}"
@@ -318,6 +341,27 @@ class ImagePreprocessor:
         msg = "All processing complete."
         print(msg)
         if log_callback: log_callback(msg)
+        if self.vlm.stream:
+            stats = self.vlm.stream_stats
+            msg = (f"VLM streams: {stats['complete']} closed at a complete answer, "
+                   f"{stats['token_budget']} at the token budget, {stats['time_budget']} at the time budget.")
+            print(msg)
+            if log_callback: log_callback(msg)
+        if self.check_quality:
+            self.write_quality_report(log_callback)
+
+    def write_quality_report(self, log_callback=None):
+        """Write the images the quality gate rejected (all of the output file) to a CSV report."""
+        path = quality_gate.report_path(self.output_file)
+        try:
+            rejected, counts = quality_gate.write_report(self.data, path)
+        except Exception as e:
+            msg = f"Failed to write quality report: {e}"
+        else:
+            details = ", ".join(f"{issue} {n}" for issue, n in counts.items() if n)
+            msg = f"Quality gate: {rejected} of {len(self.data)} images rejected ({details or 'none'}). Report: {path}"
+        print(msg)
+        if log_callback: log_callback(msg)
 
 if __name__ == "__main__":
     input_folder = sys.argv[1] if len(sys.argv) > 1 else "."
@@ -325,5 +369,7 @@ if __name__ == "__main__":
         print(f"Error: Directory '{input_folder}' not found.")
         sys.exit(1)
         
-    processor = ImagePreprocessor(input_folder)
+    # Output format follows the extension: .json, .jsonl or columnar .bqr
+    output_file = sys.argv[2] if len(sys.argv) > 2 else "pre_annotated.json"
+    processor = ImagePreprocessor(input_folder, output_file)
     processor.process_folder()
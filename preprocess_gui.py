@@ -1,18 +1,18 @@
+import startup
 import sys
 import os
-import json
-import math
 import time
-import shutil
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                              QLabel, QPushButton, QProgressBar, QTextEdit, QFileDialog, 
                              QMessageBox, QGroupBox, QSpinBox, QTabWidget, QLineEdit, 
-                             QGridLayout, QSizePolicy, QScrollArea, QCheckBox, QProgressDialog)
+                             QGridLayout, QSizePolicy, QScrollArea, QCheckBox, QProgressDialog, QComboBox)
 from PyQt6.QtCore import Qt, QThread, pyqtSignal, QWaitCondition, QMutex
 from PyQt6.QtGui import QPixmap
 
-# Import existing logic
-from pre_process import ImagePreprocessor
+import config
+import record_io
+import scheduling
+import profiling
 
 # Import shared widget if possible, or redefine
 class ScalableImageLabel(QLabel):
@@ -49,10 +49,12 @@ class WorkerThread(QThread):
     result_signal = pyqtSignal(dict) # item dict
     finished_signal = pyqtSignal()
 
-    def __init__(self, input_dir, output_file):
+    def __init__(self, input_dir, output_file, policy=config.PREPROCESS_ORDER, folders=()):
         super().__init__()
         self.input_dir = input_dir
         self.output_file = output_file
+        # Shared with the processing loop; set_policy re-orders the remaining files
+        self.queue = scheduling.WorkQueue(policy, folders)
         self.processor = None
         self._is_running = True
         self._is_paused = False
@@ -60,6 +62,9 @@ class WorkerThread(QThread):
         self._pause_condition = QWaitCondition()
 
     def run(self):
+        profiling.name_thread("WorkerThread")
+        # Imported here: requests and Pillow are only needed once processing starts
+        from pre_process import ImagePreprocessor
         self.processor = ImagePreprocessor(self.input_dir, self.output_file)
         try:
             self.processor.process_folder(
@@ -67,7 +72,8 @@ class WorkerThread(QThread):
                 log_callback=self.emit_log,
                 preview_callback=self.emit_preview,
                 result_callback=self.emit_result,
-                check_pause=self.check_pause
+                check_pause=self.check_pause,
+                queue=self.queue
             )
         except Exception as e:
             self.emit_log(f"严重错误: {e}")
@@ -100,6 +106,9 @@ class WorkerThread(QThread):
         # Wake up if paused so it can exit
         self.resume()
 
+    def set_policy(self, policy, folders=()):
+        self.queue.set_policy(policy, folders)
+
     def emit_progress(self, current, total):
         self.progress_signal.emit(current, total)
 
@@ -257,6 +266,7 @@ class PreprocessWindow(QMainWindow):
         self.input_dir_btn.clicked.connect(self.select_input_dir)
         
         self.output_file_edit = QLineEdit("pre_annotated.json")
+        self.output_file_edit.setToolTip("扩展名决定格式: .json (缩进 JSON), .jsonl, .bqr (列式, 体积小、加载快), .taskdb (任务数据库)")
         
         input_layout.addWidget(QLabel("图片目录:"), 0, 0)
         input_layout.addWidget(self.input_dir_edit, 0, 1)
@@ -264,6 +274,21 @@ class PreprocessWindow(QMainWindow):
         
         input_layout.addWidget(QLabel("输出 JSON:"), 1, 0)
         input_layout.addWidget(self.output_file_edit, 1, 1)
+
+        # Processing order, can be changed while running
+        self.order_combo = QComboBox()
+        for name, label in scheduling.POLICIES.items():
+            self.order_combo.addItem(label, name)
+        self.order_combo.setCurrentIndex(max(0, self.order_combo.findData(config.PREPROCESS_ORDER)))
+        self.order_combo.currentIndexChanged.connect(self.change_order)
+        self.order_folders_edit = QLineEdit()
+        self.order_folders_edit.setPlaceholderText("优先的子文件夹, 逗号分隔 (如 2024校庆, 活动/毕业典礼)")
+        self.order_folders_edit.editingFinished.connect(self.change_order)
+
+        input_layout.addWidget(QLabel("处理顺序:"), 2, 0)
+        input_layout.addWidget(self.order_combo, 2, 1)
+        input_layout.addWidget(self.order_folders_edit, 3, 1)
+        self.update_order_widgets()
         
         grp_input.setLayout(input_layout)
         left_layout.addWidget(grp_input)
@@ -384,7 +409,7 @@ class PreprocessWindow(QMainWindow):
         1. 选择预处理生成的完整 JSON 文件 (如 <i>pre_annotated.json</i>)。<br>
         2. 设置每个子任务包含的图片数量。<br>
         3. 点击切分，系统会创建独立的任务文件夹。<br>
-        4. 每个文件夹包含：<b>需标注的图片文件</b> + <b>task_data.json</b>。<br>
+        4. 每个文件夹包含：<b>需标注的图片文件</b> + <b>task_data.json</b> (与源文件格式相同，如 .bqr)。<br>
         5. 可直接分发压缩包给标注人员。
         """)
         # Update to dark theme compatible styling
@@ -401,7 +426,7 @@ class PreprocessWindow(QMainWindow):
             self.input_dir_edit.setText(d)
 
     def select_split_json(self):
-        f, _ = QFileDialog.getOpenFileName(self, "选择 JSON", "", "JSON Files (*.json)")
+        f, _ = QFileDialog.getOpenFileName(self, "选择 JSON", "", record_io.DIALOG_FILTER)
         if f:
             self.split_input_edit.setText(f)
 
@@ -423,7 +448,8 @@ class PreprocessWindow(QMainWindow):
         self.pause_btn.setText("暂停 (Pause)")
         self.pause_btn.setStyleSheet("background-color: #FFC107; color: black; font-weight: bold;")
 
-        self.worker = WorkerThread(input_dir, output_file)
+        policy, folders = self.current_order()
+        self.worker = WorkerThread(input_dir, output_file, policy, folders)
         self.worker.progress_signal.connect(self.update_progress)
         self.worker.log_signal.connect(self.append_log)
         self.worker.preview_signal.connect(self.update_preview)
@@ -431,6 +457,21 @@ class PreprocessWindow(QMainWindow):
         self.worker.finished_signal.connect(self.processing_finished)
         self.worker.start()
 
+    def current_order(self):
+        folders = [f.strip() for f in self.order_folders_edit.text().replace("，", ",").split(",") if f.strip()]
+        return self.order_combo.currentData(), folders
+
+    def update_order_widgets(self):
+        self.order_folders_edit.setVisible(self.order_combo.currentData() == "folders")
+
+    def change_order(self):
+        self.update_order_widgets()
+        # Applied before the next image; processed images and the current one are unaffected
+        if self.worker and self.worker.isRunning():
+            policy, folders = self.current_order()
+            self.worker.set_policy(policy, folders)
+            self.append_log(f"处理顺序已切换为: {self.order_combo.currentText()}")
+
     def toggle_pause(self):
         if not self.worker: return
         
@@ -513,97 +554,40 @@ class PreprocessWindow(QMainWindow):
         if not os.path.exists(json_path):
             QMessageBox.warning(self, "错误", "找不到 JSON 文件。")
             return
-            
-        try:
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            total = len(data)
-            if total == 0:
-                 QMessageBox.warning(self, "警告", "JSON 文件为空。")
-                 return
 
-            chunks = math.ceil(total / per_file)
-            
-            base_dir = os.path.dirname(json_path)
-            json_filename = os.path.basename(json_path)
-            base_name_no_ext = os.path.splitext(json_filename)[0]
-            
-            output_root = os.path.join(base_dir, f"{base_name_no_ext}_dist")
-            os.makedirs(output_root, exist_ok=True)
-            
-            # Progress Dialog
-            progress = QProgressDialog("正在处理任务包...", "取消", 0, total, self)
-            progress.setWindowModality(Qt.WindowModality.WindowModal)
-            progress.setMinimumDuration(0)
-            
-            processed_count = 0
-            
-            for i in range(chunks):
-                if progress.wasCanceled():
-                    break
-                    
-                chunk_data = data[i*per_file : (i+1)*per_file]
-                
-                # Create task folder
-                task_folder_name = f"{base_name_no_ext}_task_{i+1:03d}"
-                task_folder_path = os.path.join(output_root, task_folder_name)
-                
-                # Clean recreate if exists
-                if os.path.exists(task_folder_path):
-                    shutil.rmtree(task_folder_path)
-                os.makedirs(task_folder_path, exist_ok=True)
-                
-                new_chunk_data = []
-                
-                for item in chunk_data:
-                    if progress.wasCanceled():
-                        break
-                        
-                    src_path = item.get("original_path")
-                    # Try to resolve relative path if absolute doesn't exist
-                    if not src_path or not os.path.exists(src_path):
-                        # Try relative to json dir
-                        possible_path = os.path.join(base_dir, item.get("filename", ""))
-                        if os.path.exists(possible_path):
-                            src_path = possible_path
-                    
-                    if src_path and os.path.exists(src_path):
-                        filename = os.path.basename(src_path)
-                        dst_path = os.path.join(task_folder_path, filename)
-                        
-                        try:
-                            shutil.copy2(src_path, dst_path)
-                            
-                            # Update item path for the task
-                            new_item = item.copy()
-                            new_item["original_path"] = filename # Relative path
-                            new_chunk_data.append(new_item)
-                        except Exception as copy_err:
-                            print(f"Copy error: {copy_err}")
-                    else:
-                        print(f"Warning: Image not found {src_path}")
-                    
-                    processed_count += 1
-                    progress.setValue(processed_count)
-                
-                # Save JSON in the folder
-                task_json_path = os.path.join(task_folder_path, "task_data.json")
-                with open(task_json_path, 'w', encoding='utf-8') as f:
-                    json.dump(new_chunk_data, f, ensure_ascii=False, indent=2)
-                
-                # Zip if requested
-                if do_zip:
-                    shutil.make_archive(task_folder_path, 'zip', task_folder_path)
-
-            progress.setValue(total)
+        import task_split
+
+        # Total is only known once the file is read, so the dialog's range is
+        # set by the first progress callback
+        progress = QProgressDialog("正在处理任务包...", "取消", 0, 0, self)
+        progress.setWindowModality(Qt.WindowModality.WindowModal)
+        progress.setMinimumDuration(0)
+
+        def on_progress(done, total):
+            progress.setMaximum(total)
+            progress.setValue(done)
+
+        try:
+            chunks, output_root = task_split.split_task_file(
+                json_path, per_file, do_zip,
+                progress_callback=on_progress, is_cancelled=progress.wasCanceled
+            )
+            progress.close()
+            if chunks == 0:
+                QMessageBox.warning(self, "警告", "JSON 文件为空。")
+                return
             QMessageBox.information(self, "成功", f"已生成 {chunks} 个任务包。\n输出目录: {output_root}")
-            
+
         except Exception as e:
+            progress.close()
             QMessageBox.critical(self, "错误", f"切分失败: {e}")
 
 if __name__ == "__main__":
+    startup.mark("imports")
     app = QApplication(sys.argv)
+    startup.mark("qapplication")
     window = PreprocessWindow()
+    startup.mark("window")
+    startup.after_first_paint(window)
     window.show()
     sys.exit(app.exec())
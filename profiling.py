@@ -0,0 +1,166 @@
+"""Opt-in profiling: a Chrome trace of the pipeline's stages, and cProfile dumps.
+
+Nothing is recorded unless BQB_PROFILE is set:
+
+    BQB_PROFILE=trace.json python cli.py preprocess photos/     # spans -> trace.json
+    BQB_PROFILE=trace.json BQB_PROFILE_CPROFILE=1 ...            # plus trace.<run>.prof per run
+    BQB_PROFILE=trace-{pid}.json ...                             # one file per process (ledger workers)
+
+The trace is Chrome trace-event JSON; open it in https://ui.perfetto.dev or
+chrome://tracing. Every span (scan, decode, resize, encode, features,
+http, parse, checkpoint, copy, upsert, pixmap, ...) is a complete event on
+its process and thread, with the file it worked on in its args, so a slow
+run shows which stage and which files took the time. The file is written
+when the process exits (and by flush()).
+
+The .prof files cover the thread a run executes on (process_folder,
+IngestionManager.run, the tagger's GUI thread); read them with
+`python -m pstats trace.preprocess.prof` or snakeviz.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
+
+PATH = os.getenv("BQB_PROFILE", "")
+CPROFILE = os.getenv("BQB_PROFILE_CPROFILE", "") not in ("", "0")
+
+_events = []
+_lock = threading.Lock()
+_threads = {}
+_pid = os.getpid()
+
+
+def enabled():
+    return bool(PATH)
+
+
+def _now_us():
+    return time.perf_counter_ns() // 1000
+
+
+def name_thread(name):
+    """Name the current thread in the trace (Qt threads otherwise show as Dummy-N)."""
+    if PATH:
+        with _lock:
+            _threads[threading.get_ident()] = name
+
+
+def _thread_id():
+    thread = threading.current_thread()
+    tid = threading.get_ident()
+    if tid not in _threads:
+        with _lock:
+            _threads[tid] = thread.name
+    return tid
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = _now_us()
+        event = {"name": self.name, "cat": self.name.split(".")[0], "ph": "X", "ts": self.start,
+                 "dur": end - self.start, "pid": _pid, "tid": _thread_id()}
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        if self.args:
+            event["args"] = self.args
+        with _lock:
+            _events.append(event)
+        return False
+
+
+_NULL = contextlib.nullcontext()
+
+
+def span(name, **args):
+    """Context manager timing one stage: `with profiling.span("decode", file=name): ...`.
+
+    A shared no-op when profiling is off, so spans can stay in hot loops.
+    """
+    if not PATH:
+        return _NULL
+    return _Span(name, args)
+
+
+def instant(name, **args):
+    """Mark a moment (e.g. a retry) on the current thread."""
+    if not PATH:
+        return
+    event = {"name": name, "ph": "i", "s": "t", "ts": _now_us(), "pid": _pid, "tid": _thread_id()}
+    if args:
+        event["args"] = args
+    with _lock:
+        _events.append(event)
+
+
+def _trace_path():
+    return PATH.replace("{pid}", str(os.getpid()))
+
+
+@contextlib.contextmanager
+def profiled(run):
+    """Span `run` and, with BQB_PROFILE_CPROFILE, cProfile the current thread
+    while it lasts, dumped to <trace>.<run>.prof."""
+    if not PATH:
+        yield
+        return
+    profiler = None
+    if CPROFILE:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            profiler = None
+    try:
+        with span(run):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            path = f"{os.path.splitext(_trace_path())[0]}.{run}.prof"
+            profiler.dump_stats(path)
+            print(f"[profile] cProfile of {run} written to {path}", file=sys.stderr)
+        flush()
+
+
+def flush():
+    """Write all events recorded so far to the trace file."""
+    if not PATH:
+        return
+    with _lock:
+        events = list(_events)
+        threads = dict(_threads)
+    pid = os.getpid()
+    process = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+    meta = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{process} ({pid})"}}]
+    meta += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+             for tid, name in threads.items()]
+    path = _trace_path()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _at_exit():
+    if PATH and _events and os.getpid() == _pid:
+        flush()
+        print(f"[profile] {len(_events)} spans written to {_trace_path()}", file=sys.stderr)
+
+
+atexit.register(_at_exit)
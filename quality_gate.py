@@ -0,0 +1,81 @@
+"""Quality gate run before the VLM call: skips blurry, blank and badly exposed shots.
+
+Uses the image_features.py features of the image the preprocessor has
+already decoded, so it costs no extra decode. An image is rejected for:
+
+    blurry       sharpness (Laplacian variance) < QUALITY_MIN_SHARPNESS
+    blank        contrast (luma standard deviation) < QUALITY_MIN_CONTRAST
+    dark         brightness < QUALITY_MIN_BRIGHTNESS, or more than
+                 QUALITY_MAX_CLIPPED of the pixels are clipped blacks
+    overexposed  brightness > QUALITY_MAX_BRIGHTNESS, or more than
+                 QUALITY_MAX_CLIPPED of the pixels are blown highlights
+
+Rejected images get tags.meta["quality_issues"] (e.g. ["blurry", "dark"])
+and meta["quality"] (the measured values) instead of VLM tags, and are put
+at the end of the task packs by task_split.py. The gate is off unless
+QUALITY_GATE=1; each run writes a CSV report of the rejected images.
+"""
+import os
+import csv
+
+import config
+
+ISSUES = {
+    "blurry": "模糊 (Blurry)",
+    "blank": "空白/无内容 (Blank)",
+    "dark": "欠曝 (Too dark)",
+    "overexposed": "过曝 (Overexposed)",
+}
+
+
+def check(record):
+    """(issues, measured values) of an image_features.FEATURE_DTYPE record; no issues = passed."""
+    scores = {
+        "sharpness": round(float(record["sharpness"]), 1),
+        "contrast": round(float(record["contrast"]), 3),
+        "brightness": round(float(record["brightness"]), 3),
+        "shadows": round(float(record["shadows"]), 3),
+        "highlights": round(float(record["highlights"]), 3),
+    }
+    issues = []
+    if scores["contrast"] < config.QUALITY_MIN_CONTRAST:
+        # A blank frame has no edges either; "blurry" would only repeat it
+        issues.append("blank")
+    elif scores["sharpness"] < config.QUALITY_MIN_SHARPNESS:
+        issues.append("blurry")
+    if scores["brightness"] < config.QUALITY_MIN_BRIGHTNESS or scores["shadows"] > config.QUALITY_MAX_CLIPPED:
+        issues.append("dark")
+    if scores["brightness"] > config.QUALITY_MAX_BRIGHTNESS or scores["highlights"] > config.QUALITY_MAX_CLIPPED:
+        issues.append("overexposed")
+    return issues, scores
+
+
+def is_rejected(item):
+    return bool(item.get("tags", {}).get("meta", {}).get("quality_issues"))
+
+
+def report_path(output_file):
+    """pre_annotated.json -> pre_annotated.quality.csv"""
+    return os.path.splitext(output_file)[0] + ".quality.csv"
+
+
+def write_report(items, path):
+    """Write the rejected images among `items` to a CSV file. Returns (rejected, {issue: count})."""
+    rejected = 0
+    counts = {issue: 0 for issue in ISSUES}
+    columns = ("sharpness", "contrast", "brightness", "shadows", "highlights")
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(("filename", "original_path", "issues") + columns)
+        for item in items:
+            meta = item.get("tags", {}).get("meta", {})
+            issues = meta.get("quality_issues")
+            if not issues:
+                continue
+            rejected += 1
+            for issue in issues:
+                counts[issue] = counts.get(issue, 0) + 1
+            scores = meta.get("quality", {})
+            writer.writerow([item.get("filename", ""), item.get("original_path", ""), " ".join(issues)]
+                            + [scores.get(c, "") for c in columns])
+    return rejected, counts
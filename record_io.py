@@ -0,0 +1,267 @@
+"""Reading and writing item files in the formats the tools exchange.
+
+    json      indented JSON array (pre_annotated.json, task_data.json)
+    jsonl     one compact JSON item per line
+    columnar  records.RecordTable columns saved as they are (.bqr);
+              under half the size of the indented JSON, and loaded
+              with a few array copies instead of a JSON parse
+    sqlite    a task database with the photos schema (.taskdb),
+              edited row by row by the tagger (see task_store.py)
+
+Readers detect the format from the file itself, writers pick it from the
+file extension. Convert between formats with:
+
+    python record_io.py convert pre_annotated.json pre_annotated.bqr
+"""
+import os
+import sys
+import json
+import codecs
+
+CHUNK_SIZE = 1024 * 1024
+JSONL_EXTENSIONS = ('.jsonl',)
+COLUMNAR_EXTENSIONS = ('.bqr',)
+# Not .db, so a folder scan never mistakes buct_gallery.db for a task
+SQLITE_EXTENSIONS = ('.taskdb',)
+ITEM_FILE_EXTENSIONS = ('.json',) + JSONL_EXTENSIONS + COLUMNAR_EXTENSIONS + SQLITE_EXTENSIONS
+COLUMNAR_MAGIC = b"BQBREC\x00\x01"
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+FORMATS = ("json", "jsonl", "columnar", "sqlite")
+FORMAT_EXTENSIONS = {"json": ".json", "jsonl": ".jsonl", "columnar": ".bqr", "sqlite": ".taskdb"}
+# Name filter for Qt file dialogs
+DIALOG_FILTER = "任务数据 (*.json *.jsonl *.bqr *.taskdb)"
+
+
+class NotItemListError(ValueError):
+    """Raised when a .json file does not contain a top-level array."""
+
+
+def is_jsonl(path):
+    return path.lower().endswith(JSONL_EXTENSIONS)
+
+
+def format_of(path):
+    """Format a file name asks for: 'json', 'jsonl', 'columnar' or 'sqlite'."""
+    name = path.lower()
+    if name.endswith(COLUMNAR_EXTENSIONS):
+        return "columnar"
+    if name.endswith(SQLITE_EXTENSIONS):
+        return "sqlite"
+    if name.endswith(JSONL_EXTENSIONS):
+        return "jsonl"
+    return "json"
+
+
+def detect_format(path):
+    """Format of an existing file; binary formats are recognised by content."""
+    with open(path, 'rb') as f:
+        head = f.read(len(SQLITE_MAGIC))
+    if head.startswith(COLUMNAR_MAGIC):
+        return "columnar"
+    if head == SQLITE_MAGIC:
+        return "sqlite"
+    return "jsonl" if is_jsonl(path) else "json"
+
+
+class ItemReader:
+    """Iterates the items of a JSON array or JSONL file one at a time.
+
+    Only the current chunk (plus one partially read item) is held in memory,
+    so multi-GB merged exports can be streamed into the ingestion pipeline.
+    `bytes_read` can be used for progress reporting, and an optional hashlib
+    `hasher` is fed the raw bytes so a file can be fingerprinted in the same pass.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE, hasher=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.hasher = hasher
+        self.size = os.path.getsize(path)
+        self.bytes_read = 0
+
+    def __iter__(self):
+        fmt = detect_format(self.path)
+        if fmt == "columnar":
+            return self._iter_columnar()
+        if fmt == "sqlite":
+            return self._iter_sqlite()
+        if fmt == "jsonl":
+            return self._iter_jsonl()
+        return self._iter_array()
+
+    def _iter_columnar(self):
+        import records  # records builds on this module
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.bytes_read = len(data)
+        if self.hasher:
+            self.hasher.update(data)
+        return iter(records.RecordTable.from_columns(data))
+
+    def _iter_sqlite(self):
+        import task_store  # task_store builds on this module
+
+        if self.hasher:
+            with open(self.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    self.hasher.update(chunk)
+        for item in task_store.iter_task_db(self.path):
+            yield item
+        self.bytes_read = self.size
+
+    def _iter_jsonl(self):
+        with open(self.path, 'rb') as f:
+            for line_no, line in enumerate(f, 1):
+                self.bytes_read += len(line)
+                if self.hasher:
+                    self.hasher.update(line)
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"line {line_no}: {e}") from e
+
+    def _iter_array(self):
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8-sig')()
+
+        with open(self.path, 'rb') as f:
+            buf = ""
+            pos = 0
+            eof = False
+
+            def fill():
+                nonlocal buf, pos, eof
+                chunk = f.read(self.chunk_size)
+                self.bytes_read += len(chunk)
+                if self.hasher:
+                    self.hasher.update(chunk)
+                eof = not chunk
+                buf = buf[pos:] + utf8.decode(chunk, final=eof)
+                pos = 0
+
+            def skip_ws():
+                nonlocal pos
+                while True:
+                    while pos < len(buf) and buf[pos].isspace():
+                        pos += 1
+                    if pos < len(buf) or eof:
+                        return
+                    fill()
+
+            fill()
+            skip_ws()
+            if pos >= len(buf) or buf[pos] != '[':
+                raise NotItemListError("not a JSON array")
+            pos += 1
+
+            expect_value = True
+            while True:
+                skip_ws()
+                if pos >= len(buf):
+                    raise ValueError("unexpected end of file")
+
+                ch = buf[pos]
+                if ch == ']':
+                    return
+                if not expect_value:
+                    if ch != ',':
+                        raise ValueError(f"expected ',' at offset {pos}")
+                    pos += 1
+                    expect_value = True
+                    continue
+
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # A value that runs to the end of the buffer may be cut
+                    # off (e.g. a number), so re-read it with more data.
+                    if end == len(buf) and not eof:
+                        raise json.JSONDecodeError("truncated", buf, end)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+
+                pos = end
+                expect_value = False
+                yield value
+
+
+def iter_items(path):
+    """Yield items from a JSON array or JSONL file without loading it whole."""
+    return iter(ItemReader(path))
+
+
+def write_items(path, items, fmt=None):
+    """Write items to `path`, in `fmt` or else the format its name asks for.
+
+    `items` can be any iterable of dicts, including a records.RecordTable.
+    Returns the number of items written.
+    """
+    fmt = fmt or format_of(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}")
+
+    if fmt == "columnar":
+        import records  # records builds on this module
+
+        table = items if isinstance(items, records.RecordTable) else records.RecordTable.from_items(items)
+        with open(path, 'wb') as f:
+            table.write_columns(f)
+        return len(table)
+
+    if fmt == "sqlite":
+        import task_store  # task_store builds on this module
+
+        return task_store.create_task_db(path, items)
+
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        if fmt == "jsonl":
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False, separators=(',', ':')))
+                f.write("\n")
+                count += 1
+            return count
+
+        # Same text as json.dump(list(items), f, ensure_ascii=False, indent=2),
+        # without building the list
+        f.write("[")
+        for item in items:
+            f.write(",\n" if count else "\n")
+            text = json.dumps(item, ensure_ascii=False, indent=2)
+            f.write("\n".join("  " + line for line in text.split("\n")))
+            count += 1
+        f.write("\n]" if count else "]")
+    return count
+
+
+def main(argv=None):
+    # Imported here, as the GUI tools load this module at startup
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Item file tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_convert = sub.add_parser("convert", help="convert between json, jsonl, columnar (.bqr) and task DB (.taskdb) files")
+    p_convert.add_argument("source")
+    p_convert.add_argument("target")
+    p_convert.add_argument("--format", choices=FORMATS, help="output format (default: from the target extension)")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or format_of(args.target)
+    try:
+        count = write_items(args.target, (item for item in iter_items(args.source) if isinstance(item, dict)), fmt)
+    except ValueError as e:
+        print(f"Error: cannot convert {args.source} to {fmt}: {e}", file=sys.stderr)
+        return 1
+    print(f"Converted {count} items: {args.source} ({detect_format(args.source)}) -> {args.target} ({fmt})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
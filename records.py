@@ -0,0 +1,532 @@
+"""Compact in-memory storage for annotation records.
+
+A list of nested item dicts costs ~1.2 KB per photo once keywords and meta
+are counted. RecordTable keeps the same records column by column instead:
+strings as UTF-8 in shared buffers, UUIDs as 16 raw bytes, and repeated
+values (campus, season, category, keywords, image folders, meta key sets)
+as small integer codes into an interned value pool. That is under 200
+bytes per photo, so a million records stay under 200 MB.
+
+Records go in and come out as plain dicts in the existing JSON schema:
+
+    table = records.load("pre_annotated.json")
+    item = table[0]            # a fresh dict, edits do not write back
+    item["tags"]["keywords"].append("雪")
+    table[0] = item            # store the edited record
+    record_io.write_items(path, table)
+
+The columns can also be saved as they are (`.bqr`, see write_columns):
+loading such a file is a few array copies instead of a JSON parse.
+"""
+import sys
+import json
+import struct
+import uuid
+import bisect
+import hashlib
+from array import array
+
+import record_io
+
+ATTRIBUTE_KEYS = ("campus", "season", "category")
+ITEM_KEYS = ("uuid", "filename", "original_path", "processed_path", "thumb_path", "width", "height", "tags")
+TAG_KEYS = ("attributes", "keywords", "meta")
+
+# Presence flags of the optional parts of a record
+HAS_TAGS = 1
+HAS_ATTRIBUTES = 2
+HAS_KEYWORDS = 4
+HAS_META = 8
+IRREGULAR = 16      # unexpected value types: the record is kept whole as JSON
+
+_COMPACT_JSON = {"ensure_ascii": False, "separators": (',', ':')}
+
+STR_COLUMNS = ("filenames", "basenames", "processed_paths", "thumb_paths", "meta_values", "extras")
+ARRAY_COLUMNS = ("dirs", "widths", "heights", "keyword_codes", "keyword_starts", "keyword_counts", "meta_keys", "flags")
+
+
+class ValuePool:
+    """Interned values addressed by integer codes; code 0 is None."""
+
+    def __init__(self):
+        self.values = [None]
+        self.codes = {None: 0}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            if isinstance(value, str):
+                value = sys.intern(value)
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+    @classmethod
+    def from_values(cls, values):
+        pool = cls()
+        pool.values = [sys.intern(v) if isinstance(v, str) else v for v in values]
+        pool.codes = {v: code for code, v in enumerate(pool.values)}
+        return pool
+
+    def __len__(self):
+        return len(self.values)
+
+
+class StrColumn:
+    """Strings packed as UTF-8 into one buffer, 8 bytes of overhead each.
+
+    Appended strings are addressed by consecutive offsets; a string that is
+    replaced is kept as a plain str in `moved` until compact() folds the
+    replacements back into the buffer.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.offsets = array('Q', [0])
+        self.moved = {}
+
+    def append(self, value):
+        self.buf += value.encode('utf-8')
+        self.offsets.append(len(self.buf))
+
+    def __getitem__(self, i):
+        if i in self.moved:
+            return self.moved[i]
+        return self.buf[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __setitem__(self, i, value):
+        self.moved[i] = value
+
+    def compact(self):
+        """Fold replaced strings back into the buffer."""
+        if not self.moved:
+            return
+        buf, offsets = bytearray(), array('Q', [0])
+        for i in range(len(self.offsets) - 1):
+            if i in self.moved:
+                buf += self.moved[i].encode('utf-8')
+            else:
+                buf += self.buf[self.offsets[i]:self.offsets[i + 1]]
+            offsets.append(len(buf))
+        self.buf, self.offsets, self.moved = buf, offsets, {}
+
+
+class RecordTable:
+    """Column-oriented list of annotation records with a list-like interface.
+
+    Supports len(), iteration, indexing/slicing (returning dicts), item
+    assignment and append(). Values the columns cannot represent exactly
+    are kept as JSON, so every record round-trips unchanged.
+    """
+
+    def __init__(self):
+        self.pool = ValuePool()
+        self.meta_shapes = ValuePool()      # tuples of meta keys
+        self.uuids = bytearray()
+        self.odd_uuids = {}                 # index -> uuid that is not a canonical UUID string
+        self.filenames = StrColumn()
+        self.dirs = array('I')              # original_path folder, as a pool code
+        self.basenames = StrColumn()        # original_path name, "" when equal to filename
+        self.processed_paths = StrColumn()
+        self.thumb_paths = StrColumn()
+        self.widths = array('i')
+        self.heights = array('i')
+        # Pool codes start as 16-bit and are widened once the pool outgrows them
+        self.attributes = {key: array('H') for key in ATTRIBUTE_KEYS}
+        self.keyword_codes = array('H')
+        self.keyword_starts = array('Q')
+        self.keyword_counts = array('H')
+        self.meta_keys = array('I')         # meta_shapes code
+        self.meta_values = StrColumn()      # JSON array of the meta values
+        self.extras = StrColumn()           # JSON of anything else, "" if none
+        self.flags = array('B')
+
+    @classmethod
+    def from_items(cls, items):
+        table = cls()
+        for item in items:
+            table.append(item)
+        return table
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        return self._get(self._index(index))
+
+    def __setitem__(self, index, item):
+        self._put(item, self._index(index))
+
+    def append(self, item):
+        self._put(item, None)
+
+    def to_list(self):
+        return list(self)
+
+    def original_paths(self):
+        """Yield the original_path of every record without decoding the rest."""
+        values = self.pool.values
+        for i in range(len(self)):
+            if self.extras[i]:
+                yield self._get(i).get("original_path")
+                continue
+            folder = values[self.dirs[i]]
+            yield None if folder is None else folder + (self.basenames[i] or self.filenames[i])
+
+    def write_columns(self, f):
+        """Write the table to a binary file object in the columnar format.
+
+        Layout: record_io.COLUMNAR_MAGIC, an 8-byte little-endian header
+        length, a UTF-8 JSON header (record count, value pools, column
+        types and sizes), then the raw bytes of every column in order.
+        """
+        self._compact()
+        columns = self._columns()
+        header = {
+            "count": len(self),
+            "byteorder": sys.byteorder,
+            "pool": self.pool.values,
+            "meta_shapes": self.meta_shapes.values,
+            "odd_uuids": self.odd_uuids,
+            "columns": [
+                [name, getattr(column, "typecode", "bytes"), getattr(column, "itemsize", 1), memoryview(column).nbytes]
+                for name, column in columns
+            ],
+        }
+        header = json.dumps(header, **_COMPACT_JSON).encode('utf-8')
+        f.write(record_io.COLUMNAR_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, column in columns:
+            f.write(column)
+
+    @classmethod
+    def from_columns(cls, data):
+        """Rebuild a table from the bytes written by write_columns."""
+        view = memoryview(data)
+        pos = len(record_io.COLUMNAR_MAGIC)
+        if bytes(view[:pos]) != record_io.COLUMNAR_MAGIC:
+            raise ValueError("not a columnar record file")
+        (header_len,) = struct.unpack_from('<Q', view, pos)
+        pos += 8
+        header = json.loads(bytes(view[pos:pos + header_len]).decode('utf-8'))
+        pos += header_len
+
+        columns = {}
+        for name, typecode, itemsize, nbytes in header["columns"]:
+            chunk = view[pos:pos + nbytes]
+            pos += nbytes
+            if typecode == "bytes":
+                columns[name] = bytearray(chunk)
+                continue
+            column = array(typecode)
+            if column.itemsize != itemsize:
+                raise ValueError(f"column {name}: {itemsize}-byte '{typecode}' values are not supported here")
+            column.frombytes(chunk)
+            if header["byteorder"] != sys.byteorder:
+                column.byteswap()
+            columns[name] = column
+        if pos != len(view):
+            raise ValueError("columnar record file is truncated or has trailing data")
+
+        table = cls()
+        table.pool = ValuePool.from_values(header["pool"])
+        table.meta_shapes = ValuePool.from_values([None] + [tuple(keys) for keys in header["meta_shapes"][1:]])
+        table.odd_uuids = {int(i): value for i, value in header["odd_uuids"].items()}
+        table.uuids = columns["uuids"]
+        for name in STR_COLUMNS:
+            column = getattr(table, name)
+            column.buf, column.offsets = columns[name + ".buf"], columns[name + ".offsets"]
+        for name in ARRAY_COLUMNS:
+            setattr(table, name, columns[name])
+        for key in ATTRIBUTE_KEYS:
+            table.attributes[key] = columns["attributes." + key]
+        if len(table) != header["count"]:
+            raise ValueError("columnar record file has inconsistent columns")
+        return table
+
+    def _columns(self):
+        columns = [("uuids", self.uuids)]
+        for name in STR_COLUMNS:
+            column = getattr(self, name)
+            columns += [(name + ".buf", column.buf), (name + ".offsets", column.offsets)]
+        columns += [(name, getattr(self, name)) for name in ARRAY_COLUMNS]
+        columns += [("attributes." + key, self.attributes[key]) for key in ATTRIBUTE_KEYS]
+        return columns
+
+    def _compact(self):
+        for name in STR_COLUMNS:
+            getattr(self, name).compact()
+        # Edited records may have moved their keywords to the end
+        if len(self.keyword_codes) != sum(self.keyword_counts):
+            codes, starts = array(self.keyword_codes.typecode), array('Q')
+            for start, count in zip(self.keyword_starts, self.keyword_counts):
+                starts.append(len(codes))
+                codes.extend(self.keyword_codes[start:start + count])
+            self.keyword_codes, self.keyword_starts = codes, starts
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return index
+
+    # Conversion
+
+    def _put(self, item, index):
+        flags = _flags(item)
+        extra = {}
+        if flags is None:
+            flags = IRREGULAR
+            extra["raw"] = item
+            item = {}
+        tags = item.get("tags") or {}
+        attrs = tags.get("attributes") or {}
+        meta = tags.get("meta") or {}
+
+        # Keys outside the schema, and schema keys that are absent
+        for name, container, known in (("item", item, ITEM_KEYS), ("tags", tags, TAG_KEYS),
+                                        ("attributes", attrs, ATTRIBUTE_KEYS)):
+            rest = {k: v for k, v in container.items() if k not in known}
+            if rest:
+                extra[name] = rest
+        missing = [k for k in ITEM_KEYS[:-1] if k not in item]
+        if missing and not flags & IRREGULAR:
+            extra["missing"] = missing
+
+        filename = item.get("filename", "")
+        original_path = item.get("original_path")
+        folder, name = None, ""
+        if original_path is not None:
+            split = max(original_path.rfind("/"), original_path.rfind("\\")) + 1
+            folder, name = original_path[:split], original_path[split:]
+            if name == filename:
+                name = ""
+            elif not name:
+                extra.setdefault("item", {})["original_path"] = original_path
+
+        size = []
+        for key in ("width", "height"):
+            value = item.get(key)
+            if value is None or not -2 ** 31 <= value < 2 ** 31:
+                if value is not None:
+                    extra.setdefault("item", {})[key] = value
+                value = 0
+            size.append(value)
+
+        uuid_bytes, odd_uuid = bytes(16), item.get("uuid")
+        if isinstance(odd_uuid, str) and len(odd_uuid) == 36:
+            try:
+                parsed = uuid.UUID(odd_uuid)
+                if str(parsed) == odd_uuid:
+                    uuid_bytes, odd_uuid = parsed.bytes, None
+            except ValueError:
+                pass
+
+        dir_code = self.pool.code(folder)
+        attr_codes = [self.pool.code(attrs.get(key)) for key in ATTRIBUTE_KEYS]
+        keyword_codes = [self.pool.code(k) for k in tags.get("keywords") or ()]
+        if len(self.pool) > 0xFFFF and self.keyword_codes.typecode == 'H':
+            self._widen_codes()
+        if len(keyword_codes) > 0xFFFF:
+            extra.setdefault("tags", {})["keywords"] = tags["keywords"]
+            keyword_codes = []
+        meta_keys = self.meta_shapes.code(tuple(meta))
+        meta_values = json.dumps(list(meta.values()), **_COMPACT_JSON) if meta else ""
+        extra_json = json.dumps(extra, **_COMPACT_JSON) if extra else ""
+
+        if index is None:
+            index = len(self)
+            self.uuids += uuid_bytes
+            self.filenames.append(filename)
+            self.dirs.append(dir_code)
+            self.basenames.append(name)
+            self.processed_paths.append(item.get("processed_path", ""))
+            self.thumb_paths.append(item.get("thumb_path", ""))
+            self.widths.append(size[0])
+            self.heights.append(size[1])
+            for key, code in zip(ATTRIBUTE_KEYS, attr_codes):
+                self.attributes[key].append(code)
+            self.keyword_starts.append(len(self.keyword_codes))
+            self.keyword_counts.append(len(keyword_codes))
+            self.keyword_codes.extend(keyword_codes)
+            self.meta_keys.append(meta_keys)
+            self.meta_values.append(meta_values)
+            self.extras.append(extra_json)
+            self.flags.append(flags)
+        else:
+            self.uuids[index * 16:index * 16 + 16] = uuid_bytes
+            self.filenames[index] = filename
+            self.dirs[index] = dir_code
+            self.basenames[index] = name
+            self.processed_paths[index] = item.get("processed_path", "")
+            self.thumb_paths[index] = item.get("thumb_path", "")
+            self.widths[index] = size[0]
+            self.heights[index] = size[1]
+            for key, code in zip(ATTRIBUTE_KEYS, attr_codes):
+                self.attributes[key][index] = code
+            if len(keyword_codes) > self.keyword_counts[index]:
+                self.keyword_starts[index] = len(self.keyword_codes)
+                self.keyword_codes.extend(keyword_codes)
+            else:
+                start = self.keyword_starts[index]
+                self.keyword_codes[start:start + len(keyword_codes)] = array(self.keyword_codes.typecode, keyword_codes)
+            self.keyword_counts[index] = len(keyword_codes)
+            self.meta_keys[index] = meta_keys
+            self.meta_values[index] = meta_values
+            self.extras[index] = extra_json
+            self.flags[index] = flags
+
+        self.odd_uuids.pop(index, None)
+        if odd_uuid is not None and not flags & IRREGULAR:
+            self.odd_uuids[index] = odd_uuid
+
+    def _widen_codes(self):
+        for key in ATTRIBUTE_KEYS:
+            self.attributes[key] = array('I', self.attributes[key])
+        self.keyword_codes = array('I', self.keyword_codes)
+
+    def _get(self, i):
+        flags = self.flags[i]
+        extra_json = self.extras[i]
+        extra = json.loads(extra_json) if extra_json else {}
+        if flags & IRREGULAR:
+            return extra["raw"]
+        values = self.pool.values
+        missing = extra.get("missing", ())
+
+        item = {}
+        if "uuid" not in missing:
+            if i in self.odd_uuids:
+                item["uuid"] = self.odd_uuids[i]
+            else:
+                item["uuid"] = str(uuid.UUID(bytes=bytes(self.uuids[i * 16:i * 16 + 16])))
+        if "filename" not in missing:
+            item["filename"] = self.filenames[i]
+        if "original_path" not in missing:
+            folder = values[self.dirs[i]]
+            item["original_path"] = None if folder is None else folder + (self.basenames[i] or self.filenames[i])
+        if "processed_path" not in missing:
+            item["processed_path"] = self.processed_paths[i]
+        if "thumb_path" not in missing:
+            item["thumb_path"] = self.thumb_paths[i]
+        if "width" not in missing:
+            item["width"] = self.widths[i]
+        if "height" not in missing:
+            item["height"] = self.heights[i]
+        item.update(extra.get("item", {}))
+
+        if flags & HAS_TAGS:
+            tags = {}
+            if flags & HAS_ATTRIBUTES:
+                attrs = {}
+                for key in ATTRIBUTE_KEYS:
+                    code = self.attributes[key][i]
+                    if code:
+                        attrs[key] = values[code]
+                attrs.update(extra.get("attributes", {}))
+                tags["attributes"] = attrs
+            if flags & HAS_KEYWORDS:
+                start = self.keyword_starts[i]
+                tags["keywords"] = [values[c] for c in self.keyword_codes[start:start + self.keyword_counts[i]]]
+            if flags & HAS_META:
+                keys = self.meta_shapes.values[self.meta_keys[i]]
+                tags["meta"] = dict(zip(keys, json.loads(self.meta_values[i]))) if keys else {}
+            tags.update(extra.get("tags", {}))
+            item["tags"] = tags
+        return item
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _flags(item):
+    """Presence flags of a record that fits the columns, else None."""
+    for key in ("uuid", "filename", "original_path", "processed_path", "thumb_path"):
+        if key in item and not isinstance(item[key], str):
+            return None
+    for key in ("width", "height"):
+        if key in item and not _is_int(item[key]):
+            return None
+
+    flags = 0
+    if "tags" not in item:
+        return flags
+    tags = item["tags"]
+    if not isinstance(tags, dict):
+        return None
+    flags |= HAS_TAGS
+    if "attributes" in tags:
+        attrs = tags["attributes"]
+        if not isinstance(attrs, dict) or not all(isinstance(attrs[k], str) for k in ATTRIBUTE_KEYS if k in attrs):
+            return None
+        flags |= HAS_ATTRIBUTES
+    if "keywords" in tags:
+        keywords = tags["keywords"]
+        if not isinstance(keywords, list) or not all(isinstance(k, str) for k in keywords):
+            return None
+        flags |= HAS_KEYWORDS
+    if "meta" in tags:
+        if not isinstance(tags["meta"], dict):
+            return None
+        flags |= HAS_META
+    return flags
+
+
+class DigestSet:
+    """Set of strings kept as sorted 64-bit digests (8 bytes per entry).
+
+    For membership tests over many paths, e.g. which images were already
+    processed. A false positive needs a 64-bit hash collision. New entries
+    collect in a small set that is merged in once it reaches 1/8 of the
+    sorted part, so merging stays linear overall.
+    """
+
+    def __init__(self, values=()):
+        self.sorted = array('q')
+        self.pending = set()
+        for value in values:
+            self.add(value)
+
+    @staticmethod
+    def digest(value):
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+    def add(self, value):
+        key = self.digest(value)
+        if self._has(key):
+            return
+        self.pending.add(key)
+        if len(self.pending) >= max(4096, len(self.sorted) // 8):
+            # Timsort merges the two sorted runs in linear time
+            self.sorted = array('q', sorted(self.sorted + array('q', sorted(self.pending))))
+            self.pending = set()
+
+    def _has(self, key):
+        if key in self.pending:
+            return True
+        i = bisect.bisect_left(self.sorted, key)
+        return i < len(self.sorted) and self.sorted[i] == key
+
+    def __contains__(self, value):
+        return self._has(self.digest(value))
+
+    def __len__(self):
+        return len(self.sorted) + len(self.pending)
+
+
+def load(path):
+    """Load a columnar file, or stream a JSON array or JSONL file, into a RecordTable."""
+    if record_io.detect_format(path) == "columnar":
+        with open(path, 'rb') as f:
+            return RecordTable.from_columns(f.read())
+    return RecordTable.from_items(item for item in record_io.iter_items(path) if isinstance(item, dict))
@@ -0,0 +1,169 @@
+"""Processing order for the preprocessing queue.
+
+Policies (name -> label shown in the GUI):
+
+    walk         folder order, as os.walk lists the files (the default)
+    newest       newest photos first, by EXIF DateTimeOriginal (file mtime without EXIF)
+    folders      files under the given subfolders first, in the order given
+    smallest     smallest files first, for quick early results
+    round_robin  one file from each top-level subfolder in turn
+
+WorkQueue holds the files still to process. Its policy can be changed at
+any time, e.g. from the GUI thread while a run is going: the remaining
+files are re-ordered before the next one is taken, and nothing already
+processed or in progress is affected.
+"""
+import os
+import threading
+from datetime import datetime
+
+POLICIES = {
+    "walk": "目录顺序 (Folder order)",
+    "newest": "最新拍摄优先 (Newest first)",
+    "folders": "指定文件夹优先 (Folders first)",
+    "smallest": "小文件优先 (Smallest first)",
+    "round_robin": "子文件夹轮转 (Round robin)",
+}
+
+
+def exif_timestamp(path):
+    """Capture time of a photo as a timestamp: EXIF DateTimeOriginal or
+    DateTime, else the file's mtime. Only the EXIF header is read."""
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            exif = img.getexif()
+            # 36867 (DateTimeOriginal) lives in the Exif sub-IFD, 306 (DateTime) in IFD0
+            date_str = exif.get_ifd(0x8769).get(36867) or exif.get(306)
+        if date_str:
+            return datetime.strptime(date_str.strip('\x00 '), '%Y:%m:%d %H:%M:%S').timestamp()
+    except Exception:
+        pass
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+def _relative_parts(path, root):
+    rel = os.path.relpath(path, root) if root else path
+    return rel.replace(os.sep, '/').split('/')
+
+
+def order_files(files, policy="walk", root=None, folders=(), cache=None):
+    """Return `files` (in walk order) re-ordered by `policy`.
+
+    `folders` are subfolder paths relative to `root`, for the "folders"
+    policy. `cache` is a dict kept by the caller so switching back to a
+    policy does not read every file again.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown processing order: {policy}")
+    if cache is None:
+        cache = {}
+
+    if policy == "walk":
+        return list(files)
+
+    if policy == "newest":
+        times = cache.setdefault("newest", {})
+        for f in files:
+            if f not in times:
+                times[f] = exif_timestamp(f)
+        # Stable sort: files without any date keep their folder order among equals
+        return sorted(files, key=lambda f: times[f], reverse=True)
+
+    if policy == "smallest":
+        sizes = cache.setdefault("smallest", {})
+        for f in files:
+            if f not in sizes:
+                try:
+                    sizes[f] = os.path.getsize(f)
+                except OSError:
+                    sizes[f] = 0
+        return sorted(files, key=lambda f: sizes[f])
+
+    if policy == "folders":
+        prefixes = [p.strip().strip('/\\').replace('\\', '/').split('/') for p in folders if p.strip()]
+
+        def rank(f):
+            parts = _relative_parts(f, root)
+            for i, prefix in enumerate(prefixes):
+                if parts[:len(prefix)] == prefix:
+                    return i
+            return len(prefixes)
+        return sorted(files, key=rank)
+
+    # round_robin: interleave the top-level subfolders, keeping each one's order
+    groups = {}
+    for f in files:
+        parts = _relative_parts(f, root)
+        groups.setdefault(parts[0] if len(parts) > 1 else "", []).append(f)
+    ordered = []
+    lists = list(groups.values())
+    for i in range(max((len(g) for g in lists), default=0)):
+        for g in lists:
+            if i < len(g):
+                ordered.append(g[i])
+    return ordered
+
+
+class WorkQueue:
+    """Files waiting to be processed, taken one at a time in policy order.
+
+    Thread-safe: set_policy may be called from any thread; the new order
+    is computed by the thread calling pop(), before it takes the next file.
+    """
+
+    def __init__(self, policy="walk", folders=(), root=None):
+        self.root = root
+        self.policy = None
+        self.folders = ()
+        self._lock = threading.Lock()
+        self._files = []        # remaining files, walk order
+        self._order = []        # remaining files, reversed policy order (pop from the end)
+        self._taken = set()
+        self._pending = (policy, tuple(folders))
+        self._cache = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files) - len(self._taken)
+
+    def extend(self, files, root=None):
+        """Add files, given in walk order."""
+        with self._lock:
+            if root is not None:
+                self.root = root
+            self._files.extend(files)
+            # Re-apply the current policy to include the new files
+            if self._pending is None:
+                self._pending = (self.policy, self.folders)
+
+    def set_policy(self, policy, folders=()):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown processing order: {policy}")
+        with self._lock:
+            self._pending = (policy, tuple(folders))
+
+    def pop(self):
+        """Next file to process, or None when the queue is empty."""
+        with self._lock:
+            pending = self._pending
+            self._pending = None
+            if pending:
+                remaining = [f for f in self._files if f not in self._taken]
+                self._files, self._taken = remaining, set()
+        if pending:
+            # Ordering may read every file (EXIF, sizes); done outside the lock
+            ordered = order_files(remaining, pending[0], self.root, pending[1], self._cache)
+            with self._lock:
+                self.policy, self.folders = pending
+                self._order = ordered[::-1]
+        with self._lock:
+            while self._order:
+                f = self._order.pop()
+                if f not in self._taken:
+                    self._taken.add(f)
+                    return f
+            return None
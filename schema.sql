@@ -19,13 +19,276 @@ CREATE TABLE IF NOT EXISTS photos (
     
     -- Meta info (Stored as JSON string)
     meta TEXT,
+
+    -- Item keys no other column holds, as a JSON object shaped like the
+    -- item, so items round-trip through a task DB unchanged
+    extra TEXT,
+
+    -- Copied out of meta at ingestion so dashboard queries can be answered
+    -- from covering indexes (see gallery_db.META_COLUMNS)
+    date_taken TEXT,
+    annotator TEXT,
+    vlm_error TEXT,
+    last_modified TEXT,
     
     -- Timestamps
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     annotated_at DATETIME
 );
 
--- Indexes for faster searching
-CREATE INDEX IF NOT EXISTS idx_photos_campus ON photos(campus);
-CREATE INDEX IF NOT EXISTS idx_photos_season ON photos(season);
-CREATE INDEX IF NOT EXISTS idx_photos_category ON photos(category);
+-- Indexes for faster searching; the trailing (date_taken, uuid) also serves
+-- keyset pagination within a single filter
+CREATE INDEX IF NOT EXISTS idx_photos_campus_date ON photos(campus, date_taken, uuid);
+CREATE INDEX IF NOT EXISTS idx_photos_season_date ON photos(season, date_taken, uuid);
+CREATE INDEX IF NOT EXISTS idx_photos_category_date ON photos(category, date_taken, uuid);
+
+-- Covering indexes for gallery/dashboard queries
+CREATE INDEX IF NOT EXISTS idx_photos_season_category_date ON photos(season, category, date_taken, uuid, thumb_path);
+CREATE INDEX IF NOT EXISTS idx_photos_date_taken ON photos(date_taken, uuid, thumb_path);
+CREATE INDEX IF NOT EXISTS idx_photos_last_modified ON photos(last_modified, annotator);
+CREATE INDEX IF NOT EXISTS idx_photos_vlm_error ON photos(vlm_error, uuid) WHERE vlm_error IS NOT NULL;
+
+-- Ingestion manifest: source JSON files fully ingested into a library
+-- (root and layout), used to skip unchanged files on re-runs
+CREATE TABLE IF NOT EXISTS ingest_files (
+    path TEXT NOT NULL,
+    library_root TEXT NOT NULL,
+    layout TEXT NOT NULL,           -- season / unsorted / content
+    size INTEGER,
+    mtime REAL,
+    sha256 TEXT,
+    item_count INTEGER,
+    ingested_at DATETIME,
+    PRIMARY KEY (path, library_root, layout)
+);
+
+-- Content digest of the last ingested version of each item
+CREATE TABLE IF NOT EXISTS ingest_items (
+    uuid TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    source_json TEXT
+);
+
+-- Ingestion runs and their per-item progress, used to resume a run that was
+-- stopped or crashed. Item and file rows are dropped once a run is done.
+CREATE TABLE IF NOT EXISTS ingest_runs (
+    id INTEGER PRIMARY KEY,
+    source_path TEXT NOT NULL,
+    library_root TEXT NOT NULL,
+    organize_by_season INTEGER NOT NULL,
+    status TEXT NOT NULL,           -- running / stopped / failed / done
+    started_at DATETIME,
+    finished_at DATETIME,
+    items_done INTEGER,
+    items_skipped INTEGER,
+    items_failed INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS ingest_run_files (
+    run_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    item_count INTEGER,
+    PRIMARY KEY (run_id, path)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS ingest_run_items (
+    run_id INTEGER NOT NULL,
+    source_json TEXT NOT NULL,
+    item_index INTEGER NOT NULL,    -- position of the item in source_json
+    uuid TEXT,
+    status TEXT NOT NULL,           -- done / skipped / missing / error
+    error TEXT,
+    PRIMARY KEY (run_id, source_json, item_index)
+) WITHOUT ROWID;
+
+-- Content-addressed library files (optional layout, see library_store.py).
+-- path is relative to the library root.
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at DATETIME
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS photo_blobs (
+    photo_uuid TEXT NOT NULL,
+    role TEXT NOT NULL,             -- image / thumb
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (photo_uuid, role)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_photo_blobs_sha256 ON photo_blobs(sha256);
+
+-- Normalized keywords (inverted index for tag search)
+CREATE TABLE IF NOT EXISTS keywords (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS photo_keywords (
+    keyword_id INTEGER NOT NULL,
+    photo_uuid TEXT NOT NULL,
+    PRIMARY KEY (keyword_id, photo_uuid)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_photo_keywords_photo ON photo_keywords(photo_uuid);
+
+-- Keep photo_keywords in sync with photos.keywords. The insert trigger
+-- clears old links first, so INSERT OR REPLACE works without recursive triggers.
+-- Trigger statements inherit the conflict policy of the outer INSERT OR
+-- REPLACE (an OR IGNORE here would silently become OR REPLACE and give
+-- existing keywords new ids), so conflicts are avoided with NOT EXISTS/DISTINCT.
+CREATE TRIGGER IF NOT EXISTS photos_keywords_ai AFTER INSERT ON photos BEGIN
+    DELETE FROM photo_keywords WHERE photo_uuid = NEW.uuid;
+    INSERT INTO keywords (name)
+        SELECT DISTINCT trim(j.value)
+        FROM json_each(CASE WHEN json_valid(NEW.keywords) THEN NEW.keywords ELSE '[]' END) j
+        WHERE j.type = 'text' AND trim(j.value) != ''
+          AND NOT EXISTS (SELECT 1 FROM keywords k WHERE k.name = trim(j.value));
+    INSERT INTO photo_keywords (keyword_id, photo_uuid)
+        SELECT DISTINCT k.id, NEW.uuid
+        FROM json_each(CASE WHEN json_valid(NEW.keywords) THEN NEW.keywords ELSE '[]' END) j
+        JOIN keywords k ON k.name = trim(j.value)
+        WHERE j.type = 'text';
+END;
+
+CREATE TRIGGER IF NOT EXISTS photos_keywords_au AFTER UPDATE OF keywords ON photos BEGIN
+    DELETE FROM photo_keywords WHERE photo_uuid = OLD.uuid;
+    INSERT INTO keywords (name)
+        SELECT DISTINCT trim(j.value)
+        FROM json_each(CASE WHEN json_valid(NEW.keywords) THEN NEW.keywords ELSE '[]' END) j
+        WHERE j.type = 'text' AND trim(j.value) != ''
+          AND NOT EXISTS (SELECT 1 FROM keywords k WHERE k.name = trim(j.value));
+    INSERT INTO photo_keywords (keyword_id, photo_uuid)
+        SELECT DISTINCT k.id, NEW.uuid
+        FROM json_each(CASE WHEN json_valid(NEW.keywords) THEN NEW.keywords ELSE '[]' END) j
+        JOIN keywords k ON k.name = trim(j.value)
+        WHERE j.type = 'text';
+END;
+
+CREATE TRIGGER IF NOT EXISTS photos_keywords_ad AFTER DELETE ON photos BEGIN
+    DELETE FROM photo_keywords WHERE photo_uuid = OLD.uuid;
+END;
+
+-- Precomputed counts for the facet sidebar and keyword cloud, maintained by
+-- triggers. photo_facets holds one row per (campus, season, category)
+-- combination; NULL attributes are stored as '' so the key stays unique.
+CREATE TABLE IF NOT EXISTS photo_facets (
+    campus TEXT NOT NULL,
+    season TEXT NOT NULL,
+    category TEXT NOT NULL,
+    photo_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (campus, season, category)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS keyword_counts (
+    keyword_id INTEGER PRIMARY KEY,
+    photo_count INTEGER NOT NULL DEFAULT 0
+);
+
+-- INSERT OR REPLACE deletes the old row without firing delete triggers, so
+-- the old combination is decremented before the insert instead.
+CREATE TRIGGER IF NOT EXISTS photos_facets_bi BEFORE INSERT ON photos BEGIN
+    UPDATE photo_facets SET photo_count = photo_count - 1
+    WHERE (campus, season, category) = (
+        SELECT ifnull(campus, ''), ifnull(season, ''), ifnull(category, '')
+        FROM photos WHERE uuid = NEW.uuid
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS photos_facets_ai AFTER INSERT ON photos BEGIN
+    INSERT INTO photo_facets (campus, season, category, photo_count)
+        VALUES (ifnull(NEW.campus, ''), ifnull(NEW.season, ''), ifnull(NEW.category, ''), 1)
+        ON CONFLICT (campus, season, category) DO UPDATE SET photo_count = photo_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS photos_facets_au AFTER UPDATE OF campus, season, category ON photos BEGIN
+    UPDATE photo_facets SET photo_count = photo_count - 1
+    WHERE (campus, season, category) = (ifnull(OLD.campus, ''), ifnull(OLD.season, ''), ifnull(OLD.category, ''));
+    INSERT INTO photo_facets (campus, season, category, photo_count)
+        VALUES (ifnull(NEW.campus, ''), ifnull(NEW.season, ''), ifnull(NEW.category, ''), 1)
+        ON CONFLICT (campus, season, category) DO UPDATE SET photo_count = photo_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS photos_facets_ad AFTER DELETE ON photos BEGIN
+    UPDATE photo_facets SET photo_count = photo_count - 1
+    WHERE (campus, season, category) = (ifnull(OLD.campus, ''), ifnull(OLD.season, ''), ifnull(OLD.category, ''));
+END;
+
+-- photo_keywords is itself trigger-maintained, so counting its rows covers
+-- inserts, replaces, keyword edits and deletes alike.
+CREATE TRIGGER IF NOT EXISTS photo_keywords_count_ai AFTER INSERT ON photo_keywords BEGIN
+    INSERT INTO keyword_counts (keyword_id, photo_count) VALUES (NEW.keyword_id, 1)
+        ON CONFLICT (keyword_id) DO UPDATE SET photo_count = photo_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS photo_keywords_count_ad AFTER DELETE ON photo_keywords BEGIN
+    UPDATE keyword_counts SET photo_count = photo_count - 1 WHERE keyword_id = OLD.keyword_id;
+END;
+
+-- Full-text search over keywords, VLM description, filename and annotator.
+-- Text is indexed as overlapping character bigrams ("图书馆" -> "图书 书馆 馆"),
+-- which makes Chinese searchable with the stock unicode61 tokenizer; see
+-- gallery_query.search_text for the matching query side.
+CREATE VIRTUAL TABLE IF NOT EXISTS photos_fts USING fts5(
+    keywords, description, filename, annotator,
+    tokenize = 'unicode61'
+);
+
+-- Stable FTS row ids per photo (photos.rowid may change on VACUUM)
+CREATE TABLE IF NOT EXISTS photos_fts_docs (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE
+);
+
+CREATE VIEW IF NOT EXISTS photos_fts_text AS
+    SELECT
+        p.uuid AS uuid,
+        (SELECT group_concat(j.value, ' ')
+         FROM json_each(CASE WHEN json_valid(p.keywords) THEN p.keywords ELSE '[]' END) j
+         WHERE j.type = 'text') AS keywords,
+        CASE WHEN json_valid(p.meta) THEN json_extract(p.meta, '$.vlm_description') END AS description,
+        p.filename AS filename,
+        CASE WHEN json_valid(p.meta) THEN json_extract(p.meta, '$.annotator') END AS annotator
+    FROM photos p;
+
+-- The text is carried in the CTE seed so it is computed once per column
+CREATE VIEW IF NOT EXISTS photos_fts_source AS
+    SELECT
+        t.uuid AS uuid,
+        (WITH RECURSIVE s(i, txt) AS (SELECT 1, t.keywords UNION ALL SELECT i + 1, txt FROM s WHERE i < length(txt))
+         SELECT group_concat(substr(txt, i, 2), ' ') FROM s) AS keywords,
+        (WITH RECURSIVE s(i, txt) AS (SELECT 1, t.description UNION ALL SELECT i + 1, txt FROM s WHERE i < length(txt))
+         SELECT group_concat(substr(txt, i, 2), ' ') FROM s) AS description,
+        (WITH RECURSIVE s(i, txt) AS (SELECT 1, t.filename UNION ALL SELECT i + 1, txt FROM s WHERE i < length(txt))
+         SELECT group_concat(substr(txt, i, 2), ' ') FROM s) AS filename,
+        (WITH RECURSIVE s(i, txt) AS (SELECT 1, t.annotator UNION ALL SELECT i + 1, txt FROM s WHERE i < length(txt))
+         SELECT group_concat(substr(txt, i, 2), ' ') FROM s) AS annotator
+    FROM photos_fts_text t;
+
+-- The insert trigger replaces any previous FTS row itself, so INSERT OR
+-- REPLACE stays in sync without recursive triggers. The docs row is kept
+-- with an upsert clause: an OR IGNORE would take on the outer OR REPLACE
+-- and give the photo a new id on every write.
+CREATE TRIGGER IF NOT EXISTS photos_fts_ai AFTER INSERT ON photos BEGIN
+    DELETE FROM photos_fts WHERE rowid = (SELECT id FROM photos_fts_docs WHERE uuid = NEW.uuid);
+    INSERT INTO photos_fts_docs (uuid) VALUES (NEW.uuid) ON CONFLICT (uuid) DO NOTHING;
+    INSERT INTO photos_fts (rowid, keywords, description, filename, annotator)
+        SELECT d.id, s.keywords, s.description, s.filename, s.annotator
+        FROM photos_fts_docs d JOIN photos_fts_source s ON s.uuid = d.uuid
+        WHERE d.uuid = NEW.uuid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS photos_fts_au AFTER UPDATE OF keywords, meta, filename ON photos BEGIN
+    DELETE FROM photos_fts WHERE rowid = (SELECT id FROM photos_fts_docs WHERE uuid = NEW.uuid);
+    INSERT INTO photos_fts_docs (uuid) VALUES (NEW.uuid) ON CONFLICT (uuid) DO NOTHING;
+    INSERT INTO photos_fts (rowid, keywords, description, filename, annotator)
+        SELECT d.id, s.keywords, s.description, s.filename, s.annotator
+        FROM photos_fts_docs d JOIN photos_fts_source s ON s.uuid = d.uuid
+        WHERE d.uuid = NEW.uuid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS photos_fts_ad AFTER DELETE ON photos BEGIN
+    DELETE FROM photos_fts WHERE rowid = (SELECT id FROM photos_fts_docs WHERE uuid = OLD.uuid);
+    DELETE FROM photos_fts_docs WHERE uuid = OLD.uuid;
+END;
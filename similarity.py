@@ -0,0 +1,203 @@
+"""Similarity index over annotated images, for tag suggestions in the tagger.
+
+Every annotated image is reduced to two small features computed with
+NumPy from a heavily downscaled copy:
+
+* a 64-bit difference hash (dHash) of the 9x8 grayscale image, which is
+  close for near-duplicates and shots of the same building from a
+  similar angle;
+* a 64-bin RGB colour histogram (4 levels per channel), stored as the
+  square root of its frequencies so that a dot product gives the
+  Bhattacharyya coefficient, which captures the scene (sky, brick, lawn).
+
+Both come from image_features.py, which also stores them for every
+preprocessed image; items with stored features are indexed without
+decoding the image again.
+
+The distance between two images is the mean of the normalised Hamming
+distance of the hashes and 1 - the histogram coefficient, both in
+[0, 1]. A lookup is one vectorised pass over all rows (XOR + popcount,
+and a matrix-vector product), a few milliseconds for 100k images.
+
+The index keeps each image's campus and keywords; `suggest` votes over
+the k nearest neighbours, weighted by similarity. It is saved as an .npz
+file (config.SIMILARITY_INDEX_FILE), so it grows across task packs.
+"""
+import os
+import json
+
+import numpy as np
+
+import config
+
+HASH_BITS = 64
+HIST_BINS = 64
+# Campus value that means "not set"
+UNKNOWN_CAMPUS = "未知"
+
+# Number of set bits of every byte value, for NumPy < 2.0 without bitwise_count
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _hamming(xor):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xor)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(len(xor), 8).sum(axis=1, dtype=np.uint8)
+
+
+def image_features(path):
+    """(dHash as int, sqrt colour histogram as float32[64]) of an image file.
+
+    Computed by image_features.py, so they match the features the
+    preprocessing run stores next to a task file.
+    """
+    import image_features
+    small, _ = image_features.load_small(path)
+    return features_of(image_features.compute(small[None])[0])
+
+
+def features_of(record):
+    """(dHash, histogram) from an image_features.FEATURE_DTYPE record."""
+    return int(record["dhash"]), record["hist"].astype(np.float32) / np.float32(255)
+
+
+class SimilarityIndex:
+    """Features and tags of annotated images, keyed by uuid.
+
+    Not thread-safe; the tagger uses it from a single worker thread.
+    """
+
+    def __init__(self):
+        self.uuids = []
+        self.rows = {}                     # uuid -> row
+        self.campus = []
+        self.keywords = []
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.hists = np.zeros((0, HIST_BINS), dtype=np.float32)
+        self.count = 0
+        self.dirty = False
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, uuid):
+        return uuid in self.rows
+
+    def _grow(self):
+        capacity = max(1024, len(self.hashes) * 2)
+        hashes = np.zeros(capacity, dtype=np.uint64)
+        hashes[:self.count] = self.hashes[:self.count]
+        hists = np.zeros((capacity, HIST_BINS), dtype=np.float32)
+        hists[:self.count] = self.hists[:self.count]
+        self.hashes, self.hists = hashes, hists
+
+    def add(self, uuid, features, campus=None, keywords=()):
+        """Add an image, or replace its features and tags if already indexed."""
+        dhash, hist = features
+        row = self.rows.get(uuid)
+        if row is None:
+            if self.count == len(self.hashes):
+                self._grow()
+            row = self.count
+            self.count += 1
+            self.rows[uuid] = row
+            self.uuids.append(uuid)
+            self.campus.append(None)
+            self.keywords.append(())
+        self.hashes[row] = dhash
+        self.hists[row] = hist
+        self.campus[row] = campus if campus != UNKNOWN_CAMPUS else None
+        self.keywords[row] = tuple(keywords)
+        self.dirty = True
+
+    def update_tags(self, uuid, campus=None, keywords=()):
+        """Replace the tags of an indexed image. False if it is not indexed."""
+        row = self.rows.get(uuid)
+        if row is None:
+            return False
+        self.campus[row] = campus if campus != UNKNOWN_CAMPUS else None
+        self.keywords[row] = tuple(keywords)
+        self.dirty = True
+        return True
+
+    def neighbours(self, features, k=config.SIMILAR_K, exclude=None):
+        """[(distance, uuid)] of the k nearest images, nearest first."""
+        n = self.count
+        if not n:
+            return []
+        dhash, hist = features
+        hamming = _hamming(self.hashes[:n] ^ np.uint64(dhash)).astype(np.float32)
+        coefficient = self.hists[:n] @ hist
+        # 0.5 * hamming / 64 + 0.5 * (1 - coefficient), in float32
+        distance = hamming * np.float32(0.5 / HASH_BITS)
+        distance += np.float32(0.5)
+        distance -= np.float32(0.5) * np.minimum(coefficient, np.float32(1.0))
+
+        if exclude is not None and exclude in self.rows:
+            distance[self.rows[exclude]] = np.inf
+        k = min(k, n)
+        nearest = np.argpartition(distance, k - 1)[:k]
+        nearest = nearest[np.argsort(distance[nearest])]
+        return [(float(distance[i]), self.uuids[i]) for i in nearest if np.isfinite(distance[i])]
+
+    def suggest(self, features, k=config.SIMILAR_K, exclude=None,
+                max_distance=config.SIMILAR_MAX_DISTANCE, min_share=0.4):
+        """Suggested (campus or None, [keywords]) from the k nearest neighbours.
+
+        Neighbours further than `max_distance` are ignored; the rest vote
+        with weight 1 - distance. A tag is suggested when the neighbours
+        carrying it hold at least `min_share` of the total weight (campus:
+        more than half).
+        """
+        votes_campus = {}
+        votes_keywords = {}
+        total = 0.0
+        for distance, uuid in self.neighbours(features, k, exclude):
+            if distance > max_distance:
+                break
+            row = self.rows[uuid]
+            weight = 1.0 - distance
+            total += weight
+            if self.campus[row]:
+                votes_campus[self.campus[row]] = votes_campus.get(self.campus[row], 0.0) + weight
+            for keyword in self.keywords[row]:
+                votes_keywords[keyword] = votes_keywords.get(keyword, 0.0) + weight
+        if not total:
+            return None, []
+
+        campus = None
+        if votes_campus:
+            best, weight = max(votes_campus.items(), key=lambda kv: kv[1])
+            if weight > total / 2:
+                campus = best
+        keywords = [kw for kw, weight in sorted(votes_keywords.items(), key=lambda kv: -kv[1])
+                    if weight >= total * min_share]
+        return campus, keywords
+
+    # Persistence
+
+    def save(self, path=config.SIMILARITY_INDEX_FILE):
+        n = self.count
+        tags = json.dumps([[c, list(k)] for c, k in zip(self.campus, self.keywords)], ensure_ascii=False)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, uuids=np.array(self.uuids, dtype=str), hashes=self.hashes[:n],
+                 hists=self.hists[:n], tags=np.array(tags))
+        os.replace(tmp_path, path)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path=config.SIMILARITY_INDEX_FILE):
+        """The saved index, or an empty one if there is none yet."""
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        with np.load(path) as data:
+            index.uuids = [str(u) for u in data["uuids"]]
+            index.hashes = data["hashes"].astype(np.uint64)
+            index.hists = data["hists"].astype(np.float32)
+            tags = json.loads(str(data["tags"]))
+        index.count = len(index.uuids)
+        index.rows = {uuid: i for i, uuid in enumerate(index.uuids)}
+        index.campus = [t[0] for t in tags]
+        index.keywords = [tuple(t[1]) for t in tags]
+        return index
@@ -0,0 +1,79 @@
+"""Startup timing for the GUI tools.
+
+Each tool imports this module first and marks its phases (imports done,
+QApplication created, window built, first paint, data loaded). Nothing is
+reported unless BQB_STARTUP_REPORT is set:
+
+    BQB_STARTUP_REPORT=1 python gui.py            # print the phases to stderr
+    BQB_STARTUP_REPORT=t.json python gui.py       # write them as JSON
+    BQB_STARTUP_EXIT=1 ...                        # quit once startup is done
+
+Times are seconds since this module was imported; benchmark.py runs each
+tool this way (`python benchmark.py startup`) and also records the wall
+time of the whole process, interpreter start-up included.
+"""
+import os
+import sys
+import time
+
+_T0 = time.perf_counter()
+_marks = []
+
+REPORT = os.getenv("BQB_STARTUP_REPORT", "")
+EXIT_WHEN_DONE = os.getenv("BQB_STARTUP_EXIT", "") not in ("", "0")
+
+
+def mark(name):
+    """Record that phase `name` finished now."""
+    _marks.append((name, round(time.perf_counter() - _T0, 4)))
+
+
+def marks():
+    return dict(_marks)
+
+
+def after_first_paint(window, callback=None):
+    """Run `callback` (e.g. loading data) once `window` has painted, then report.
+
+    The callback is queued behind the first paint event, so the window is
+    on screen before any slow work starts.
+    """
+    from PyQt6.QtCore import QObject, QEvent, QTimer
+
+    class _PaintWatcher(QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.Type.Paint:
+                obj.removeEventFilter(self)
+                mark("first_paint")
+                QTimer.singleShot(0, _finish)
+            return False
+
+    def _finish():
+        if callback:
+            callback()
+            mark("data_loaded")
+        _report()
+        if EXIT_WHEN_DONE:
+            window.close()
+            QTimer.singleShot(0, _quit)
+
+    watcher = _PaintWatcher(window)
+    window.installEventFilter(watcher)
+
+
+def _quit():
+    from PyQt6.QtWidgets import QApplication
+    QApplication.quit()
+
+
+def _report():
+    if not REPORT:
+        return
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if REPORT == "1":
+        phases = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in _marks)
+        print(f"[startup] {tool}: {phases}", file=sys.stderr, flush=True)
+        return
+    import json
+    with open(REPORT, 'w', encoding='utf-8') as f:
+        json.dump({"tool": tool, "phases": marks()}, f, indent=2)
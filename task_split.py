@@ -0,0 +1,111 @@
+import os
+import math
+import shutil
+
+import records
+import record_io
+import quality_gate
+
+
+def split_task_file(json_path, per_file, do_zip=False, progress_callback=None, is_cancelled=None, log_callback=None):
+    """Split a pre-annotated file into task folders of `per_file` images each.
+
+    Each folder gets the images it needs plus task_data in the source's
+    format, with original_path rewritten to the bare file name. The
+    folders go to <name>_dist next to the source, optionally zipped.
+    Images rejected by the quality gate (quality_gate.py) go to the last
+    task folders, so annotators reach them only after the usable ones.
+    Returns (number of task folders, output root).
+    """
+    def log(msg):
+        if log_callback:
+            log_callback(msg)
+        else:
+            print(msg)
+
+    data = records.load(json_path)
+    # Task files are written in the same format as the source
+    task_format = record_io.detect_format(json_path)
+
+    total = len(data)
+    if total == 0:
+        return 0, None
+
+    chunks = math.ceil(total / per_file)
+
+    # Stable: usable images keep their order, rejected ones follow in theirs
+    rejected = [i for i, item in enumerate(data) if quality_gate.is_rejected(item)]
+    if rejected:
+        rejected_set = set(rejected)
+        order = [i for i in range(total) if i not in rejected_set] + rejected
+        log(f"{len(rejected)} images rejected by the quality gate moved to the last tasks.")
+    else:
+        order = range(total)
+
+    base_dir = os.path.dirname(json_path)
+    json_filename = os.path.basename(json_path)
+    base_name_no_ext = os.path.splitext(json_filename)[0]
+
+    output_root = os.path.join(base_dir, f"{base_name_no_ext}_dist")
+    os.makedirs(output_root, exist_ok=True)
+
+    processed_count = 0
+
+    for i in range(chunks):
+        if is_cancelled and is_cancelled():
+            break
+
+        chunk_data = [data[j] for j in order[i*per_file : (i+1)*per_file]]
+
+        # Create task folder
+        task_folder_name = f"{base_name_no_ext}_task_{i+1:03d}"
+        task_folder_path = os.path.join(output_root, task_folder_name)
+
+        # Clean recreate if exists
+        if os.path.exists(task_folder_path):
+            shutil.rmtree(task_folder_path)
+        os.makedirs(task_folder_path, exist_ok=True)
+
+        new_chunk_data = []
+
+        for item in chunk_data:
+            if is_cancelled and is_cancelled():
+                break
+
+            src_path = item.get("original_path")
+            # Try to resolve relative path if absolute doesn't exist
+            if not src_path or not os.path.exists(src_path):
+                # Try relative to json dir
+                possible_path = os.path.join(base_dir, item.get("filename", ""))
+                if os.path.exists(possible_path):
+                    src_path = possible_path
+
+            if src_path and os.path.exists(src_path):
+                filename = os.path.basename(src_path)
+                dst_path = os.path.join(task_folder_path, filename)
+
+                try:
+                    shutil.copy2(src_path, dst_path)
+
+                    # Update item path for the task
+                    new_item = item.copy()
+                    new_item["original_path"] = filename # Relative path
+                    new_chunk_data.append(new_item)
+                except Exception as copy_err:
+                    log(f"Copy error: {copy_err}")
+            else:
+                log(f"Warning: Image not found {src_path}")
+
+            processed_count += 1
+            if progress_callback:
+                progress_callback(processed_count, total)
+
+        # Save task data in the folder
+        task_json_path = os.path.join(task_folder_path, "task_data" + record_io.FORMAT_EXTENSIONS[task_format])
+        record_io.write_items(task_json_path, new_chunk_data, task_format)
+
+        # Zip if requested
+        if do_zip:
+            shutil.make_archive(task_folder_path, 'zip', task_folder_path)
+
+    return chunks, output_root
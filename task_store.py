@@ -0,0 +1,316 @@
+"""Random-access task files for the tagger.
+
+A JSONL task file is opened through an offset index kept next to it
+(task_data.jsonl.idx), so opening takes the same time for 50 items or
+50k: records are read from disk when they are shown, and an edited record
+is written back over its own line instead of rewriting the whole file.
+
+A record that grows is appended at the end of the file and its old line
+blanked out with spaces (JSONL readers skip blank lines); the index keeps
+the original order, and the file is rewritten in that order when the
+store is closed (or, after a crash, when it is next opened with its
+index). Without a valid index, e.g. after another tool wrote the file, it
+is rebuilt from the file in one pass.
+
+A task can also be kept as a small SQLite file with the photos schema
+(.taskdb, see SqliteTaskStore): saving a record is a single-row UPDATE,
+and finished tasks are merged into the gallery with gallery_db.merge_db.
+Item keys without a column of their own are kept in photos.extra, so
+items round-trip unchanged; items the table cannot hold (no uuid or
+filename, or a uuid seen before) stop the conversion with a ValueError.
+Task DBs are created from and exported back to the JSON exchange format
+with record_io:
+
+    python record_io.py convert task_data.json task_data.taskdb
+    python record_io.py convert task_data.taskdb task_data.json
+"""
+import os
+import sys
+import json
+import struct
+import sqlite3
+from datetime import datetime
+from array import array
+
+import config
+import gallery_db
+import record_io
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"BQBIDX\x00\x01"
+# magic, size and mtime of the task file it indexes, record count
+INDEX_HEADER = struct.Struct('<8sQdQ')
+OFFSET = struct.Struct('<Q')
+
+
+class JsonlTaskStore:
+    """List-like access to the records of a JSONL file, read and written in place.
+
+    Supports len(), iteration, indexing (returning dicts) and item
+    assignment, which is written to disk immediately.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.f = open(path, 'r+b')
+        self.offsets = self._load_index()
+        if self.offsets is None:
+            self.offsets = self._build_index()
+            self._write_index()
+        # Set once a record moved out of file order; close() puts it back
+        self.moved = any(b <= a for a, b in zip(self.offsets, self.offsets[1:]))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        line = self._read_line(self._index(index))
+        return json.loads(line)
+
+    def __setitem__(self, index, item):
+        index = self._index(index)
+        line = json.dumps(item, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        old_len = len(self._read_line(index))
+
+        if len(line) <= old_len:
+            # Trailing spaces keep the line length, and are valid JSON whitespace
+            self.f.seek(self.offsets[index])
+            self.f.write(line + b" " * (old_len - len(line)))
+            self.f.flush()
+            self._update_index()
+            return
+
+        # Append first, so a crash in between leaves a duplicate rather than a lost record
+        self.f.seek(0, os.SEEK_END)
+        end = self.f.tell()
+        if end:
+            self.f.seek(end - 1)
+            if self.f.read(1) != b"\n":
+                self.f.write(b"\n")
+                end += 1
+        self.f.write(line + b"\n")
+        self.f.seek(self.offsets[index])
+        self.f.write(b" " * old_len)
+        self.f.flush()
+        self.offsets[index] = end
+        self._update_index(index)
+        self.moved = True
+
+    def close(self):
+        if self.moved:
+            self._compact()
+        self.f.close()
+
+    def _compact(self):
+        """Rewrite the file with its records in index order, without blanked lines."""
+        tmp_path = self.path + ".tmp"
+        offsets = array('Q')
+        with open(tmp_path, 'wb') as f:
+            for index in range(len(self)):
+                offsets.append(f.tell())
+                f.write(self._read_line(index).rstrip(b" ") + b"\n")
+        self.f.close()
+        os.replace(tmp_path, self.path)
+        self.f = open(self.path, 'r+b')
+        self.offsets = offsets
+        self.moved = False
+        self._write_index()
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return index
+
+    def _read_line(self, index):
+        self.f.seek(self.offsets[index])
+        return self.f.readline().rstrip(b"\r\n")
+
+    # Index file
+
+    def _stat(self):
+        st = os.fstat(self.f.fileno())
+        return st.st_size, st.st_mtime
+
+    def _build_index(self):
+        offsets = array('Q')
+        self.f.seek(0)
+        pos = 0
+        for line in self.f:
+            if line.strip():
+                offsets.append(pos)
+            pos += len(line)
+        return offsets
+
+    def _load_index(self):
+        """Offsets from the index file, or None if it is missing or stale."""
+        try:
+            with open(self.index_path, 'rb') as f:
+                header = f.read(INDEX_HEADER.size)
+                if len(header) != INDEX_HEADER.size:
+                    return None
+                magic, size, mtime, count = INDEX_HEADER.unpack(header)
+                if magic != INDEX_MAGIC or (size, mtime) != self._stat():
+                    return None
+                offsets = array('Q')
+                offsets.frombytes(f.read())
+        except (OSError, ValueError):
+            return None
+        if len(offsets) != count:
+            return None
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return offsets
+
+    def _header(self):
+        size, mtime = self._stat()
+        return INDEX_HEADER.pack(INDEX_MAGIC, size, mtime, len(self.offsets))
+
+    def _write_index(self):
+        offsets = array('Q', self.offsets)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self._header())
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, self.index_path)
+
+    def _update_index(self, index=None):
+        """Re-stamp the index after a write, and store one moved offset."""
+        try:
+            with open(self.index_path, 'r+b') as f:
+                if index is not None:
+                    f.seek(INDEX_HEADER.size + OFFSET.size * index)
+                    f.write(OFFSET.pack(self.offsets[index]))
+                f.seek(0)
+                f.write(self._header())
+        except OSError:
+            self._write_index()
+
+
+class SqliteTaskStore:
+    """List-like access to the photos of a task database, saved row by row.
+
+    Records keep the order they were added in (rowid order). Assigning a
+    record is one UPDATE of its row, committed immediately; in WAL mode
+    that appends a page or two to the log instead of rewriting anything.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = gallery_db.connect(path)
+        gallery_db.add_missing_columns(self.conn)
+        self.rowids = array('q', (r[0] for r in self.conn.execute("SELECT rowid FROM photos ORDER BY rowid")))
+
+    def __len__(self):
+        return len(self.rowids)
+
+    def __iter__(self):
+        for row in self.conn.execute(gallery_db.ITEM_SELECT + " ORDER BY rowid"):
+            yield gallery_db.row_to_item(row)
+
+    def __getitem__(self, index):
+        row = self.conn.execute(gallery_db.ITEM_SELECT + " WHERE rowid = ?", (self.rowids[self._index(index)],)).fetchone()
+        return gallery_db.row_to_item(row)
+
+    def __setitem__(self, index, item):
+        row = gallery_db.item_to_row(item)
+        assignments = ", ".join(f"{column} = ?" for column in gallery_db.PHOTO_INSERT_COLUMNS)
+        self.conn.execute(f"UPDATE photos SET {assignments} WHERE rowid = ?", row + (self.rowids[self._index(index)],))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return index
+
+
+# Stores that save each record as it is assigned
+STORES = (JsonlTaskStore, SqliteTaskStore)
+
+
+def open_store(path, fmt=None):
+    """Open `path` as a task store, or return None for formats loaded whole."""
+    fmt = fmt or record_io.detect_format(path)
+    if fmt == "jsonl":
+        return JsonlTaskStore(path)
+    if fmt == "sqlite":
+        return SqliteTaskStore(path)
+    return None
+
+
+def _photos_table_sql():
+    """The photos table as schema.sql defines it, without the gallery's
+    indexes, triggers and summary tables, which would only slow task edits."""
+    with open(gallery_db.SCHEMA_FILE, 'r', encoding='utf-8') as f:
+        script = f.read()
+    mem = sqlite3.connect(":memory:")
+    try:
+        mem.executescript(script)
+        return mem.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'photos'").fetchone()[0]
+    finally:
+        mem.close()
+
+
+def _remove_db(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def create_task_db(path, items, batch_size=config.DB_BATCH_SIZE):
+    """Create a task database at `path` holding `items`, in order. Returns the count.
+
+    Raises ValueError, and leaves no file behind, if an item has no uuid or
+    filename or repeats a uuid: the photos table holds one row per uuid.
+    """
+    _remove_db(path)
+    conn = gallery_db.connect(path)
+    try:
+        conn.execute(_photos_table_sql())
+        writer = gallery_db.BulkWriter(conn, batch_size)
+        annotated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        seen = {}
+        for index, item in enumerate(items):
+            uuid = item.get("uuid")
+            for key in ("uuid", "filename"):
+                if not item.get(key):
+                    raise ValueError(f"item {index} has no {key}; a task DB needs a uuid and filename for every item")
+            if uuid in seen:
+                raise ValueError(f"items {seen[uuid]} and {index} share uuid {uuid}; a task DB holds one item per uuid")
+            seen[uuid] = index
+            writer.add(gallery_db.item_to_row(item, annotated_at=annotated_at))
+        writer.close()
+        if writer.failed:
+            raise ValueError(f"{writer.failed} items could not be written to the task DB")
+        # Leave a single self-contained file behind
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except BaseException:
+        conn.close()
+        _remove_db(path)
+        raise
+    conn.close()
+    return writer.written
+
+
+def iter_task_db(path):
+    """Yield the items of a task database in order, read-only."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        for row in conn.execute(gallery_db.item_select(conn) + " ORDER BY rowid"):
+            yield gallery_db.row_to_item(row)
+    finally:
+        conn.close()
+
@@ -0,0 +1,287 @@
+"""Client for the VLM's OpenAI-compatible chat completions endpoint.
+
+The tags we ask for are described by RESPONSE_SCHEMA. Depending on
+VLM_STRUCTURED_OUTPUT the schema is sent along so the server constrains
+decoding to it and the reply is always one valid JSON object:
+
+    json_schema  "response_format": {"type": "json_schema", ...}  (LM Studio, vLLM, llama.cpp, OpenAI)
+    guided_json  "guided_json": <schema>                          (older vLLM)
+    off          prompt only; the reply is parsed leniently
+    auto         try json_schema, then guided_json, then off, as the server
+                 rejects them (the default); the first mode that works is kept
+
+Whatever the mode, replies go through parse_response / normalize, the one
+place where values are checked: season and category are mapped to their
+English enum values (Chinese and common variants are accepted), objects
+are de-duplicated and capped. max_tokens is capped (VLM_MAX_TOKENS), so a
+model that runs on cannot generate indefinitely.
+
+With VLM_STREAM=1 the reply is streamed (server-sent events) and read as
+it arrives. JsonObjectScanner spots the end of the first complete JSON
+object; once it holds valid tags the connection is closed, so the server
+stops generating whatever the model would have added after it. The
+stream is also cut when VLM_STREAM_MAX_TOKENS chunks or
+VLM_STREAM_MAX_SECONDS have gone by; the text received so far is then
+returned as is (usually ending up as raw_description, for manual tagging)
+rather than retried.
+"""
+import re
+import json
+import time
+
+import requests
+
+import config
+
+SEASONS = ("Spring", "Summer", "Autumn", "Winter")
+CATEGORIES = ("Landscape", "Portrait", "Activity", "Documentary")
+MAX_OBJECTS = 5
+
+# Accepted spellings, lower case -> enum value
+_SEASON_ALIASES = {
+    "spring": "Spring", "春": "Spring", "春季": "Spring", "春天": "Spring",
+    "summer": "Summer", "夏": "Summer", "夏季": "Summer", "夏天": "Summer",
+    "autumn": "Autumn", "fall": "Autumn", "秋": "Autumn", "秋季": "Autumn", "秋天": "Autumn",
+    "winter": "Winter", "冬": "Winter", "冬季": "Winter", "冬天": "Winter",
+}
+_CATEGORY_ALIASES = {
+    "landscape": "Landscape", "scenery": "Landscape", "风景": "Landscape", "风光": "Landscape", "景观": "Landscape",
+    "portrait": "Portrait", "人像": "Portrait", "肖像": "Portrait",
+    "activity": "Activity", "event": "Activity", "活动": "Activity",
+    "documentary": "Documentary", "纪实": "Documentary", "记录": "Documentary",
+}
+
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "season": {"type": "string", "enum": list(SEASONS)},
+        "category": {"type": "string", "enum": list(CATEGORIES)},
+        "objects": {
+            "type": "array",
+            "items": {"type": "string", "maxLength": 20},
+            "maxItems": MAX_OBJECTS,
+        },
+    },
+    "required": ["season", "category", "objects"],
+    "additionalProperties": False,
+}
+
+PROMPT = f"""请分析这张图片。
+1. 判断季节 ({'/'.join(SEASONS)})。
+2. 判断场景类型 ({'/'.join(CATEGORIES)})。
+3. 提取画面中的关键物体 (不超过{MAX_OBJECTS}个) 使用中文标签。
+请以纯JSON格式返回，不要包含Markdown格式标记，格式如下:
+{{
+    "season": "...",
+    "category": "...",
+    "objects": ["...", "..."]
+}}"""
+
+MODES = ("auto", "json_schema", "guided_json", "off")
+# Order tried in auto mode
+_FALLBACK = ("json_schema", "guided_json", "off")
+# Error text of a server rejecting the structured output parameters
+_UNSUPPORTED = re.compile(r"response_format|json_schema|guided|grammar|schema", re.IGNORECASE)
+
+
+def _enum_value(value, aliases):
+    if not isinstance(value, str):
+        return None
+    return aliases.get(value.strip().lower())
+
+
+def normalize(data):
+    """Validated tags from a decoded reply: {"season", "category", "objects"},
+    each present only if valid. Unknown enum values are dropped."""
+    if not isinstance(data, dict):
+        return {}
+    tags = {}
+    season = _enum_value(data.get("season"), _SEASON_ALIASES)
+    if season:
+        tags["season"] = season
+    category = _enum_value(data.get("category"), _CATEGORY_ALIASES)
+    if category:
+        tags["category"] = category
+
+    objects = data.get("objects")
+    if isinstance(objects, str):
+        objects = re.split(r"[,，、;；]", objects)
+    if isinstance(objects, list):
+        seen = []
+        for obj in objects:
+            if isinstance(obj, str) and obj.strip() and obj.strip() not in seen:
+                seen.append(obj.strip())
+        tags["objects"] = seen[:MAX_OBJECTS]
+    return tags
+
+
+def parse_response(text):
+    """Tags from the reply text, see normalize.
+
+    Accepts markdown fences and text around the object. A reply without
+    a JSON object holding any valid tag gives {"raw_description": text}.
+    """
+    if not text:
+        return {}
+    start = text.find("{")
+    while start != -1:
+        try:
+            data, _ = json.JSONDecoder().raw_decode(text, start)
+        except json.JSONDecodeError:
+            start = text.find("{", start + 1)
+            continue
+        tags = normalize(data)
+        if tags:
+            return tags
+        break
+    return {"raw_description": text.strip()}
+
+
+class JsonObjectScanner:
+    """Finds complete top-level JSON objects in text fed piece by piece.
+
+    Tracks brace depth outside of strings; feed() returns the text of each
+    object closed by the new piece. Text outside objects is ignored.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.current = []
+
+    def feed(self, text):
+        objects = []
+        for ch in text:
+            if self.depth:
+                self.current.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"' and self.depth:
+                self.in_string = True
+            elif ch == "{":
+                if not self.depth:
+                    self.current = [ch]
+                self.depth += 1
+            elif ch == "}" and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    objects.append("".join(self.current))
+                    self.current = []
+        return objects
+
+
+class VLMClient:
+    """Sends one image per request and returns the reply text.
+
+    Keeps the HTTP connection open between requests. In auto mode the
+    structured output mode the server accepts is found on the first
+    request and kept.
+    """
+
+    def __init__(self, base_url=None, model=None, structured=None, max_tokens=None, timeout=None, stream=None):
+        self.base_url = (base_url or config.API_BASE_URL).rstrip("/")
+        self.model = model or config.MODEL_NAME
+        self.structured = structured or config.VLM_STRUCTURED_OUTPUT
+        if self.structured not in MODES:
+            raise ValueError(f"Unknown structured output mode: {self.structured}")
+        self.max_tokens = max_tokens if max_tokens is not None else config.VLM_MAX_TOKENS
+        self.timeout = timeout if timeout is not None else config.VLM_TIMEOUT_SECONDS
+        self.stream = config.VLM_STREAM if stream is None else stream
+        self.session = requests.Session()
+        # Totals for the run: streams closed early, and why
+        self.stream_stats = {"complete": 0, "token_budget": 0, "time_budget": 0}
+
+    def payload(self, base64_image, mode):
+        payload = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": PROMPT},
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                    ],
+                }
+            ],
+            "temperature": 0.7,
+            "max_tokens": self.max_tokens if self.max_tokens > 0 else -1,
+            "stream": bool(self.stream),
+        }
+        if mode == "json_schema":
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "image_tags", "strict": True, "schema": RESPONSE_SCHEMA},
+            }
+        elif mode == "guided_json":
+            payload["guided_json"] = RESPONSE_SCHEMA
+        return payload
+
+    def complete(self, base64_image):
+        """Reply text for an image (base64 JPEG), or None on failure."""
+        modes = _FALLBACK if self.structured == "auto" else (self.structured,)
+        for i, mode in enumerate(modes):
+            response = self.session.post(f"{self.base_url}/chat/completions", json=self.payload(base64_image, mode),
+                                         timeout=self.timeout, stream=bool(self.stream))
+            with response:
+                if response.status_code == 200:
+                    if self.structured == "auto" and mode != modes[0]:
+                        print(f"VLM server does not support structured output as {', '.join(modes[:i])}; using {mode}.")
+                    # Later requests go straight to the mode that worked
+                    self.structured = mode
+                    if self.stream:
+                        return self.read_stream(response)
+                    return response.json()['choices'][0]['message']['content']
+                if (response.status_code in (400, 422) and i + 1 < len(modes)
+                        and _UNSUPPORTED.search(response.text)):
+                    # The server rejected the structured output parameter; try the next mode
+                    continue
+                print(f"API Error: {response.status_code} - {response.text}")
+                return None
+        return None
+
+    def read_stream(self, response):
+        """Reply text of a streamed response; stops reading once a valid
+        tags object has arrived or a budget runs out (the caller closes
+        the connection)."""
+        scanner = JsonObjectScanner()
+        parts = []
+        chunks = 0
+        deadline = time.monotonic() + config.VLM_STREAM_MAX_SECONDS
+        for raw in response.iter_lines():
+            # Event streams are UTF-8 whatever the Content-Type says
+            line = raw.decode('utf-8', errors='replace')
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                choice = json.loads(data)["choices"][0]
+            except (ValueError, KeyError, IndexError):
+                continue
+            piece = (choice.get("delta") or {}).get("content") or ""
+            if piece:
+                chunks += 1
+                parts.append(piece)
+                for candidate in scanner.feed(piece):
+                    try:
+                        if normalize(json.loads(candidate)):
+                            self.stream_stats["complete"] += 1
+                            return candidate
+                    except json.JSONDecodeError:
+                        pass
+            if config.VLM_STREAM_MAX_TOKENS and chunks >= config.VLM_STREAM_MAX_TOKENS:
+                self.stream_stats["token_budget"] += 1
+                print(f"VLM stream stopped after {chunks} tokens without a complete answer.")
+                break
+            if time.monotonic() > deadline:
+                self.stream_stats["time_budget"] += 1
+                print(f"VLM stream stopped after {config.VLM_STREAM_MAX_SECONDS:g} s without a complete answer.")
+                break
+        return "".join(parts)
@@ -0,0 +1,547 @@
+"""Shared work ledger for preprocessing one image folder on several machines.
+
+The ledger is a small SQLite file on the share, next to the images. It
+lists every image (by path relative to the image folder, so machines may
+mount the share at different places) in batches. A worker claims a
+pending batch with a lease, renews the lease before each image, and once
+the batch is annotated saves its records to its own output file and marks
+the batch done. A batch whose lease ran out (the worker crashed, or was
+unplugged) goes back to the pool and is claimed by the next worker.
+
+    python cli.py ledger init  //nas/photos/ledger.db //nas/photos/raw --batch-size 50
+    python cli.py ledger work  //nas/photos/ledger.db //nas/photos/raw        # on every machine
+    python cli.py ledger status //nas/photos/ledger.db
+    python cli.py ledger merge //nas/photos/ledger.db pre_annotated.json
+
+Workers may run on Windows and Linux against the same ledger: paths in
+the ledger are stored '/'-separated, and each record carries the ledger
+path of its image (`_ledger_path`), which the merge matches on.
+
+Network file systems do not support WAL's shared memory, so the ledger
+uses the rollback journal and short write transactions. Worker clocks
+only matter through the lease length, which should be well above both
+the time one image takes and the clock drift between machines.
+"""
+import os
+import time
+import ntpath
+import posixpath
+import socket
+import sqlite3
+from datetime import datetime
+
+import config
+import record_io
+import profiling
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ledger_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',   -- pending, claimed, done
+    worker TEXT,
+    lease_expires REAL,
+    claims INTEGER NOT NULL DEFAULT 0,
+    finished_at TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,                    -- relative to the image folder, '/' separated
+    batch_id INTEGER NOT NULL REFERENCES batches(id),
+    worker TEXT,                              -- worker whose output holds the record, once done
+    error TEXT                                -- why the last attempt failed, if it did
+);
+CREATE INDEX IF NOT EXISTS idx_files_batch ON files(batch_id);
+CREATE INDEX IF NOT EXISTS idx_batches_status ON batches(status);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    input_dir TEXT,
+    output_file TEXT,
+    last_seen TEXT
+);
+"""
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def default_worker_name():
+    return socket.gethostname()
+
+
+def to_posix(path):
+    """A path as stored in the ledger: '/'-separated whatever OS wrote it."""
+    return path.replace('\\', '/')
+
+
+def _is_absolute(path):
+    # Either OS's notion: "/mnt/nas/..." or "Z:/photos/..."
+    return posixpath.isabs(path) or bool(ntpath.splitdrive(path)[0])
+
+
+def ledger_relpath(path, input_dir):
+    """'/'-separated path of `path` below `input_dir`, or None if it is not below it.
+
+    Works on paths written by either OS (a drive letter means Windows,
+    compared case-insensitively), wherever it runs.
+    """
+    path, root = to_posix(path), to_posix(input_dir).rstrip('/') + '/'
+    if ntpath.splitdrive(root)[0]:
+        matches = path.lower().startswith(root.lower())
+    else:
+        matches = path.startswith(root)
+    return path[len(root):] if matches else None
+
+
+def list_images(input_dir):
+    """Relative paths of the images under `input_dir`, sorted."""
+    paths = []
+    for root, dirs, filenames in os.walk(input_dir):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in config.IMAGE_EXTENSIONS:
+                rel = os.path.relpath(os.path.join(root, filename), input_dir)
+                paths.append(rel.replace(os.sep, '/'))
+    paths.sort()
+    return paths
+
+
+class WorkLedger:
+    """Batches of images with leases, kept in an SQLite file on the share."""
+
+    def __init__(self, path, create=False):
+        if not create and not os.path.exists(path):
+            raise FileNotFoundError(f"Ledger not found: {path}")
+        self.path = path
+        # Autocommit mode; every change is an explicit short transaction
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("PRAGMA busy_timeout=60000")
+        if create:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _write(self, func):
+        """Run func(conn) in a write transaction taken up front, so two
+        workers can never read the same free batch."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(self.conn)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return result
+
+    def add_files(self, paths, batch_size=config.LEDGER_BATCH_SIZE):
+        """Add images not in the ledger yet, in new batches. Returns the number added."""
+        def add(conn):
+            known = {r[0] for r in conn.execute("SELECT path FROM files")}
+            new = [p for p in paths if p not in known]
+            for start in range(0, len(new), batch_size):
+                batch_id = conn.execute("INSERT INTO batches (status) VALUES ('pending')").lastrowid
+                conn.executemany("INSERT INTO files (path, batch_id) VALUES (?, ?)",
+                                 ((p, batch_id) for p in new[start:start + batch_size]))
+            conn.execute("INSERT OR REPLACE INTO ledger_meta (key, value) VALUES ('batch_size', ?)", (str(batch_size),))
+            return len(new)
+        return self._write(add)
+
+    def requeue_failed(self, batch_size=config.LEDGER_BATCH_SIZE):
+        """Put images that failed in finished batches into new batches. Returns the count."""
+        def requeue(conn):
+            paths = [r[0] for r in conn.execute("""
+                SELECT files.path FROM files JOIN batches ON batches.id = files.batch_id
+                WHERE files.worker IS NULL AND batches.status = 'done' ORDER BY files.path
+            """)]
+            for start in range(0, len(paths), batch_size):
+                batch_id = conn.execute("INSERT INTO batches (status) VALUES ('pending')").lastrowid
+                conn.executemany("UPDATE files SET batch_id = ?, error = NULL WHERE path = ?",
+                                 ((batch_id, p) for p in paths[start:start + batch_size]))
+            return len(paths)
+        return self._write(requeue)
+
+    def register(self, worker, input_dir, output_file):
+        # Output files inside the ledger's folder are stored relative to it,
+        # so the machine running the merge finds them under its own mount
+        ledger_dir = os.path.dirname(os.path.abspath(self.path))
+        output_file = os.path.abspath(output_file)
+        try:
+            if os.path.commonpath([ledger_dir, output_file]) == ledger_dir:
+                output_file = os.path.relpath(output_file, ledger_dir)
+        except ValueError:
+            # Different drives on Windows
+            pass
+        self._write(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO workers (name, input_dir, output_file, last_seen) VALUES (?, ?, ?, ?)",
+            (worker, to_posix(os.path.abspath(input_dir)), to_posix(output_file), _now())
+        ))
+
+    def claim(self, worker, lease_seconds):
+        """Lease the next free batch to `worker`.
+
+        Returns (batch id, relative paths not done yet), or None when no
+        batch is free. A batch this worker already held (e.g. before a
+        restart) is handed back first.
+        """
+        def claim(conn):
+            now = time.time()
+            row = conn.execute("""
+                SELECT id FROM batches
+                WHERE (status = 'claimed' AND (worker = ? OR lease_expires < ?)) OR status = 'pending'
+                ORDER BY status = 'pending', id LIMIT 1
+            """, (worker, now)).fetchone()
+            if not row:
+                return None
+            batch_id = row[0]
+            conn.execute("""
+                UPDATE batches SET status = 'claimed', worker = ?, lease_expires = ?, claims = claims + 1
+                WHERE id = ?
+            """, (worker, now + lease_seconds, batch_id))
+            conn.execute("UPDATE workers SET last_seen = ? WHERE name = ?", (_now(), worker))
+            paths = [r[0] for r in conn.execute(
+                "SELECT path FROM files WHERE batch_id = ? AND worker IS NULL ORDER BY path", (batch_id,)
+            )]
+            return batch_id, paths
+        return self._write(claim)
+
+    def renew(self, batch_id, worker, lease_seconds):
+        """Extend the lease; False if the batch was given to another worker meanwhile."""
+        def renew(conn):
+            cur = conn.execute("""
+                UPDATE batches SET lease_expires = ?
+                WHERE id = ? AND worker = ? AND status = 'claimed'
+            """, (time.time() + lease_seconds, batch_id, worker))
+            return cur.rowcount == 1
+        return self._write(renew)
+
+    def complete(self, batch_id, worker, paths, failed=None):
+        """Mark `paths` as annotated by `worker` and the batch done; `failed`
+        maps the paths that could not be processed to their error. False if
+        the lease was lost, in which case nothing changes."""
+        def complete(conn):
+            row = conn.execute("SELECT worker, status FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            if not row or row[0] != worker or row[1] != 'claimed':
+                return False
+            conn.executemany("UPDATE files SET worker = ?, error = NULL WHERE path = ? AND batch_id = ?",
+                             ((worker, p, batch_id) for p in paths))
+            conn.executemany("UPDATE files SET error = ? WHERE path = ? AND batch_id = ?",
+                             ((error, p, batch_id) for p, error in (failed or {}).items()))
+            conn.execute("UPDATE batches SET status = 'done', lease_expires = NULL, finished_at = ? WHERE id = ?",
+                         (_now(), batch_id))
+            return True
+        return self._write(complete)
+
+    def release(self, batch_id, worker):
+        """Give a claimed batch back to the pool (e.g. when stopping)."""
+        self._write(lambda conn: conn.execute("""
+            UPDATE batches SET status = 'pending', worker = NULL, lease_expires = NULL
+            WHERE id = ? AND worker = ? AND status = 'claimed'
+        """, (batch_id, worker)))
+
+    def status(self):
+        """Counts for a progress overview."""
+        conn = self.conn
+        now = time.time()
+        batches = dict(conn.execute("SELECT status, COUNT(*) FROM batches GROUP BY status").fetchall())
+        expired = conn.execute(
+            "SELECT COUNT(*) FROM batches WHERE status = 'claimed' AND lease_expires < ?", (now,)
+        ).fetchone()[0]
+        total, done, failed = conn.execute("SELECT COUNT(*), COUNT(worker), COUNT(error) FROM files").fetchone()
+        workers = []
+        for name, last_seen in conn.execute("SELECT name, last_seen FROM workers ORDER BY name"):
+            files_done = conn.execute("SELECT COUNT(*) FROM files WHERE worker = ?", (name,)).fetchone()[0]
+            active = conn.execute(
+                "SELECT COUNT(*) FROM batches WHERE worker = ? AND status = 'claimed' AND lease_expires >= ?",
+                (name, now)
+            ).fetchone()[0]
+            workers.append({"name": name, "done": files_done, "active_batches": active, "last_seen": last_seen})
+        return {
+            "files": total,
+            "done": done,
+            "failed": failed,
+            "batches": batches,
+            "expired_leases": expired,
+            "workers": workers,
+        }
+
+    def active_leases(self):
+        """Number of batches currently leased to some worker."""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM batches WHERE status = 'claimed' AND lease_expires >= ?", (time.time(),)
+        ).fetchone()[0]
+
+    def owners(self):
+        """{relative path: worker} of the annotated images."""
+        return dict(self.conn.execute("SELECT path, worker FROM files WHERE worker IS NOT NULL"))
+
+    def workers(self):
+        """{worker: (input_dir, output_file)}: the input folder as the worker
+        wrote it ('/'-separated), the output file as a native path on this
+        machine (resolved against the ledger's folder if relative)."""
+        ledger_dir = os.path.dirname(os.path.abspath(self.path))
+        workers = {}
+        for name, input_dir, output_file in self.conn.execute("SELECT name, input_dir, output_file FROM workers"):
+            # Rows written by older versions on Windows use '\\'
+            input_dir, output_file = to_posix(input_dir or ""), to_posix(output_file or "")
+            if not _is_absolute(output_file):
+                output_file = os.path.join(ledger_dir, *output_file.split('/'))
+            workers[name] = (input_dir, output_file)
+        return workers
+
+
+def init_ledger(ledger_path, input_dir, batch_size=config.LEDGER_BATCH_SIZE, retry_failed=False,
+                order="walk", folders=()):
+    """Create the ledger, or add new images to it. Returns (added, total).
+
+    Batches are claimed in the order they were added, so `order` (a
+    scheduling policy) decides which images are annotated first.
+    """
+    import scheduling
+
+    paths = list_images(input_dir)
+    if order != "walk":
+        files = scheduling.order_files([os.path.join(input_dir, *p.split('/')) for p in paths],
+                                       order, input_dir, folders)
+        paths = [os.path.relpath(f, input_dir).replace(os.sep, '/') for f in files]
+    ledger = WorkLedger(ledger_path, create=True)
+    try:
+        added = ledger.add_files(paths, batch_size)
+        if retry_failed:
+            added += ledger.requeue_failed(batch_size)
+        return added, ledger.status()["files"]
+    finally:
+        ledger.close()
+
+
+def default_output_file(ledger_path, worker, fmt="jsonl"):
+    """Per-worker output next to the ledger: <ledger>_workers/<worker>.jsonl"""
+    base = os.path.splitext(ledger_path)[0] + "_workers"
+    return os.path.join(base, worker + record_io.FORMAT_EXTENSIONS[fmt])
+
+
+class LedgerWorker:
+    """Claims batches from the ledger and annotates them with ImagePreprocessor.
+
+    Records of a batch are kept in memory until the whole batch is done,
+    then saved to this worker's output file before the ledger marks the
+    batch done. If the lease is lost in between (the worker stalled past
+    it and another worker took the batch over), the batch's records are
+    dropped, so every image ends up annotated by one worker only. If the
+    output file cannot be written, the batch is handed back and the worker
+    stops, with the reason in `error`.
+    """
+
+    def __init__(self, ledger_path, input_dir, worker=None, output_file=None,
+                 lease_seconds=config.LEDGER_LEASE_SECONDS, wait=False, log_callback=None, progress_callback=None):
+        from pre_process import ImagePreprocessor
+
+        self.ledger_path = ledger_path
+        self.input_dir = input_dir
+        self.worker = worker or default_worker_name()
+        self.output_file = output_file or default_output_file(ledger_path, self.worker)
+        self.lease_seconds = lease_seconds
+        # Keep polling while other workers hold leases, to pick up their batches if they crash
+        self.wait = wait
+        self.log_callback = log_callback
+        self.progress_callback = progress_callback
+        self._is_running = True
+        self.annotated = 0
+        self.batches = 0
+        self.lost_batches = 0
+        self.error = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_file)), exist_ok=True)
+        self.ledger = WorkLedger(ledger_path)
+        self.processor = ImagePreprocessor(input_dir, self.output_file)
+
+    def log(self, msg):
+        if self.log_callback:
+            self.log_callback(msg)
+        else:
+            print(msg)
+
+    def stop(self):
+        self._is_running = False
+
+    def run(self):
+        """Work until no batch is left (or stop() is called). Returns the number of images annotated."""
+        ledger = self.ledger
+        ledger.register(self.worker, self.input_dir, self.output_file)
+        self.log(f"Worker '{self.worker}' writing to {self.output_file}")
+        self._batch_id = None
+        try:
+            with profiling.profiled("ledger_work"):
+                self._run_batches()
+        except BaseException:
+            # Hand the unfinished batch back right away instead of waiting for the lease to expire
+            if self._batch_id is not None:
+                try:
+                    ledger.release(self._batch_id, self.worker)
+                except sqlite3.Error:
+                    pass
+            raise
+        finally:
+            ledger.close()
+        return self.annotated
+
+    def _run_batches(self):
+        ledger = self.ledger
+        while self._is_running:
+            claimed = ledger.claim(self.worker, self.lease_seconds)
+            if not claimed:
+                if self.wait and ledger.active_leases():
+                    time.sleep(min(60, self.lease_seconds / 4))
+                    continue
+                self.log("No batches left.")
+                break
+            self._batch_id, paths = claimed
+            with profiling.span("batch", batch=self._batch_id, images=len(paths)):
+                self._run_batch(self._batch_id, paths)
+            self._batch_id = None
+
+    def _run_batch(self, batch_id, paths):
+        ledger = self.ledger
+        processor = self.processor
+        self.log(f"Batch {batch_id}: {len(paths)} images")
+        items = []
+        done_paths = []
+        failed = {}
+        for i, rel in enumerate(paths):
+            if not self._is_running:
+                ledger.release(batch_id, self.worker)
+                return
+            file_path = os.path.join(self.input_dir, *rel.split('/'))
+            if os.path.abspath(file_path) in processor.processed_files:
+                # Annotated before a restart, but the batch was never completed
+                done_paths.append(rel)
+                continue
+            if not ledger.renew(batch_id, self.worker, self.lease_seconds):
+                self.log(f"Batch {batch_id}: lease lost to another worker, dropping it.")
+                self.lost_batches += 1
+                return
+            try:
+                with profiling.span("image", file=rel):
+                    item = processor.process_file(file_path, self.log_callback)
+                # What merge_outputs matches records on, whatever OS this worker runs on
+                item["_ledger_path"] = rel
+                items.append(item)
+                done_paths.append(rel)
+            except Exception as e:
+                # Recorded as failed; `ledger init --retry-failed` queues it again
+                self.log(f"ERROR processing {file_path}: {e}")
+                failed[rel] = str(e)
+            if self.progress_callback:
+                self.progress_callback(i + 1, len(paths))
+            time.sleep(config.VLM_RATE_LIMIT_SECONDS)
+
+        # The records are saved before the ledger vouches for them
+        if not ledger.renew(batch_id, self.worker, self.lease_seconds):
+            self.log(f"Batch {batch_id}: lease lost to another worker, dropping it.")
+            self.lost_batches += 1
+            return
+        for item in items:
+            processor.data.append(item)
+            processor.processed_files.add(item["original_path"])
+        try:
+            processor.write_data()
+        except Exception as e:
+            # The records are not on disk, so the ledger must not credit them to this worker
+            self.error = f"failed to save {self.output_file}: {e}"
+            self.log(f"Batch {batch_id}: {self.error}; handing the batch back and stopping.")
+            ledger.release(batch_id, self.worker)
+            self.stop()
+            return
+        if not ledger.complete(batch_id, self.worker, done_paths, failed):
+            # Saved, but the merge only takes records from the worker the ledger names
+            self.log(f"Batch {batch_id}: lease lost to another worker, dropping it.")
+            self.lost_batches += 1
+            return
+        self.annotated += len(items)
+        self.batches += 1
+
+
+def merge_outputs(ledger_path, output_file, input_dir=None, log_callback=None):
+    """Merge the workers' output files into `output_file`. Returns (written, missing).
+
+    Each image's record is taken from the worker the ledger says annotated
+    it, so records left behind by a crashed or overtaken worker are ignored.
+    With `input_dir`, original_path is rewritten to this machine's mount of
+    the image folder. `missing` counts images the ledger has no record for
+    yet (not annotated, or failed).
+    """
+    import records
+
+    def log(msg):
+        if log_callback:
+            log_callback(msg)
+        else:
+            print(msg)
+
+    ledger = WorkLedger(ledger_path)
+    try:
+        owners = ledger.owners()
+        workers = ledger.workers()
+        total = ledger.status()["files"]
+    finally:
+        ledger.close()
+
+    merged = records.RecordTable()
+    seen = set()
+    kept_uuids = {}
+    for worker, (worker_input_dir, worker_output) in sorted(workers.items()):
+        if not os.path.exists(worker_output):
+            # Fine for a worker that never finished a batch
+            if worker in owners.values():
+                log(f"Warning: output of worker '{worker}' not found: {worker_output}")
+            continue
+        kept = 0
+        for item in record_io.iter_items(worker_output):
+            rel = item.pop("_ledger_path", None)
+            if rel is None:
+                # Written by an older version
+                rel = ledger_relpath(item.get("original_path", ""), worker_input_dir)
+            if owners.get(rel) != worker or rel in seen:
+                continue
+            seen.add(rel)
+            if input_dir:
+                item["original_path"] = os.path.abspath(os.path.join(input_dir, *rel.split('/')))
+            merged.append(item)
+            kept_uuids.setdefault(worker, set()).add(item.get("uuid"))
+            kept += 1
+        log(f"{worker}: {kept} records")
+
+    tmp_path = output_file + ".tmp"
+    written = record_io.write_items(tmp_path, merged, record_io.format_of(output_file))
+    os.replace(tmp_path, output_file)
+    _merge_features(workers, kept_uuids, output_file)
+
+    import quality_gate
+    if any(quality_gate.is_rejected(item) for item in merged):
+        rejected, _ = quality_gate.write_report(merged, quality_gate.report_path(output_file))
+        log(f"{rejected} images rejected by the quality gate, see {quality_gate.report_path(output_file)}")
+    return written, total - written
+
+
+def _merge_features(workers, kept_uuids, output_file):
+    """Copy the image features stored by each worker for the records it was credited with."""
+    import image_features
+    sources = [(image_features.default_store_path(workers[w][1]), uuids) for w, uuids in kept_uuids.items()]
+    sources = [(path, uuids) for path, uuids in sources if os.path.exists(path)]
+    if not sources:
+        return
+    store = image_features.FeatureStore(image_features.default_store_path(output_file))
+    try:
+        for path, uuids in sources:
+            source = image_features.FeatureStore(path)
+            try:
+                wanted = {image_features.uuid_bytes(u) for u in uuids if u}
+                found = source.all()
+                store.add(found[[bytes(u) in wanted for u in found["uuid"]]])
+            finally:
+                source.close()
+    finally:
+        store.close()